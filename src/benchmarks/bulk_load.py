@@ -0,0 +1,77 @@
+"""
+Times LOAD of a project's existing backups into scratch databases, once with the default connection profile and once
+with the bulk-load profile, and reports rows/sec per table. augmented_tdd.db is not touched.
+
+Usage: python -m benchmarks.bulk_load <project_name> [TABLE ...]
+"""
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import database.db_connection as db_connection
+from database.create_atdd import create_tables
+from database.db_action import DbAction
+from database.db_populator_manager import table_populators
+from utils.config_interface import get_all_projects
+
+# Tables whose LOAD reads a backup file; the others are too small to be worth timing
+backed_up_tables = ['JIRA_ISSUES', 'GIT_COMMITS', 'GIT_COMMIT_VERSION', 'GIT_COMMIT_CHANGES', 'GIT_COMMIT_JIRA',
+                    'REFACTORING_MINER', 'DESIGNITE_SMELLS', 'STATIC_METRICS']
+
+
+def time_load(project, table_name, bulk_load, scratch_db_path):
+    """
+    Loads one table into a freshly created scratch database
+
+    :return: (rows loaded, seconds taken)
+    :rtype: tuple
+    """
+    if os.path.exists(scratch_db_path):
+        os.remove(scratch_db_path)
+    with sqlite3.connect(scratch_db_path) as conn:
+        create_tables(conn)
+
+    populator = table_populators[table_name](project, DbAction(DbAction.LOAD), bulk_load=bulk_load)
+    if populator.db_backup.backup_file is None:
+        populator.finish()
+        return None, None
+
+    start = time.perf_counter()
+    populator.execute(DbAction(DbAction.LOAD))
+    seconds = time.perf_counter() - start
+
+    with sqlite3.connect(scratch_db_path) as conn:
+        n_rows = conn.execute(f'SELECT COUNT(*) FROM {populator.db_table_name}').fetchone()[0]
+
+    return n_rows, seconds
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+
+    target_project = get_all_projects()[sys.argv[1]]
+    target_tables = sys.argv[2:] if len(sys.argv) > 2 else backed_up_tables
+
+    scratch_dir = tempfile.mkdtemp()
+    db_connection.DB_ABSPATH = os.path.join(scratch_dir, 'bulk_load_benchmark.db')
+
+    print(f'{"table":<22}{"rows":>12}{"default rows/s":>18}{"bulk rows/s":>18}{"speedup":>10}')
+    try:
+        for target_table in target_tables:
+            rows, default_seconds = time_load(target_project, target_table, False, db_connection.DB_ABSPATH)
+            if rows is None:
+                print(f'{target_table:<22}{"no backup":>12}')
+                continue
+            _, bulk_seconds = time_load(target_project, target_table, True, db_connection.DB_ABSPATH)
+
+            default_rate = rows / default_seconds
+            bulk_rate = rows / bulk_seconds
+            print(f'{target_table:<22}{rows:>12}{default_rate:>18.0f}{bulk_rate:>18.0f}'
+                  f'{bulk_rate / default_rate:>9.2f}x')
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
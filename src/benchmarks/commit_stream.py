@@ -0,0 +1,87 @@
+"""
+Times the git-history populators' traversal: one walk per populator (the previous behaviour) against a single
+CommitStream shared by all of them.
+
+Usage: python -m benchmarks.commit_stream <repo_path>
+"""
+import sys
+import time
+
+from database.commit_stream import CommitStream
+from pydriller import Repository
+
+
+class _CommitsProbe:
+    """ Touches the same commit properties as GitCommitsPopulator """
+
+    def _start_commit_stream(self):
+        pass
+
+    def _receive_commit(self, commit):
+        return (commit.hash, commit.msg, commit.author.name, commit.author_date, commit.author_timezone,
+                commit.committer.name, commit.committer_date, commit.committer_timezone, commit.in_main_branch,
+                commit.merge, commit.parents)
+
+    def _finish_commit_stream(self):
+        pass
+
+
+class _CommitChangesProbe(_CommitsProbe):
+    """ Touches the same commit properties as GitCommitChangesPopulator """
+
+    def _receive_commit(self, commit):
+        for f in commit.modified_files:
+            _ = (f.old_path, f.new_path, f.change_type, f.diff, f.added_lines, f.deleted_lines, f.nloc,
+                 f.complexity, f.token_count, f.methods)
+
+
+class _CommitVersionProbe(_CommitsProbe):
+    """ Touches the same commit properties as GitCommitReleasePopulator """
+
+    def _receive_commit(self, commit):
+        return commit.hash, commit.author_date
+
+
+probe_classes = [_CommitsProbe, _CommitChangesProbe, _CommitVersionProbe]
+
+
+def time_separate_walks(repo_path):
+    start = time.perf_counter()
+    for probe_class in probe_classes:
+        probe = probe_class()
+        for commit in Repository(repo_path, order='').traverse_commits():
+            probe._receive_commit(commit)
+    return time.perf_counter() - start
+
+
+def time_shared_stream(repo_path):
+    start = time.perf_counter()
+    commit_stream = CommitStream(repo_path)
+    for probe_class in probe_classes:
+        commit_stream.subscribe(probe_class())
+    commit_stream.walk()
+    return time.perf_counter() - start
+
+
+def time_single_walk(repo_path):
+    start = time.perf_counter()
+    for _ in Repository(repo_path, order='').traverse_commits():
+        pass
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+
+    target_repo = sys.argv[1]
+
+    bare_walk = time_single_walk(target_repo)
+    separate = time_separate_walks(target_repo)
+    shared = time_shared_stream(target_repo)
+
+    print(f'Bare traversal (no subscribers):          {bare_walk:10.2f}s')
+    print(f'Per-populator walks ({len(probe_classes)} traversals):     {separate:10.2f}s')
+    print(f'Shared CommitStream (1 traversal):        {shared:10.2f}s')
+    print(f'Speedup:                                  {separate / shared:10.2f}x')
@@ -0,0 +1,104 @@
+"""
+Times JIRA_ISSUES row parsing: the previous BeautifulSoup parser, which searched each row once per attribute, against
+the single-pass lxml parser. Both must produce the same records.
+
+Usage: python -m benchmarks.jira_parsing [saved_page.html ...]
+    Pages can be saved from a project's SearchRequest.html export. Without pages, a synthetic 1000-row page is used
+"""
+import sys
+import time
+from datetime import datetime
+
+from bs4 import BeautifulSoup
+
+from database.db_populators.jira_issues import desired_jira_attributes, attributes_to_listify, \
+    attributes_to_dateify, parse_issue_rows
+
+
+def legacy_parse_issue_rows(html):
+    """ The per-attribute BeautifulSoup parser JiraIssuesPopulator used before """
+    parsed_html = BeautifulSoup(html, 'html.parser')
+    parsed_html = parsed_html.find('tbody')
+
+    thousand_keys = []
+    for tr in parsed_html.find_all('tr'):
+        key_attributes = []
+        for i, html_attribute in enumerate(desired_jira_attributes.keys()):
+            value = tr.find('td', attrs={'class': html_attribute})
+
+            if value is None:
+                value = ''
+            else:
+                value = value.get_text(strip=True)
+
+            if html_attribute in attributes_to_listify:
+                value = value.split()
+            elif html_attribute in attributes_to_dateify and value != '':
+                value_time_obj = None
+                try:
+                    value_time_obj = datetime.strptime(value, '%d/%b/%y %H:%M')
+                except:
+                    value_time_obj = datetime.strptime(value, '%d/%b/%y')
+                value = str(value_time_obj)
+
+            key_attributes.append(value)
+        thousand_keys.insert(0, key_attributes)
+
+    return thousand_keys
+
+
+def synthetic_page(n_rows=1000):
+    """
+    :return: an HTML export shaped like Jira's, with extra columns, nested markup and entities
+    :rtype: str
+    """
+    rows = []
+    for n in range(n_rows, 0, -1):
+        cells = []
+        for html_attribute in desired_jira_attributes.keys():
+            if html_attribute in ('created', 'updated', 'resolutiondate'):
+                value = f'{n % 28 + 1:02d}/Mar/21 10:{n % 60:02d}'
+            elif html_attribute == 'duedate':
+                value = '' if n % 3 else f'{n % 28 + 1:02d}/Apr/21'
+            elif html_attribute in attributes_to_listify:
+                value = f'<a href="#">1.{n % 7}.0</a>, <a href="#">2.{n % 5}.0</a>'
+            elif html_attribute == 'description':
+                value = f'<div><p>Line one &amp; <b>bold</b></p>\n  <p>issue {n}</p></div>'
+            else:
+                value = f'  {html_attribute} {n}\n'
+            cells.append(f'<td class="{html_attribute}">{value}</td>')
+        cells.append('<td class="customfield_12310220">unused</td>')
+        rows.append(f'<tr id="issuerow{n}" class="issuerow">{"".join(cells)}</tr>')
+
+    return f'<html><body><table id="issuetable"><tbody>{"".join(rows)}</tbody></table></body></html>'
+
+
+def time_parser(parse, pages):
+    """
+    :return: (records of every page, rows parsed per second)
+    :rtype: tuple
+    """
+    start = time.perf_counter()
+    records = [parse(page) for page in pages]
+    elapsed = time.perf_counter() - start
+
+    n_rows = sum(len(page_records) for page_records in records)
+    return records, n_rows / elapsed
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        pages = []
+        for page_path in sys.argv[1:]:
+            with open(page_path, 'r', encoding='utf-8') as page_file:
+                pages.append(page_file.read())
+    else:
+        pages = [synthetic_page()]
+
+    legacy_records, legacy_rate = time_parser(legacy_parse_issue_rows, pages)
+    records, rate = time_parser(parse_issue_rows, pages)
+
+    print(f'{"parser":<24}{"rows/sec":>12}')
+    print(f'{"BeautifulSoup (legacy)":<24}{legacy_rate:>12.0f}')
+    print(f'{"lxml single-pass":<24}{rate:>12.0f}')
+    print(f'Speedup: {rate / legacy_rate:.1f}x. Identical records: {records == legacy_records}')
@@ -0,0 +1,80 @@
+"""
+Times every Project.get_* query for one project. If the database has an older schema version, the queries are also
+timed against a migrated scratch copy, so the effect of the typed, indexed schema and its rollups can be compared.
+augmented_tdd.db itself is never modified.
+
+Usage: python -m benchmarks.project_queries <project_name> [database_path]
+"""
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import warnings
+
+import database.db_connection as db_connection
+from database.create_atdd import SCHEMA_VERSION, migrate_atdd
+from utils.config_interface import get_all_projects
+
+query_methods = ['get_version_history', 'get_issue_times', 'get_packages_belonging_to_keys', 'get_all_pv_metrics',
+                 'get_issue_pv_metrics', 'get_issue_refactorings', 'get_issue_smells', 'get_issue_commit_metrics',
+                 'get_pv_linked_refactorings', 'get_pv_smells', 'build_issue_feature_matrix']
+
+
+def time_queries(project, db_path):
+    """
+    :return: query method name -> seconds taken, or the raised exception's name
+    :rtype: dict
+    """
+    db_connection.DB_ABSPATH = db_path
+    db_connection.TEST_DB_ABSPATH = db_path
+    # Nothing read from the previous database may be reused
+    project.close()
+    project.clear_query_cache()
+
+    timings = {}
+    for method_name in query_methods:
+        start = time.perf_counter()
+        try:
+            getattr(project, method_name)()
+            timings[method_name] = time.perf_counter() - start
+        except Exception as e:
+            timings[method_name] = type(e).__name__
+
+    return timings
+
+
+def schema_version(db_path):
+    with sqlite3.connect(db_path) as conn:
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def _format_timing(timing):
+    return f'{timing:>14.3f}s' if isinstance(timing, float) else f'{timing:>15}'
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+
+    warnings.filterwarnings('ignore')
+    target_project = get_all_projects(include_test=True)[sys.argv[1]]
+    source_db = sys.argv[2] if len(sys.argv) > 2 else db_connection.DB_ABSPATH
+
+    scratch_dir = tempfile.mkdtemp()
+    try:
+        columns = {'current': time_queries(target_project, source_db)}
+
+        if schema_version(source_db) < SCHEMA_VERSION:
+            migrated_db = os.path.join(scratch_dir, 'migrated.db')
+            shutil.copyfile(source_db, migrated_db)
+            migrate_atdd(migrated_db)
+            columns['migrated'] = time_queries(target_project, migrated_db)
+
+        print(f'{"query":<32}' + ''.join(f'{column_name:>15}' for column_name in columns))
+        for method_name in query_methods:
+            print(f'{method_name:<32}' + ''.join(_format_timing(timings[method_name]) for timings in columns.values()))
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
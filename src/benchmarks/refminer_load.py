@@ -0,0 +1,172 @@
+"""
+LOADs synthetic RefactoringMiner output files of increasing size into scratch databases, with the default and the
+bulk-load connection profiles, and reports rows/sec and how much the loading process's peak RSS grew. augmented_tdd.db
+is not touched. Needs the resource module (Linux, macOS).
+
+Then asserts that memory is bounded whatever the file's size: the default profile's growth stays under
+DEFAULT_MAX_RSS_GROWTH_MB at every size and flat across sizes (the streaming parser), and the bulk-load profile's stays
+under db_connection.BULK_LOAD_MEMORY_FACTOR times bulk_load_cache_mb (SQLite's page cache and sorts) plus
+BULK_LOAD_RSS_SLACK_MB.
+
+Usage: python -m benchmarks.refminer_load [size_mb size_mb ...]    (at least two sizes; default: 256 2048)
+"""
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import database.db_connection as db_connection
+from database.create_atdd import create_tables
+from database.db_action import DbAction
+from database.db_populators.refactoring_miner import RefMinerPopulator
+from utils.config_interface import get_processing_option
+from utils.project import Project
+
+# Most the default profile's peak RSS may grow by at any size, and by how much more at the largest size than the smallest
+DEFAULT_MAX_RSS_GROWTH_MB = 64
+FLAT_RSS_TOLERANCE_MB = 16
+# Allowance on top of the bulk-load profile's SQLite memory, for the parser and the interpreter
+BULK_LOAD_RSS_SLACK_MB = 64
+
+refactoring_types = ['Extract Method', 'Rename Variable', 'Move Class', 'Change Parameter Type', 'Add Parameter',
+                     'Rename Method', 'Extract Variable', 'Inline Method']
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 1024 ** 2 if sys.platform == 'darwin' else max_rss / 1024
+
+
+def _location(file_path, line):
+    return {'filePath': file_path, 'startLine': line, 'endLine': line + 12, 'startColumn': 5, 'endColumn': 6,
+            'codeElementType': 'METHOD_DECLARATION', 'description': 'original method declaration',
+            'codeElement': f'public method{line}(arg String) : void'}
+
+
+def write_synthetic_output(file_path, size_mb, seed=0):
+    """
+    Writes a RefactoringMiner-shaped json file of about size_mb megabytes, one commit at a time
+
+    :return: the number of refactorings in the file
+    :rtype: int
+    """
+    rng = random.Random(seed)
+    n_refactorings = 0
+    target_bytes = size_mb * 1024 ** 2
+
+    with open(file_path, 'w', encoding='utf-8') as file:
+        file.write('{"commits":[')
+        n_commits = 0
+        while file.tell() < target_bytes:
+            refactorings = []
+            for _ in range(rng.randint(0, 20)):
+                package_path = f'src/main/java/org/project/module{rng.randint(0, 200)}'
+                file_path_in_repo = f'{package_path}/Class{rng.randint(0, 5000)}.java'
+                line = rng.randint(1, 3000)
+                refactorings.append({
+                    'type': rng.choice(refactoring_types),
+                    'description': f'Refactoring of method{line}() in class {file_path_in_repo}',
+                    'leftSideLocations': [_location(file_path_in_repo, line)],
+                    'rightSideLocations': [_location(file_path_in_repo, line + 1)],
+                })
+            n_refactorings = n_refactorings + len(refactorings)
+
+            commit = {'repository': 'https://github.com/apache/project.git', 'sha1': f'{rng.getrandbits(160):040x}',
+                      'url': 'https://github.com/apache/project/commit/', 'refactorings': refactorings}
+            file.write((',' if n_commits > 0 else '') + json.dumps(commit))
+            n_commits = n_commits + 1
+        file.write(']}')
+
+    return n_refactorings
+
+
+def load_output(json_path, db_path, bulk_load):
+    """
+    LOADs one RefactoringMiner output file into a fresh scratch database. Runs in its own process, so its peak RSS is
+    that of this load alone
+
+    :return: (rows loaded, seconds taken, peak RSS before the load in MB, peak RSS after the load in MB)
+    :rtype: tuple
+    """
+    db_connection.DB_ABSPATH = db_path
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    with sqlite3.connect(db_path) as conn:
+        create_tables(conn)
+
+    project = Project('ME', 'refminer_benchmark', 'master', '', '')
+    populator = RefMinerPopulator(project, DbAction(DbAction.LOAD), bulk_load=bulk_load)
+    populator.db_backup.backup_file = json_path  # The synthetic output, in place of the project's latest backup
+
+    rss_before = _peak_rss_mb()
+    start = time.perf_counter()
+    populator.execute(DbAction(DbAction.LOAD))
+    seconds = time.perf_counter() - start
+
+    return populator.rows_loaded, seconds, rss_before, _peak_rss_mb()
+
+
+def check_rss_growth(rss_growth):
+    """
+    Asserts that the loads' memory is bounded whatever the file's size (see the module docstring)
+
+    :param rss_growth: (size_mb, bulk_load) -> RSS growth in MB, for at least two sizes
+    :type rss_growth: dict
+    """
+    sizes_mb = sorted({size_mb for size_mb, _ in rss_growth})
+    default_growth = [rss_growth[(size_mb, False)] for size_mb in sizes_mb]
+    assert max(default_growth) <= DEFAULT_MAX_RSS_GROWTH_MB, \
+        f'default profile RSS grew by {max(default_growth):.1f} MB, over {DEFAULT_MAX_RSS_GROWTH_MB} MB'
+    assert default_growth[-1] - default_growth[0] <= FLAT_RSS_TOLERANCE_MB, \
+        f'default profile RSS growth is not flat: {default_growth[0]:.1f} MB at {sizes_mb[0]} MB, ' \
+        f'{default_growth[-1]:.1f} MB at {sizes_mb[-1]} MB'
+
+    cache_size_mb = get_processing_option('bulk_load_cache_mb', db_connection.BULK_LOAD_CACHE_MB)
+    max_bulk_growth = db_connection.BULK_LOAD_MEMORY_FACTOR * cache_size_mb + BULK_LOAD_RSS_SLACK_MB
+    bulk_growth = max(rss_growth[(size_mb, True)] for size_mb in sizes_mb)
+    assert bulk_growth <= max_bulk_growth, \
+        f'bulk-load profile RSS grew by {bulk_growth:.1f} MB, over {max_bulk_growth} MB'
+
+
+if __name__ == '__main__':
+    sizes_mb = [int(size) for size in sys.argv[1:]] or [256, 2048]
+    if len(set(sizes_mb)) < 2:
+        sys.exit('Give at least two file sizes, so that RSS growth can be compared across sizes')
+
+    rss_growth = {}
+    scratch_dir = tempfile.mkdtemp()
+    print(f'{"file (MB)":>10}{"profile":>9}{"rows":>12}{"seconds":>10}{"rows/s":>12}{"peak RSS (MB)":>15}'
+          f'{"RSS growth (MB)":>17}')
+    try:
+        for size_mb in sizes_mb:
+            json_path = os.path.join(scratch_dir, f'refminer_{size_mb}.json')
+            db_path = os.path.join(scratch_dir, f'refminer_{size_mb}.db')
+            expected_rows = write_synthetic_output(json_path, size_mb)
+
+            for bulk_load in (False, True):
+                # A new process per load, so each load's peak RSS is measured on its own
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                    rows, seconds, rss_before, rss_after = executor.submit(load_output, json_path, db_path,
+                                                                           bulk_load).result()
+
+                assert rows == expected_rows, f'Loaded {rows} rows, but the file holds {expected_rows} refactorings'
+                rss_growth[(size_mb, bulk_load)] = rss_after - rss_before
+                print(f'{os.path.getsize(json_path) / 1024 ** 2:>10.0f}{"bulk" if bulk_load else "default":>9}'
+                      f'{rows:>12}{seconds:>10.1f}{rows / seconds:>12.0f}{rss_after:>15.1f}'
+                      f'{rss_after - rss_before:>17.1f}')
+
+            os.remove(json_path)
+            os.remove(db_path)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    check_rss_growth(rss_growth)
+    print('RSS growth is bounded')
@@ -0,0 +1,251 @@
+"""
+Index of the dated backup files in root/database/db_loadfiles, so that finding a table's latest backup, listing a
+project's backups and cleaning up old ones never scan the directory.
+
+Each backup has one row with its project, table, timestamp, format, row count, size and SHA-256 checksum. DbBackup
+registers the files it writes; files that appear any other way (i.e, copied or restored into the folder) are picked up
+by `BackupManifest.latest` once the folder's modification time changes, and fully indexed by `BackupManifest.rebuild`,
+which runs automatically the first time the manifest is created.
+"""
+import csv
+import hashlib
+import os
+import re
+import sqlite3
+from contextlib import closing
+
+import pyarrow.parquet as pq
+
+from utils.top_level_paths import database_directory
+
+MANIFEST_PATH = os.path.join(database_directory, 'db_backup_manifest.db')
+
+# <project>_<TABLE>_<timestamp>.<ext>, i.e. hive_GIT_COMMITS_2022-01-31_12-00-00.csv. Table names are upper case
+backup_file_pattern = re.compile(
+    r'^(?P<project_name>.+?)_(?P<table_name>[A-Z][A-Z0-9_]*)_(?P<file_time>\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})'
+    r'\.(?P<file_ext>\w+)$'
+)
+
+create_manifest_tables = [
+    'CREATE TABLE IF NOT EXISTS BACKUPS (file_name TEXT PRIMARY KEY, file_prefix TEXT, project_name TEXT, '
+    'table_name TEXT, file_time TEXT, file_ext TEXT, n_rows INTEGER, size INTEGER, checksum TEXT)',
+    'CREATE INDEX IF NOT EXISTS BACKUPS_PREFIX_TIME ON BACKUPS (file_prefix, file_time)',
+    'CREATE TABLE IF NOT EXISTS MANIFEST_INFO (name TEXT PRIMARY KEY, value TEXT)',
+]
+
+manifest_columns = ['file_name', 'file_prefix', 'project_name', 'table_name', 'file_time', 'file_ext', 'n_rows',
+                    'size', 'checksum']
+
+
+def parse_backup_file_name(file_name):
+    """
+    :return: the project_name, table_name, file_time and file_ext encoded in a backup's file name, or None if the
+        file is not a backup (i.e, an unfinished parquet backup)
+    :rtype: dict
+    """
+    match = backup_file_pattern.match(file_name)
+    return match.groupdict() if match else None
+
+
+def file_checksum(file_path):
+    """
+    :return: the SHA-256 of a file, read in chunks
+    :rtype: str
+    """
+    checksum = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def count_backup_rows(file_path):
+    """
+    :return: the number of records in a csv or parquet backup, or None for other formats
+    :rtype: int
+    """
+    if file_path.endswith('.parquet'):
+        return pq.ParquetFile(file_path).metadata.num_rows
+    if file_path.endswith('.csv'):
+        with open(file_path, 'r', encoding='utf-8') as file:
+            return sum(1 for _ in csv.reader(line.replace('\0', '') for line in file))
+    return None
+
+
+class BackupManifest:
+    """
+    :param backup_dir: the folder holding the backups
+    :type backup_dir: str
+    :param manifest_path: the manifest database, MANIFEST_PATH if not given
+    :type manifest_path: str
+    """
+
+    def __init__(self, backup_dir, manifest_path=None):
+        self.backup_dir = backup_dir
+        self.manifest_path = manifest_path or MANIFEST_PATH
+
+        is_new = not os.path.exists(self.manifest_path)
+        with closing(self._connect()) as conn, conn:
+            for create_statement in create_manifest_tables:
+                conn.execute(create_statement)
+
+        # Backups written before the manifest existed are indexed once
+        if is_new:
+            self.rebuild()
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+        return sqlite3.connect(self.manifest_path, timeout=60)
+
+    def register(self, file_path, n_rows=None, checksum=True):
+        """
+        Adds or updates a backup's entry from the file on disk
+
+        :param n_rows: the backup's record count, if known
+        :type n_rows: int
+        :param checksum: whether to checksum the file. Files that are still being written are registered without
+            one, and rebuilt later if they are never finished
+        :type checksum: bool
+        """
+        file_name = os.path.basename(file_path)
+        name_parts = parse_backup_file_name(file_name)
+        if name_parts is None:
+            return
+
+        file_prefix = f'{name_parts["project_name"]}_{name_parts["table_name"]}_'
+        exists = os.path.exists(file_path)
+        size = os.path.getsize(file_path) if exists else 0
+        file_hash = file_checksum(file_path) if checksum and exists else None
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute('INSERT OR REPLACE INTO BACKUPS VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         (file_name, file_prefix, name_parts['project_name'], name_parts['table_name'],
+                          name_parts['file_time'], name_parts['file_ext'], n_rows, size, file_hash))
+
+    def remove(self, file_path):
+        with closing(self._connect()) as conn, conn:
+            conn.execute('DELETE FROM BACKUPS WHERE file_name = ?', (os.path.basename(file_path),))
+
+    def entry(self, file_path):
+        """
+        :return: a backup's manifest row, by column name, or None if it is not registered
+        :rtype: dict
+        """
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT * FROM BACKUPS WHERE file_name = ?', (os.path.basename(file_path),)).fetchone()
+        return dict(zip(manifest_columns, row)) if row else None
+
+    def _backup_dir_mtime(self):
+        return str(os.stat(self.backup_dir).st_mtime_ns) if os.path.isdir(self.backup_dir) else None
+
+    def reconcile(self):
+        """
+        Registers the backup files the manifest does not know, and drops the entries of deleted files, if the backup
+        folder changed since the last reconcile (by its modification time, so an unchanged folder costs one stat). New
+        files are registered as unfinished, without reading them, in case they are still being written; `rebuild`
+        completes them
+        """
+        backup_dir_mtime = self._backup_dir_mtime()
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT value FROM MANIFEST_INFO WHERE name = 'backup_dir_mtime'").fetchone()
+        if backup_dir_mtime is None or (row is not None and row[0] == backup_dir_mtime):
+            return
+
+        registered = {backup['file_name'] for backup in self.backups()}
+        on_disk = {file_name for file_name in os.listdir(self.backup_dir) if parse_backup_file_name(file_name)}
+        for file_name in sorted(on_disk - registered):
+            print(f'Found unindexed backup {file_name}')
+            self.register(os.path.join(self.backup_dir, file_name), checksum=False)
+        for file_name in registered - on_disk:
+            self.remove(file_name)
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO MANIFEST_INFO VALUES ('backup_dir_mtime', ?)", (backup_dir_mtime,))
+
+    def latest(self, file_prefix):
+        """
+        :param file_prefix: <project>_<TABLE>_
+        :type file_prefix: str
+        :return: absolute path of the most recent backup with the prefix, or None. The manifest is reconciled with the
+            folder first if the folder changed, and entries whose file was deleted are dropped on the way
+        :rtype: str
+        """
+        self.reconcile()
+        with closing(self._connect()) as conn, conn:
+            while True:
+                row = conn.execute('SELECT file_name FROM BACKUPS WHERE file_prefix = ? '
+                                   'ORDER BY file_time DESC LIMIT 1', (file_prefix,)).fetchone()
+                if row is None:
+                    return None
+
+                file_path = os.path.abspath(os.path.join(self.backup_dir, row[0]))
+                if os.path.exists(file_path):
+                    return file_path
+                conn.execute('DELETE FROM BACKUPS WHERE file_name = ?', (row[0],))
+
+    def backups(self, project_name=None):
+        """
+        :return: manifest rows by column name, of one project or of all, newest first within each table
+        :rtype: list
+        """
+        query = 'SELECT * FROM BACKUPS'
+        parameters = ()
+        if project_name is not None:
+            query = query + ' WHERE project_name = ?'
+            parameters = (project_name,)
+
+        with closing(self._connect()) as conn:
+            rows = conn.execute(f'{query} ORDER BY project_name, table_name, file_time DESC', parameters).fetchall()
+        return [dict(zip(manifest_columns, row)) for row in rows]
+
+    def rebuild(self):
+        """
+        Reconciles the manifest with the backup folder in one pass: new and changed files are registered (counting
+        their rows), unfinished entries are completed, and entries of deleted files are dropped
+        """
+        registered = {backup['file_name']: backup for backup in self.backups()}
+        on_disk = set()
+
+        for file_name in os.listdir(self.backup_dir) if os.path.isdir(self.backup_dir) else []:
+            if parse_backup_file_name(file_name) is None:
+                continue
+            on_disk.add(file_name)
+
+            file_path = os.path.join(self.backup_dir, file_name)
+            backup = registered.get(file_name)
+            if backup is None or backup['checksum'] is None or backup['size'] != os.path.getsize(file_path):
+                print(f'Indexing backup {file_name}')
+                self.register(file_path, n_rows=count_backup_rows(file_path))
+
+        for file_name in registered.keys() - on_disk:
+            self.remove(file_name)
+
+    def cleanup(self):
+        """
+        Deletes every backup but the most recent of each project's table, in a single pass over the manifest
+        """
+        self.rebuild()
+
+        kept_prefixes = set()
+        for backup in sorted(self.backups(), key=lambda backup: (backup['file_prefix'], backup['file_time']),
+                             reverse=True):
+            if backup['file_prefix'] not in kept_prefixes:
+                kept_prefixes.add(backup['file_prefix'])
+                print('Keeping file ' + backup['file_name'])
+                continue
+
+            print('Deleting file ' + backup['file_name'])
+            os.remove(os.path.join(self.backup_dir, backup['file_name']))
+            self.remove(backup['file_name'])
+
+
+def format_backups(backups):
+    """
+    :return: a table of manifest rows, one line per backup
+    :rtype: str
+    """
+    lines = [f'{"file":<64}{"rows":>12}{"size (MB)":>12}']
+    for backup in backups:
+        n_rows = '?' if backup['n_rows'] is None else backup['n_rows']
+        lines.append(f'{backup["file_name"]:<64}{n_rows:>12}{backup["size"] / 1024 ** 2:>12.1f}')
+    return '\n'.join(lines)
@@ -0,0 +1,74 @@
+"""
+Walks a repository's git history once and hands every commit to each subscribed populator.
+
+PyDriller's history parsing is the expensive part of every commit-level table, so populators subscribe to a single
+CommitStream instead of each running their own `Repository(...).traverse_commits()`.
+"""
+from pydriller import Repository
+
+from utils import resource_limits, shell_interface
+
+END_LOOP_FLAG = -1
+
+
+class CommitStream:
+    """
+    Fans out each commit of a repository to a set of subscribers
+
+    :param repo_path: path to the local repository
+    :type repo_path: str
+    :param branch: the branch whose history is walked. Without one, the history of whatever is checked out (HEAD) is
+        walked, which after a version walk may be an old version
+    :type branch: str
+    """
+
+    def __init__(self, repo_path, branch=None):
+        self.repo_path = repo_path
+        self.branch = branch
+        self.subscribers = []
+
+    def subscribe(self, subscriber):
+        """
+        Registers a subscriber. Subscribers implement `_start_commit_stream`, `_receive_commit` and
+        `_finish_commit_stream` (see populator_helpers.CommitStreamPopulator)
+        """
+        self.subscribers.append(subscriber)
+
+    def walk(self):
+        """
+        Traverses the history once. A subscriber returning END_LOOP_FLAG from `_receive_commit` is finished
+        immediately and receives no further commits; the walk stops early once every subscriber has left.
+
+        :return: the number of commits traversed
+        :rtype: int
+        """
+        active_subscribers = list(self.subscribers)
+        for subscriber in active_subscribers:
+            subscriber._start_commit_stream()
+
+        branch_ref = None
+        if self.branch:
+            branch_ref = shell_interface.branch_ref(self.repo_path, self.branch)
+            if branch_ref is None:
+                raise ValueError(f'Branch {self.branch} not found in {self.repo_path}')
+
+        n_commits = 0
+        commits = Repository(self.repo_path, only_in_branch=branch_ref, order='').traverse_commits()
+        while len(active_subscribers) > 0:
+            # Parsing and handling a commit is CPU-bound; the resource is held one commit at a time, so a long history
+            # does not keep other projects waiting for the whole walk
+            with resource_limits.acquire('cpu'):
+                commit = next(commits, None)
+                if commit is None:
+                    break
+                n_commits = n_commits + 1
+
+                for subscriber in list(active_subscribers):
+                    if subscriber._receive_commit(commit) == END_LOOP_FLAG:
+                        active_subscribers.remove(subscriber)
+                        subscriber._finish_commit_stream()
+
+        for subscriber in active_subscribers:
+            subscriber._finish_commit_stream()
+
+        return n_commits
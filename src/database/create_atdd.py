@@ -1,116 +1,175 @@
 """
 Attempts to create database tables. If the database already exists, prompts user to delete database, and quits
+
+The schema is versioned through SQLite's user_version pragma. Databases created before the schema was versioned
+have user_version 0 and untyped, unindexed tables; `migrate_atdd` upgrades them in place.
 """
 import os
 import sqlite3
+import sys
+from contextlib import closing
 
-from internal_configs import all_refactoring_types
-from .db_connection import DB_ABSPATH
+from internal_configs import all_refactoring_types, all_smell_types
+from .db_connection import DB_ABSPATH, NEW_DATA_ID
+from .rollups import refresh_rollups, rollup_definitions
 
 all_refactoring_columns = ', '.join(f'"{w}"' for w in all_refactoring_types)
+refactoring_count_columns = ', '.join(f'"{w}" INTEGER' for w in all_refactoring_types)
+smell_count_columns = ', '.join(f'"{w}" INTEGER' for w in all_smell_types)
+
+SCHEMA_VERSION = 4
+
+# create_jira_issues = """
+#     CREATE TABLE JIRA_ISSUES (project_name, "key", creation_date,
+#         resolution_date, update_date, due_date, resolution, type, priority,
+#         fix_versions, versions, time_spent DECIMAL, aggregated_time_spent,
+#         time_estimate, time_original_estimate, aggregate_time_estimate,
+#         progress_percent, component_name, component_description, description,
+#         summary, watch_count, votes, labels, creator_name, creator_active,
+#         assignee, reporter);
+# """
+
+# Table name -> CREATE TABLE statement, in creation order. A LOAD first deletes the project's rows of the table (see
+# Populator._run_load), so LOADing a project again never repeats its rows. LOADs into keyed tables also use INSERT OR
+# REPLACE, so a row that repeats a key within a backup (one appended to twice, an issue that moved to another project)
+# replaces the row loaded before it instead of aborting the LOAD
+table_definitions = {
+    'PROJECTS': """
+        CREATE TABLE PROJECTS (project_name TEXT PRIMARY KEY, git_link TEXT, jira_link TEXT);
+    """,
+    'REFACTORING_MINER': """
+        CREATE TABLE REFACTORING_MINER (project_name TEXT, commit_hash TEXT,
+            refactoring_type TEXT, refactoring_detail TEXT, refactoring_path TEXT, package TEXT);
+    """,
+    'GIT_COMMITS': """
+        CREATE TABLE GIT_COMMITS(project_name TEXT, commit_hash TEXT, commit_message TEXT,
+            author TEXT, author_date TEXT, author_timezone INTEGER, committer TEXT, committer_date TEXT,
+            committer_timezone INTEGER, in_main_branch TEXT, merge TEXT, parents TEXT,
+            PRIMARY KEY (project_name, commit_hash));
+    """,
+    'GIT_COMMITS_CHANGES': """
+        CREATE TABLE GIT_COMMITS_CHANGES(project_name TEXT, commit_hash TEXT, old_path TEXT,
+            new_path TEXT, change_type TEXT, diff TEXT, lines_added INTEGER, lines_removed INTEGER, n_loc INTEGER,
+            complexity INTEGER, token_count INTEGER, methods TEXT);
+    """,
+    'JIRA_ISSUES': """
+        CREATE TABLE JIRA_ISSUES (project_name TEXT, key TEXT PRIMARY KEY, creation_date TEXT, resolution_date TEXT,
+            update_date TEXT, due_date TEXT, resolution TEXT, type TEXT, priority TEXT, fix_versions TEXT,
+            versions TEXT, time_spent DECIMAL, aggregated_time_spent DECIMAL, time_estimate DECIMAL,
+            aggregated_time_estimate DECIMAL, progress_percent TEXT, description TEXT, summary TEXT,
+            watch_count INTEGER, votes INTEGER, creator_name TEXT, assignee TEXT, reporter TEXT);
+    """,
+    'GIT_COMMIT_RELEASE': """
+        CREATE TABLE GIT_COMMIT_RELEASE (project_name TEXT, commit_hash TEXT, date TEXT, version TEXT,
+            PRIMARY KEY (project_name, commit_hash));
+    """,
+    'GIT_COMMIT_JIRA': """
+        CREATE TABLE GIT_COMMIT_JIRA (key TEXT, commit_hash TEXT, PRIMARY KEY (key, commit_hash));
+    """,
+    'DESIGNITE_SMELLS': """
+        CREATE TABLE DESIGNITE_SMELLS (project_name TEXT, version TEXT, package TEXT, smell TEXT, cause TEXT)
+    """,
+    'STATIC_METRICS': """
+        CREATE TABLE STATIC_METRICS (project_name TEXT, package TEXT, version TEXT, pkg_files NUMERIC,
+            pkg_loc NUMERIC, pkg_tokens NUMERIC, pkg_cc NUMERIC, pkg_average_loc NUMERIC, pkg_average_cc NUMERIC,
+            pkg_average_tokens NUMERIC, PRIMARY KEY (project_name, package, version))
+    """,
+    'PROJECT_VERSIONS': """
+        CREATE TABLE PROJECT_VERSIONS (project_name TEXT, version TEXT, commit_hash TEXT, author_date TEXT,
+            previous_version TEXT, PRIMARY KEY (project_name, version))
+    """,
+    # One row, bumped by every LOAD. Cached query results (utils.project) are only valid for the version they read.
+    # data_id is random, and drawn again by every LOAD, so versions of different (i.e, recreated) databases never match
+    'DATA_VERSION': """
+        CREATE TABLE DATA_VERSION (id INTEGER PRIMARY KEY CHECK (id = 0), version INTEGER NOT NULL, data_id TEXT)
+    """,
+    # Rollups of the tables above, rebuilt on every LOAD of their source table. See database.rollups
+    'DESIGNITE_SMELLS_WIDE': f"""
+        CREATE TABLE DESIGNITE_SMELLS_WIDE (project_name TEXT, version TEXT, package TEXT, {smell_count_columns},
+            PRIMARY KEY (project_name, package, version))
+    """,
+    'REFACTORING_MINER_WIDE': f"""
+        CREATE TABLE REFACTORING_MINER_WIDE (project_name TEXT, commit_hash TEXT, package TEXT,
+            {refactoring_count_columns})
+    """,
+    'STATIC_METRICS_PV': """
+        CREATE TABLE STATIC_METRICS_PV (project_name TEXT, package TEXT, version TEXT, pkg_files NUMERIC,
+            pkg_loc NUMERIC, pkg_tokens NUMERIC, pkg_cc NUMERIC, pkg_average_loc NUMERIC, pkg_average_cc NUMERIC,
+            pkg_average_tokens NUMERIC)
+    """,
+}
+
+# Tables of schema version 1, which `_migrate_to_v1` builds. Their CREATE statements have not changed since; changing
+# one takes a migration step of its own, as does adding a table
+v1_tables = ['PROJECTS', 'REFACTORING_MINER', 'GIT_COMMITS', 'GIT_COMMITS_CHANGES', 'JIRA_ISSUES', 'GIT_COMMIT_RELEASE',
+             'GIT_COMMIT_JIRA', 'DESIGNITE_SMELLS', 'STATIC_METRICS', 'PROJECT_VERSIONS']
+
+# Table name -> {legacy column name: its name in the schema}, for columns renamed in schema version 1
+v1_renamed_columns = {
+    'JIRA_ISSUES': {'aggregate_time_estimate': 'aggregated_time_estimate'},
+}
+
+# Secondary indexes for the joins in utils.project. Primary keys above cover the remaining lookups
+index_definitions = [
+    'CREATE INDEX IF NOT EXISTS GIT_COMMITS_CHANGES_PROJECT_COMMIT ON GIT_COMMITS_CHANGES (project_name, commit_hash)',
+    'CREATE INDEX IF NOT EXISTS GIT_COMMITS_CHANGES_COMMIT ON GIT_COMMITS_CHANGES (commit_hash)',
+    'CREATE INDEX IF NOT EXISTS GIT_COMMIT_RELEASE_COMMIT ON GIT_COMMIT_RELEASE (commit_hash, version)',
+    'CREATE INDEX IF NOT EXISTS GIT_COMMIT_JIRA_COMMIT ON GIT_COMMIT_JIRA (commit_hash, key)',
+    'CREATE INDEX IF NOT EXISTS JIRA_ISSUES_PROJECT_KEY ON JIRA_ISSUES (project_name, key, time_spent)',
+    'CREATE INDEX IF NOT EXISTS REFACTORING_MINER_PROJECT_COMMIT ON REFACTORING_MINER (project_name, commit_hash)',
+    'CREATE INDEX IF NOT EXISTS REFACTORING_MINER_COMMIT ON REFACTORING_MINER (commit_hash)',
+    'CREATE INDEX IF NOT EXISTS DESIGNITE_SMELLS_PACKAGE_VERSION ON DESIGNITE_SMELLS (project_name, package, version)',
+    'CREATE INDEX IF NOT EXISTS REFACTORING_MINER_WIDE_PROJECT_COMMIT '
+    'ON REFACTORING_MINER_WIDE (project_name, commit_hash)',
+    'CREATE INDEX IF NOT EXISTS REFACTORING_MINER_WIDE_COMMIT ON REFACTORING_MINER_WIDE (commit_hash)',
+    'CREATE INDEX IF NOT EXISTS STATIC_METRICS_PV_PACKAGE_VERSION ON STATIC_METRICS_PV (project_name, package, version)',
+]
 
 
 def create_tables(conn):
     """
-    Creates all database tables
+    Creates all database tables and their indexes, and stamps the schema version
     :param conn: the connection to the database
     """
-    create_projects = """
-        CREATE TABLE PROJECTS (project_name, git_link, jira_link);
-    """
-    create_ref_miner = """
-        CREATE TABLE REFACTORING_MINER (project_name, commit_hash, 
-            refactoring_type, refactoring_detail, refactoring_path, package);
-    """
-    create_git_commits = """
-        CREATE TABLE GIT_COMMITS(project_name, commit_hash, commit_message, 
-            author, author_date, author_timezone, committer, committer_date, 
-            committer_timezone, in_main_branch, merge, parents);
+    for create_table in table_definitions.values():
+        conn.execute(create_table)
+
+    create_indexes(conn)
+    conn.execute(f'INSERT INTO DATA_VERSION (id, version, data_id) VALUES (0, 0, {NEW_DATA_ID})')
+    conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+    return
+
+
+def create_indexes(conn):
     """
-    create_git_commits_changes = """
-        CREATE TABLE GIT_COMMITS_CHANGES(project_name, commit_hash, old_path, 
-            new_path, change_type, diff, lines_added, lines_removed, n_loc, 
-            complexity, token_count, methods);
+    Creates every secondary index. Existing indexes are left alone
+    :param conn: the connection to the database
     """
+    for create_index in index_definitions:
+        conn.execute(create_index)
 
-    # create_jira_issues = """
-    #     CREATE TABLE JIRA_ISSUES (project_name, "key", creation_date,
-    #         resolution_date, update_date, due_date, resolution, type, priority,
-    #         fix_versions, versions, time_spent DECIMAL, aggregated_time_spent,
-    #         time_estimate, time_original_estimate, aggregate_time_estimate,
-    #         progress_percent, component_name, component_description, description,
-    #         summary, watch_count, votes, labels, creator_name, creator_active,
-    #         assignee, reporter);
-    # """
 
-    create_jira_issues = """
-        CREATE TABLE JIRA_ISSUES (project_name, key, creation_date, resolution_date, update_date, due_date, resolution, 
-            type, priority, fix_versions, versions, time_spent DECIMAL, aggregated_time_spent, time_estimate, 
-            aggregated_time_estimate, progress_percent, description, summary, watch_count, votes, creator_name, 
-            assignee, reporter);
+def restore_indexes(conn, skip_tables=()):
     """
-
-    create_git_commit_release = """
-        CREATE TABLE GIT_COMMIT_RELEASE (project_name, commit_hash, date, version);
+    Creates the secondary indexes missing from the database, i.e, those a bulk LOAD dropped (see
+    db_connection.drop_table_indexes) before it was interrupted. Databases older than schema version 1 and tables the
+    database does not have are left alone
+    :param conn: the connection to the database
+    :param skip_tables: tables whose indexes are not created
     """
+    if conn.execute('PRAGMA user_version').fetchone()[0] < 1:
+        return
 
-    create_git_commit_jira = """
-        CREATE TABLE GIT_COMMIT_JIRA (key, commit_hash);
-    """
+    _create_indexes_on(conn, set(tables_in_sqlite_db(conn)) - set(skip_tables))
 
-    create_project_versions = """
-        CREATE TABLE PROJECT_VERSIONS (project_name, version, commit_hash, author_date, previous_version)
-    """
 
-    create_designite_smells = """
-        CREATE TABLE DESIGNITE_SMELLS (project_name, version, package, smell, cause)    
+def _create_indexes_on(conn, table_names):
     """
-
-    create_static_metrics = """
-        CREATE TABLE STATIC_METRICS (project_name, package, version, pkg_files NUMERIC, pkg_loc NUMERIC, 
-            pkg_tokens NUMERIC, pkg_cc NUMERIC, pkg_average_loc NUMERIC, pkg_average_cc NUMERIC, 
-            pkg_average_tokens NUMERIC)
+    Creates the secondary indexes of the given tables. Existing indexes are left alone
     """
-
-    # create_designite_smells_wide = """
-    #     CREATE TABLE DESIGNITE_SMELLS_WIDE (project_name, version, package, smell, cause);
-    # """
-
-    # create_ref_pivoted = """
-    #     CREATE TABLE REFACTORING_MINER_WIDE ("project_name", "commit_hash", "refactoring_path", "release",
-    #         "package", "add_attribute_annotation", "add_attribute_modifier", "add_class_annotation",
-    #         "add_method_annotation", "add_method_modifier", "add_parameter", "add_parameter_annotation",
-    #         "add_parameter_modifier", "add_thrown_exception_type", "add_variable_annotation", "add_variable_modifier",
-    #         "change_attribute_access_modifier", "change_attribute_type", "change_method_access_modifier",
-    #         "change_package", "change_parameter_type", "change_return_type", "change_thrown_exception_type",
-    #         "change_variable_type", "encapsulate_attribute", "extract_and_move_method", "extract_attribute",
-    #         "extract_class", "extract_interface", "extract_method", "extract_subclass", "extract_superclass",
-    #         "extract_variable", "inline_method", "inline_variable", "merge_attribute", "merge_parameter",
-    #         "merge_variable", "modify_attribute_annotation", "modify_class_annotation", "modify_method_annotation",
-    #         "modify_parameter_annotation", "modify_variable_annotation", "move_and_inline_method",
-    #         "move_and_rename_attribute", "move_and_rename_class", "move_and_rename_method", "move_attribute",
-    #         "move_class", "move_method", "move_source_folder", "parameterize_attribute", "parameterize_variable",
-    #         "pull_up_attribute", "pull_up_method", "push_down_attribute", "push_down_method",
-    #         "remove_attribute_annotation", "remove_attribute_modifier", "remove_class_annotation",
-    #         "remove_method_annotation", "remove_method_modifier", "remove_parameter", "remove_parameter_annotation",
-    #         "remove_parameter_modifier", "remove_thrown_exception_type", "remove_variable_annotation",
-    #         "remove_variable_modifier", "rename_attribute", "rename_class", "rename_method", "rename_parameter",
-    #         "rename_variable", "reorder_parameter", "replace_attribute", "replace_attribute_with_variable",
-    #         "replace_variable_with_attribute", "split_attribute", "split_parameter", "split_variable");
-    # """
-
-    conn.execute(create_projects)
-    conn.execute(create_ref_miner)
-    conn.execute(create_git_commits)
-    conn.execute(create_git_commits_changes)
-    conn.execute(create_jira_issues)
-    conn.execute(create_git_commit_release)
-    conn.execute(create_git_commit_jira)
-    conn.execute(create_designite_smells)
-    conn.execute(create_static_metrics)
-    conn.execute(create_project_versions)
-    # conn.execute(create_ref_pivoted)
-    return
+    for create_index in index_definitions:
+        if create_index.split(' ON ')[1].split(' ')[0] in table_names:
+            conn.execute(create_index)
 
 
 def tables_in_sqlite_db(conn):
@@ -128,6 +187,138 @@ def tables_in_sqlite_db(conn):
     cursor.close()
     return tables
 
+
+def table_columns(conn, table_name):
+    """
+    :param conn: the connection to the database
+    :param table_name: the table to inspect
+    :return: List of the table's column names
+    :rtype: list
+    """
+    return [column_info[1] for column_info in conn.execute(f'PRAGMA table_info({table_name})').fetchall()]
+
+
+def _migrate_to_v1(conn):
+    """
+    Rebuilds every untyped table with the typed, keyed schema and adds the indexes. Renamed columns are copied under
+    their new name (v1_renamed_columns). Other columns that are no longer part of the schema are kept, untyped, after
+    the schema's columns if they hold any data, and dropped if they are empty. Rows that repeat a primary key are
+    dropped, keeping the first one. Only the tables of version 1 are built; those added later are left to their own
+    migration steps.
+
+    Values keep their storage class when copied, except where the typed column converts them: i.e, integer versions
+    (interval_versions) become TEXT, as LOAD stores them, so query results read them as strings from then on
+    """
+    existing_tables = tables_in_sqlite_db(conn)
+
+    for table_name in v1_tables:
+        create_table = table_definitions[table_name]
+        if table_name not in existing_tables:
+            conn.execute(create_table)
+            continue
+
+        legacy_table_name = f'{table_name}_LEGACY'
+        conn.execute(f'ALTER TABLE {table_name} RENAME TO {legacy_table_name}')
+        conn.execute(create_table)
+
+        legacy_columns = table_columns(conn, legacy_table_name)
+        schema_columns = table_columns(conn, table_name)
+        renamed_columns = {
+            legacy_column: column for legacy_column, column in v1_renamed_columns.get(table_name, {}).items()
+            if legacy_column in legacy_columns and column not in legacy_columns
+        }
+
+        # (legacy column, schema column) pairs
+        copied_columns = []
+        for legacy_column in legacy_columns:
+            column = renamed_columns.get(legacy_column, legacy_column)
+            if column in schema_columns:
+                copied_columns.append((legacy_column, column))
+            elif conn.execute(f'SELECT 1 FROM {legacy_table_name} WHERE "{legacy_column}" IS NOT NULL '
+                              f'AND "{legacy_column}" != \'\' LIMIT 1').fetchone() is not None:
+                print(f'{table_name}: keeping column {legacy_column}, which is not in the schema but holds data')
+                conn.execute(f'ALTER TABLE {table_name} ADD COLUMN "{legacy_column}"')
+                copied_columns.append((legacy_column, legacy_column))
+            else:
+                print(f'{table_name}: dropping empty column {legacy_column}, which is not in the schema')
+
+        legacy_column_list = ', '.join(f'"{legacy_column}"' for legacy_column, _ in copied_columns)
+        column_list = ', '.join(f'"{column}"' for _, column in copied_columns)
+        conn.execute(f'INSERT OR IGNORE INTO {table_name} ({column_list}) '
+                     f'SELECT {legacy_column_list} FROM {legacy_table_name}')
+        conn.execute(f'DROP TABLE {legacy_table_name}')
+
+    _create_indexes_on(conn, v1_tables)
+
+
+def _migrate_to_v2(conn):
+    """
+    Adds the DATA_VERSION table, starting at version 0
+    """
+    conn.execute('CREATE TABLE IF NOT EXISTS DATA_VERSION (id INTEGER PRIMARY KEY CHECK (id = 0), '
+                 'version INTEGER NOT NULL)')
+    conn.execute('INSERT OR IGNORE INTO DATA_VERSION (id, version) VALUES (0, 0)')
+
+
+def _migrate_to_v3(conn):
+    """
+    Adds the rollup tables (database.rollups) and builds them from the rows already loaded
+    """
+    existing_tables = tables_in_sqlite_db(conn)
+    for table_name, (source_table, _) in rollup_definitions.items():
+        if table_name not in existing_tables:
+            conn.execute(table_definitions[table_name])
+    create_indexes(conn)
+
+    for source_table in sorted({source_table for source_table, _ in rollup_definitions.values()}):
+        print(f'Building the rollups of {source_table}...')
+        refresh_rollups(conn, source_table)
+
+
+def _migrate_to_v4(conn):
+    """
+    Adds a random data_id to DATA_VERSION, so that query results cached for another database are not reused
+    """
+    if 'data_id' not in table_columns(conn, 'DATA_VERSION'):
+        conn.execute('ALTER TABLE DATA_VERSION ADD COLUMN data_id TEXT')
+    conn.execute(f'UPDATE DATA_VERSION SET data_id = {NEW_DATA_ID}')
+
+
+# Schema version -> function that upgrades a database from the previous version
+migrations = {
+    1: _migrate_to_v1,
+    2: _migrate_to_v2,
+    3: _migrate_to_v3,
+    4: _migrate_to_v4,
+}
+
+
+def migrate_atdd(db_path=DB_ABSPATH):
+    """
+    Upgrades an existing database to SCHEMA_VERSION, one version at a time. Each upgrade runs in its own transaction
+    """
+    if not os.path.isfile(db_path):
+        print('Database filename "' + db_path + '" does not exist! Please run create_db.')
+        quit()
+
+    conn = sqlite3.connect(db_path)
+    conn.isolation_level = None  # Transactions are managed explicitly below
+    try:
+        current_version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for version in range(current_version + 1, SCHEMA_VERSION + 1):
+            print(f'Migrating schema to version {version}...')
+            conn.execute('BEGIN')
+            migrations[version](conn)
+            conn.execute(f'PRAGMA user_version = {version}')
+            conn.execute('COMMIT')
+
+        conn.execute('VACUUM')
+    finally:
+        conn.close()
+
+    print('Done!')
+
+
 def create_atdd():
     if not os.path.isfile(DB_ABSPATH):
         with sqlite3.connect(DB_ABSPATH) as conn:
@@ -141,5 +332,60 @@ def create_atdd():
 
     print('Done!')
 
+
+def check_migration():
+    """
+    Migrates a scratch database of schema version 0 (untyped, unindexed tables, some rows repeating a primary key, a
+    renamed column, and columns no longer in the schema) and asserts that it ends up with the tables, columns and
+    indexes of a newly created database, and with its data
+    """
+    import tempfile
+
+    def schema(conn):
+        return {
+            table_name: table_columns(conn, table_name) for table_name in tables_in_sqlite_db(conn)
+        }, sorted(row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'"))
+
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        with closing(sqlite3.connect(':memory:')) as conn:
+            create_tables(conn)
+            expected_schema = schema(conn)
+
+        legacy_db = os.path.join(scratch_dir, 'legacy.db')
+        with closing(sqlite3.connect(legacy_db)) as conn:
+            for table_name in v1_tables:
+                legacy_columns = [
+                    {column: legacy_column for legacy_column, column in v1_renamed_columns.get(table_name, {}).items()}
+                    .get(column, column) for column in expected_schema[0][table_name]
+                ]
+                if table_name == 'JIRA_ISSUES':
+                    legacy_columns = legacy_columns + ['labels', 'creator_active']
+                conn.execute(f'CREATE TABLE {table_name} ({", ".join(legacy_columns)})')
+            conn.executemany('INSERT INTO GIT_COMMITS (project_name, commit_hash) VALUES (?, ?)',
+                             [('stub', 'a'), ('stub', 'b'), ('stub', 'a')])
+            conn.execute("INSERT INTO PROJECTS VALUES ('stub', 'git_link', 'jira_link')")
+            conn.execute("INSERT INTO JIRA_ISSUES (key, aggregate_time_estimate, labels, creator_active) "
+                         "VALUES ('STUB-1', 60, '[''label'']', '')")
+            conn.commit()
+
+        migrate_atdd(legacy_db)
+
+        with closing(sqlite3.connect(legacy_db)) as conn:
+            assert conn.execute('PRAGMA user_version').fetchone()[0] == SCHEMA_VERSION, 'schema version not stamped'
+            # Columns with data are kept after the schema's, empty ones are dropped
+            expected_schema[0]['JIRA_ISSUES'].append('labels')
+            assert schema(conn) == expected_schema, 'migrated schema differs from a new database'
+            assert conn.execute('SELECT aggregated_time_estimate, labels FROM JIRA_ISSUES').fetchall() == \
+                [(60, "['label']")], 'renamed or kept column lost its data'
+            assert conn.execute('SELECT COUNT(*) FROM GIT_COMMITS').fetchone()[0] == 2, 'repeated key not dropped'
+            assert conn.execute('SELECT * FROM PROJECTS').fetchall() == [('stub', 'git_link', 'jira_link')]
+            assert conn.execute('SELECT data_id FROM DATA_VERSION').fetchone()[0] is not None, 'no data_id'
+
+    print('Migration check passed')
+
+
 if __name__ == '__main__':
-    create_atdd()
+    if len(sys.argv) > 1 and sys.argv[1] == 'check_migration':
+        check_migration()
+    else:
+        create_atdd()
@@ -7,7 +7,9 @@ import os
 import re
 import sqlite3
 import warnings
+from functools import lru_cache
 
+from utils.config_interface import get_processing_option
 from utils.top_level_paths import database_directory
 
 DB_ABSPATH = os.path.join(database_directory, 'augmented_tdd.db')
@@ -15,13 +17,35 @@ TEST_DB_ABSPATH = os.path.join(database_directory, 'mock_tdd.db')
 
 test_warning_debounce = False
 
+# Used while loading whole backups into the database. Writes are not synced to disk until SQLite checkpoints the
+# write-ahead log, which is safe to lose on a crash because the backups can simply be LOADed again. The page cache
+# holds up to bulk_load_cache_mb (configs/database_processing.yaml) megabytes, BULK_LOAD_CACHE_MB if not set. Sorts
+# (index rebuilds, rollups) size their memory by the cache too, and spill the rest to temporary files on disk, so a
+# LOAD's memory is bounded by about BULK_LOAD_MEMORY_FACTOR times the cache, whatever the backup's size
+BULK_LOAD_CACHE_MB = 256
+BULK_LOAD_MEMORY_FACTOR = 3
+BULK_LOAD_PRAGMAS = [
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = OFF',
+    'PRAGMA cache_size = -{cache_size_kb}',
+]
+
+# Journal mode of the database outside of bulk loads. WAL is stored in the database file, so it is switched back once a
+# bulk load is done
+DEFAULT_JOURNAL_MODE = 'DELETE'
+
+@lru_cache(maxsize=1024)
+def _compile_regex(expr):
+    return re.compile(expr, re.I)
+
+
 # Regex function for SQLite3 regex queries
 def re_fn(expr, item):
-    reg = re.compile(expr, re.I)
+    reg = _compile_regex(expr)
     return reg.search(item) is not None
 
 
-def get_db_connection(use_regex=False, test_db=False):
+def get_db_connection(use_regex=False, test_db=False, bulk_load=False):
     global test_warning_debounce
 
     if not test_db:
@@ -34,6 +58,104 @@ def get_db_connection(use_regex=False, test_db=False):
 
     if use_regex:
         conn.create_function("REGEXP", 2, re_fn)
+    if bulk_load:
+        cache_size_mb = get_processing_option('bulk_load_cache_mb', BULK_LOAD_CACHE_MB)
+        for pragma in BULK_LOAD_PRAGMAS:
+            conn.execute(pragma.format(cache_size_kb=int(cache_size_mb * 1024)))
     cursor = conn.cursor()
 
     return conn, cursor
+
+
+def end_bulk_load(conn):
+    """
+    Switches a bulk-load connection's database back to DEFAULT_JOURNAL_MODE, which checkpoints the write-ahead log into
+    the database. Committed work only. SQLite cannot leave WAL while another connection has the database open (i.e,
+    a LOAD in another process, or a populator of another table), and reports the database as locked. The database is
+    then left in WAL, which is just as safe to read and write, until a bulk load ends with no other connection open
+    """
+    try:
+        conn.execute(f'PRAGMA journal_mode = {DEFAULT_JOURNAL_MODE}')
+    except sqlite3.OperationalError as e:
+        if 'locked' not in str(e):
+            raise
+        print('Other connections have the database open; leaving it in WAL journal mode')
+
+
+def drop_table_indexes(conn, table_name):
+    """
+    Drops every explicitly created index on a table, so that rows can be inserted without maintaining them
+
+    :param conn: the connection to the database
+    :param table_name: the table whose indexes are dropped
+    :type table_name: str
+    :return: the CREATE INDEX statements of the dropped indexes, to be passed to `create_indexes`
+    :rtype: list
+    """
+    indexes = conn.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+        (table_name,)
+    ).fetchall()
+
+    for index_name, _ in indexes:
+        conn.execute(f'DROP INDEX "{index_name}"')
+
+    return [index_sql for _, index_sql in indexes]
+
+
+def create_indexes(conn, index_statements):
+    """
+    Builds indexes from their CREATE INDEX statements, i.e, the ones returned by `drop_table_indexes`
+    """
+    for index_sql in index_statements:
+        conn.execute(index_sql)
+
+
+# SQL expression drawing a new random DATA_VERSION.data_id
+NEW_DATA_ID = 'lower(hex(randomblob(8)))'
+
+
+def read_data_version(conn):
+    """
+    :param conn: the connection to the database
+    :return: the database's data version, which every LOAD bumps, or None for databases without a DATA_VERSION table
+        (see create_atdd.migrate_atdd)
+    :rtype: int
+    """
+    try:
+        row = conn.execute('SELECT version FROM DATA_VERSION WHERE id = 0').fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return row[0] if row else 0
+
+
+def read_data_stamp(conn):
+    """
+    :param conn: the connection to the database
+    :return: '<data version>_<data id>', which identifies the database's data across databases: a recreated or swapped
+        database file has its own data id even where its version repeats one of another. None for databases without a
+        data id (see create_atdd.migrate_atdd)
+    :rtype: str
+    """
+    try:
+        row = conn.execute('SELECT version, data_id FROM DATA_VERSION WHERE id = 0').fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return f'{row[0]}_{row[1]}' if row and row[1] else None
+
+
+def bump_data_version(conn):
+    """
+    Marks the database's data as changed, invalidating results cached against the previous data version, and draws a
+    new data id, so that copies of one database that are LOADed separately never share a stamp. Committed with the
+    caller's transaction
+    """
+    try:
+        conn.execute(f'INSERT INTO DATA_VERSION (id, version, data_id) VALUES (0, 1, {NEW_DATA_ID}) '
+                     f'ON CONFLICT (id) DO UPDATE SET version = version + 1, data_id = excluded.data_id')
+    except sqlite3.OperationalError:
+        try:
+            conn.execute('INSERT INTO DATA_VERSION (id, version) VALUES (0, 1) '
+                         'ON CONFLICT (id) DO UPDATE SET version = version + 1')
+        except sqlite3.OperationalError:
+            pass
@@ -2,12 +2,39 @@ import csv
 import io
 import os
 import sys
+import time
 from datetime import datetime
+from database.backup_manifest import BackupManifest
 from utils.top_level_paths import database_directory
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 OUTPUT_DIR = os.path.join(database_directory, 'db_loadfiles')
 
+# CSV backups are written through one handle per run, with a userspace buffer of CSV_BUFFER_SIZE bytes. The buffer is
+# also handed to the OS once it is CSV_FLUSH_SECONDS old, and checkpoints sync the file at most every CSV_SYNC_SECONDS.
+# Rows handed to the OS after the last sync may survive a crash; see DbBackup.truncate
+CSV_BUFFER_SIZE = 1024 * 1024
+CSV_FLUSH_SECONDS = 5
+CSV_SYNC_SECONDS = 60
+
+# Parquet backups are written in row groups of at most PARQUET_ROW_GROUP_SIZE records and about PARQUET_ROW_GROUP_BYTES
+# of values, compressed with PARQUET_COMPRESSION, and read back one row group at a time. The byte bound keeps memory
+# flat for tables with large values (i.e, the diffs of GIT_COMMIT_CHANGES)
+PARQUET_ROW_GROUP_SIZE = 50000
+PARQUET_ROW_GROUP_BYTES = 32 * 1024 * 1024
+PARQUET_COMPRESSION = 'zstd'
+# Suffix of a parquet backup that is still being written
+PARTIAL_FILE_SUFFIX = '.partial'
+
+# Type names usable in a populator's backup_schema
+parquet_types = {
+    'string': pa.string(),
+    'int64': pa.int64(),
+    'float64': pa.float64(),
+}
+
 FILE_TIME_FORMAT = '%Y-%m-%d_%H-%M-%S'
 FILE_TIME_LENGTH = len(datetime.min.strftime(FILE_TIME_FORMAT))
 
@@ -26,54 +53,102 @@ while True:
 
 
 def cleanup_all_save_files():
+    """
+    Deletes unfinished parquet backups, then every backup but the most recent of each project's table
+    """
     for this_file in os.listdir(OUTPUT_DIR):
-        this_file_path = os.path.join(OUTPUT_DIR, this_file)
+        if this_file.endswith(PARTIAL_FILE_SUFFIX):
+            print('Deleting unfinished file ' + this_file)
+            os.remove(os.path.join(OUTPUT_DIR, this_file))
 
-        this_file_wo_ext = os.path.splitext(this_file)[0]
-        this_file_prefix = this_file_wo_ext[:-FILE_TIME_LENGTH]
-        file_to_keep = get_most_recent_file_with_prefix(this_file_prefix)
-        if os.path.samefile(this_file_path, file_to_keep):
-            print('Keeping file ' + this_file)
-        else:
-            print('Deleting file ' + this_file)
-            os.remove(this_file_path)
+    BackupManifest(OUTPUT_DIR).cleanup()
 
 
 def get_most_recent_file_with_prefix(file_prefix):
-    # Get existing backup file
-    most_recent_file = {
-        'file_path': None,
-        'file_datetime': datetime.min
-    }
+    """
+    :param file_prefix: <project>_<TABLE>_
+    :type file_prefix: str
+    :return: absolute path of the most recent backup with the prefix, looked up in the backup manifest
+    :rtype: str
+    """
+    return BackupManifest(OUTPUT_DIR).latest(file_prefix)
 
-    # Loop to find most recent file belonging to project and table type
-    for this_file in os.listdir(OUTPUT_DIR):
-        file_path = os.path.join(OUTPUT_DIR, this_file)
 
-        if this_file.startswith(file_prefix):
-            this_file_wo_ext = os.path.splitext(this_file)[0]
-            file_timestamp = this_file_wo_ext[len(file_prefix):]
-            this_file_date = datetime.strptime(file_timestamp, FILE_TIME_FORMAT)
+def _record_bytes(record):
+    """
+    :return: a cheap estimate of a record's size in a row group: the length of its strings, and 8 bytes per other value
+    :rtype: int
+    """
+    return sum(len(value) if isinstance(value, str) else 8 for value in record)
 
-            if this_file_date > most_recent_file['file_datetime']:
-                most_recent_file = {
-                    'file_path': file_path,
-                    'file_datetime': this_file_date
-                }
 
-    if most_recent_file['file_path']:
-        return os.path.abspath(most_recent_file['file_path'])
+def _to_backup_value(value, type_name):
+    """
+    Converts a record's value for a typed backup column. String columns hold exactly what the csv module would have
+    written (None as '', other values through str), so both formats load the same database contents
+    """
+    if type_name == 'string':
+        return '' if value is None else str(value)
+    if value is None or value == '':
+        return None
+    return int(value) if type_name == 'int64' else float(value)
 
 
 class DbBackup:
-    def __init__(self, project_id, file_identifier, file_ext, mode='r'):
+    """
+    A dated backup file of one project's table. Records are saved and read with `save_records` and `iter_records`,
+    in the format given by the file extension:
+        csv: every value as text, appended in place through a buffered handle that `checkpoint` syncs to disk
+        parquet: typed columns (see schema), compressed in row groups. Saves are written to a partial file that
+            becomes the backup on `close`. A parquet file cannot be appended to in place, nor read before it is
+            closed, so parquet backups are always written whole (mode 'w'), never continued (mode 'a')
+
+    Files are held open between saves; use as a context manager, or call `close`
+
+    :param schema: (column name, type name from parquet_types) of each record field; required for parquet
+    :type schema: list
+    """
+
+    def __init__(self, project_id, file_identifier, file_ext, mode='r', schema=None):
+        if mode == 'a' and file_ext == 'parquet':
+            raise ValueError('parquet backups cannot be appended to; write a new backup instead')
+
         self.file_prefix = f'{project_id}_{file_identifier}_'
         self.file_ext = file_ext
+        self.mode = mode
+        self.schema = schema
+        self.manifest = BackupManifest(OUTPUT_DIR)
+
+        self._csv_file = None
+        self._csv_writer = None
+        self._last_csv_flush = 0
+        self._last_csv_sync = 0
+
+        self._parquet_writer = None
+        self._parquet_records = []
+        self._parquet_records_bytes = 0
 
         if mode == 'r':
             self.backup_file = get_most_recent_file_with_prefix(self.file_prefix)
         elif mode == 'w':
             self.backup_file = self.create_new_backup_file()
+        elif mode == 'a':
+            # Continue the most recent backup, if there is one in this format
+            self.backup_file = get_most_recent_file_with_prefix(self.file_prefix)
+            if self.backup_file is None or not self.backup_file.endswith(f'.{self.file_ext}'):
+                self.backup_file = self.create_new_backup_file()
+
+        # Rows in the backup once it is closed; unknown when appending to a backup whose rows were never counted
+        self.n_rows = 0
+        self.rows_saved = 0
+        self.size_at_open = os.path.getsize(self.backup_file) if self.backup_file and os.path.exists(self.backup_file) \
+            else 0
+        if mode == 'a' and os.path.exists(self.backup_file):
+            backup_entry = self.manifest.entry(self.backup_file)
+            self.n_rows = backup_entry['n_rows'] if backup_entry else None
+
+        # Size of a csv backup when it was last synced to disk, i.e, the size a watermark saved now describes
+        self.synced_size = self.size_at_open if file_ext == 'csv' else None
 
     def create_new_backup_file(self):
         # Create a new file to append into
@@ -85,23 +160,209 @@ class DbBackup:
         return os.path.exists(self.backup_file)
 
     def save_record_to_csv(self, record):
-        with io.open(self.backup_file, 'a', newline='', encoding='utf-8') as file:
-            writer = csv.writer(file, delimiter=',')
-            writer.writerow(record)
+        self.save_records_to_csv([record])
 
     def save_records_to_csv(self, records):
+        """
+        Appends records through the backup's open handle, opening it on the first save. Records reach the OS once
+        the buffer fills or is CSV_FLUSH_SECONDS old, and the disk at the next due `checkpoint`
+        """
+        if self._csv_file is None:
+            self._csv_file = io.open(self.backup_file, 'a', newline='', encoding='utf-8', buffering=CSV_BUFFER_SIZE)
+            self._csv_writer = csv.writer(self._csv_file, delimiter=',')
+            self._last_csv_flush = time.monotonic()
+            self._last_csv_sync = time.monotonic()
+            # Registered as unfinished, so the backup is found even if the run never closes it
+            self.manifest.register(self.backup_file, checksum=False)
+
+        records = list(records)
+        self._csv_writer.writerows(records)
+        self._count_rows(len(records))
+
+        if time.monotonic() - self._last_csv_flush >= CSV_FLUSH_SECONDS:
+            self._flush_csv()
+
+    def _flush_csv(self):
+        if self._csv_file is not None:
+            self._csv_file.flush()
+            self._last_csv_flush = time.monotonic()
+
+    def _sync_csv(self):
+        if self._csv_file is not None:
+            self._flush_csv()
+            os.fsync(self._csv_file.fileno())
+            self._last_csv_sync = time.monotonic()
+            self.synced_size = os.fstat(self._csv_file.fileno()).st_size
+
+    def truncate(self, size):
+        """
+        Cuts a csv backup being appended to back to size bytes, the synced size its watermark recorded. Rows that
+        reached the file after that sync, but before a crash, are dropped, as the resumed run saves them again
+
+        :param size: the backup's size when its watermark was saved, or None if the watermark did not record one
+        :type size: int
+        """
+        if size is None or self.file_ext != 'csv' or self._csv_file is not None or not os.path.exists(self.backup_file):
+            return
+
+        if os.path.getsize(self.backup_file) > size:
+            print(f'Dropping rows saved to {os.path.basename(self.backup_file)} after its last watermark')
+            with open(self.backup_file, 'r+b') as file:
+                file.truncate(size)
+            self.n_rows = None
+
+        self.size_at_open = os.path.getsize(self.backup_file)
+        self.synced_size = self.size_at_open
+
+    @property
+    def bytes_written(self):
+        """
+        :return: how much the backup file grew since it was opened. Buffered and unfinished parquet saves only count
+            once they are on disk
+        :rtype: int
+        """
+        if self.backup_file is None or not os.path.exists(self.backup_file):
+            return 0
+        return os.path.getsize(self.backup_file) - self.size_at_open
 
-        with io.open(self.backup_file, 'a', newline='', encoding='utf-8') as file:
-            for record in records:
-                writer = csv.writer(file, delimiter=',')
-                writer.writerow(record)
+    def _count_rows(self, n_records):
+        self.rows_saved = self.rows_saved + n_records
+        if self.n_rows is not None:
+            self.n_rows = self.n_rows + n_records
+
+    def checkpoint(self):
+        """
+        Called where progress is recorded. Syncs a csv backup to disk if its last sync is CSV_SYNC_SECONDS old. A
+        parquet backup is only on disk once closed
+
+        :return: whether every record saved so far is on disk, so progress covering them can be recorded
+        :rtype: bool
+        """
+        if self.file_ext == 'parquet':
+            return False
+
+        if time.monotonic() - self._last_csv_sync >= CSV_SYNC_SECONDS:
+            self._sync_csv()
+            return True
+        return self._csv_file is None
+
+    def save_records(self, records):
+        if self.file_ext == 'parquet':
+            self.save_records_to_parquet(records)
+        else:
+            self.save_records_to_csv(records)
+
+    def iter_records(self):
+        """
+        Lazily yields the backup's rows, one list per row. The format is taken from the backup file's extension, so a
+        backup stays readable after its populator switches format
+        """
+        if self.backup_file.endswith('.parquet'):
+            return self.iter_parquet_data()
+        return self.iter_csv_data()
+
+    def close(self):
+        """
+        Finishes the backup, syncing it to disk, and records it in the backup manifest. A parquet backup is only
+        complete, and only replaces the previous file, once closed
+        """
+        if self._csv_file is not None:
+            self._sync_csv()
+            self._csv_file.close()
+            self._csv_file = None
+            self._csv_writer = None
+
+        if self.file_ext == 'parquet' and self.mode != 'r':
+            if self._parquet_writer is None:
+                self._open_parquet_writer()
+
+            self._write_parquet_row_group()
+            self._parquet_writer.close()
+            self._parquet_writer = None
+            os.replace(self._partial_parquet_file, self.backup_file)
+
+        if self.mode != 'r' and os.path.exists(self.backup_file):
+            # Files written by external tools (i.e, RefactoringMiner json) have no known row count
+            n_rows = self.n_rows if self.file_ext in ('csv', 'parquet') else None
+            self.manifest.register(self.backup_file, n_rows=n_rows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def _partial_parquet_file(self):
+        return self.backup_file + PARTIAL_FILE_SUFFIX
+
+    def _arrow_schema(self):
+        return pa.schema([(column_name, parquet_types[type_name]) for column_name, type_name in self.schema])
+
+    def _open_parquet_writer(self):
+        self._parquet_writer = pq.ParquetWriter(
+            self._partial_parquet_file, self._arrow_schema(), compression=PARQUET_COMPRESSION
+        )
+
+    def save_records_to_parquet(self, records):
+        """
+        Buffers records, writing a row group once PARQUET_ROW_GROUP_SIZE records or PARQUET_ROW_GROUP_BYTES are buffered
+        """
+        if self._parquet_writer is None:
+            self._open_parquet_writer()
+
+        n_records = 0
+        for record in records:
+            self._parquet_records.append(record)
+            self._parquet_records_bytes = self._parquet_records_bytes + _record_bytes(record)
+            n_records = n_records + 1
+
+            if len(self._parquet_records) >= PARQUET_ROW_GROUP_SIZE or \
+                    self._parquet_records_bytes >= PARQUET_ROW_GROUP_BYTES:
+                self._write_parquet_row_group()
+        self._count_rows(n_records)
+
+    def _write_parquet_row_group(self):
+        records = self._parquet_records
+        self._parquet_records = []
+        self._parquet_records_bytes = 0
+        if len(records) <= 0:
+            return
+
+        columns = zip(*records)
+        arrays = [
+            pa.array([_to_backup_value(value, type_name) for value in column], type=parquet_types[type_name])
+            for column, (_, type_name) in zip(columns, self.schema)
+        ]
+        self._parquet_writer.write_table(pa.Table.from_arrays(arrays, schema=self._arrow_schema()))
+
+    def iter_parquet_data(self):
+        """
+        Lazily yields the backup's rows, one list per row, reading one row group at a time. Row groups are bounded in
+        records and in bytes when written, so memory use does not grow with the backup or with its values' size
+        """
+        parquet_file = pq.ParquetFile(self.backup_file)
+        for i in range(parquet_file.num_row_groups):
+            row_group = parquet_file.read_row_group(i)
+            columns = [column.to_pylist() for column in row_group.columns]
+            del row_group
+            for row in zip(*columns):
+                yield list(row)
 
     def read_csv_data(self):
+        return list(self.iter_csv_data())
+
+    def iter_csv_data(self):
+        """
+        Lazily yields the backup's rows, one list per row, so that a backup never has to fit in memory.
+        NUL characters are stripped, as the csv module cannot read them
+        """
+        self._flush_csv()
         with io.open(self.backup_file, 'r', encoding='utf-8') as file:
             csv_reader = csv.reader((line.replace('\0', '') for line in file), delimiter=',')
 
-            csv_data = [[col for col in row] for row in csv_reader]
-        return csv_data
+            for row in csv_reader:
+                yield row
 
 
 if __name__ == '__main__':
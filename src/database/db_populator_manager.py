@@ -13,10 +13,16 @@ from .db_populators.projects import ProjectInfoPopulator
 from .db_populators.refactoring_miner import RefMinerPopulator
 from .db_populators.static_metrics import StaticMetricsPopulator
 
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
 import pandas as pd
+from database.commit_stream import CommitStream
 from database.db_action import DbAction
 from database.repo_version_walker import RepoVersionWalker
+from utils.config_interface import get_processing_option
+from utils import run_metrics
 from utils.project import Project
+from utils.resource_limits import current_resource_semaphores, init_resource_limits
 
 pd.options.display.max_colwidth = 300
 # Each populator can save or loads a table's worth of project-specific information
@@ -34,16 +40,109 @@ table_populators = {
 }
 
 
+def generate_groups(targeted_tables):
+    """
+    Groups the tables that are GENERATEd together: commit-stream tables share one history walk, and per-version
+    tables one version walk. Every other table is GENERATEd on its own
+
+    :return: lists of table names, in targeted_tables order
+    :rtype: list
+    """
+    groups = {}
+    for table_name in targeted_tables:
+        populator_class = table_populators[table_name]
+        if hasattr(populator_class, 'commit_stream_subscriber'):
+            group_key = 'commit_stream'
+        elif hasattr(populator_class, 'per_version_saving'):
+            group_key = 'per_version'
+        else:
+            group_key = table_name
+        groups.setdefault(group_key, []).append(table_name)
+
+    return list(groups.values())
+
+
+def table_dag(targeted_tables):
+    """
+    Builds the graph of work needed to GENERATE and LOAD the targeted tables. A node is (action, table names): one
+    GENERATE node per group of `generate_groups`, and one LOAD node per table. Each table is LOADed after it is
+    GENERATEd, and GENERATEd after the targeted tables it depends on (Populator.depends_on) are LOADed. Dependencies
+    that are not targeted are assumed to be in the database already.
+
+    The per-version tables are GENERATEd after every other table, as their version walk checks old versions out in the
+    project's repository, which the other tables read
+
+    :return: node -> set of the nodes that must finish first
+    :rtype: dict
+    """
+    generate_nodes = {}
+    for group in generate_groups(targeted_tables):
+        for table_name in group:
+            generate_nodes[table_name] = (DbAction.GENERATE, tuple(group))
+
+    dag = {}
+    for table_name in targeted_tables:
+        load_node = (DbAction.LOAD, (table_name,))
+        dag[load_node] = {generate_nodes[table_name]}
+
+        generate_node = generate_nodes[table_name]
+        dag.setdefault(generate_node, set())
+        for dependency in table_populators[table_name].depends_on:
+            if dependency in generate_node[1]:
+                raise ValueError(f'{table_name} depends on {dependency}, which is GENERATEd in the same pass')
+            if dependency in targeted_tables:
+                dag[generate_node].add((DbAction.LOAD, (dependency,)))
+
+    for generate_node in set(generate_nodes.values()):
+        if hasattr(table_populators[generate_node[1][0]], 'per_version_saving'):
+            dag[generate_node].update(node for node in set(generate_nodes.values()) if node != generate_node)
+
+    return dag
+
+
+def topological_order(dag):
+    """
+    :return: the nodes of a dag, each after all of its prerequisites, otherwise in insertion order
+    :rtype: list
+    """
+    ordered_nodes = []
+    done = set()
+    pending = dict(dag)
+    while len(pending) > 0:
+        ready_nodes = [node for node, prerequisites in pending.items() if prerequisites <= done]
+        if len(ready_nodes) == 0:
+            raise ValueError(f'Table dependencies form a cycle: {list(pending)}')
+
+        for node in ready_nodes:
+            del pending[node]
+            done.add(node)
+            ordered_nodes.append(node)
+
+    return ordered_nodes
+
+
+def _run_node(incremental, project, node):
+    """
+    Runs one node of `table_dag`. Module level, so that worker processes can run it
+    """
+    action, table_names = node
+    PopulatorManager(incremental=incremental).execute(project, list(table_names), DbAction(action))
+    return node
+
+
 class PopulatorManager:
     """
     Does the heavy lifting in populating the database
     """
 
-    def __init__(self):
+    def __init__(self, incremental=False):
         """
         Does the heavy lifting in populating the database
+
+        :param incremental: whether GENERATE resumes from each populator's watermark and appends to its latest backup
+        :type incremental: bool
         """
-        pass
+        self.incremental = incremental
 
     def execute(self, project, targeted_tables, db_action):
         """
@@ -55,27 +154,209 @@ class PopulatorManager:
         :param db_action: whether the data will be saved or loaded
         :type db_action: DbAction
         """
-        requested_populators = []
+        requested_populator_classes = []
         requested_versioned_populators = []
+        requested_commit_populators = []
+
+        def build_populator(populator_class):
+            return populator_class(project, db_action, incremental=self.incremental, bulk_load=db_action.is_load())
 
         for table_name in targeted_tables:
             populator_class = table_populators.get(table_name)
-            populator = populator_class(project, db_action)
 
-            if hasattr(populator, 'per_version_saving') and db_action.is_generate():
-                requested_versioned_populators.append(populator)
+            if hasattr(populator_class, 'per_version_saving') and db_action.is_generate():
+                requested_versioned_populators.append(build_populator(populator_class))
+            elif hasattr(populator_class, 'commit_stream_subscriber') and db_action.is_generate():
+                requested_commit_populators.append(build_populator(populator_class))
             else:
-                requested_populators.append(populator)
+                requested_populator_classes.append(populator_class)
 
-        for populator in requested_populators:
+        # Each one is built when it runs, so that its database connection is the only one this process has open. A
+        # bulk LOAD can then switch the database back out of WAL once done (see db_connection.end_bulk_load)
+        for populator_class in requested_populator_classes:
+            populator = build_populator(populator_class)
             print(populator.table_name)
-            populator.execute(db_action)
+            with run_metrics.measure('populator', populator.table_name, project=project.repo_name,
+                                     action=str(db_action)) as metric:
+                populator.execute(db_action)
+                metric.update(populator.run_metrics())
+
+        # Process commit-level populators (Traverse the git history once, shared by all of them)
+        if len(requested_commit_populators) > 0:
+            commit_stream = CommitStream(project.repo_path, project.branch)
+            for populator in requested_commit_populators:
+                print(populator.table_name)
+                commit_stream.subscribe(populator)
+
+            with run_metrics.measure('walk', 'commit_stream', project=project.repo_name,
+                                     tables=[populator.table_name for populator in requested_commit_populators]) \
+                    as metric:
+                metric['commits'] = commit_stream.walk()
+
+                for populator in requested_commit_populators:
+                    populator.finish()
+            self._record_walk_populators(project, requested_commit_populators, 'commit_stream')
 
         # Process versioned populators (Clone repository, )
         if len(requested_versioned_populators) > 0:
-            repo_version_walker = RepoVersionWalker(project)
+            already_analyzed = set.intersection(
+                *[populator.analyzed_versions() for populator in requested_versioned_populators]
+            )
+            walk_mode = get_processing_option('version_walk_mode', 'full')
+            repo_version_walker = RepoVersionWalker(project, omit_versions=already_analyzed, walk_mode=walk_mode)
+            version_workers = get_processing_option('version_workers', 1)
+
+            # A diff walk carries each version's results into the next, so versions are analyzed in order
+            if version_workers > 1 and walk_mode == 'diff':
+                print('version_walk_mode diff analyzes versions sequentially; version_workers is ignored')
+                version_workers = 1
+
+            if version_workers > 1:
+                populator_classes = [type(populator) for populator in requested_versioned_populators]
+                analyzed_versions = [populator.analyzed_versions() for populator in requested_versioned_populators]
+                with run_metrics.measure('walk', 'versions', project=project.repo_name, workers=version_workers,
+                                         tables=[populator.table_name for populator in requested_versioned_populators]):
+                    for version, version_records in repo_version_walker.walk_parallel(populator_classes,
+                                                                                      version_workers,
+                                                                                      analyzed_versions):
+                        print(f'Saving version {version.id}')
+                        for populator, records in zip(requested_versioned_populators, version_records):
+                            # Populators that already saved the version skipped it
+                            if records is not None:
+                                populator.save_version_records(version, records)
+
+                    for populator in requested_versioned_populators:
+                        populator.finish()
+            else:
+                checkout = any(populator.needs_working_tree for populator in requested_versioned_populators)
+                with run_metrics.measure('walk', 'versions', project=project.repo_name, workers=1,
+                                         tables=[populator.table_name for populator in requested_versioned_populators]):
+                    for repo_state in repo_version_walker.walk(checkout=checkout):
+                        for populator in requested_versioned_populators:
+                            print(populator.table_name)
+                            rows_before = populator.run_metrics()['rows']
+                            with run_metrics.measure('version', populator.table_name, project=project.repo_name,
+                                                     version=repo_state.version.id) as metric:
+                                populator.execute(repo_state)
+                                metric['rows'] = populator.run_metrics()['rows'] - rows_before
+
+                    for populator in requested_versioned_populators:
+                        populator.finish()
+            self._record_walk_populators(project, requested_versioned_populators, 'versions')
+
+    @staticmethod
+    def _record_walk_populators(project, populators, walk_name):
+        """
+        Records the rows and bytes of populators that shared a walk. Their time is that of the walk
+        """
+        for populator in populators:
+            run_metrics.record('populator', populator.table_name, project=project.repo_name,
+                               action=str(populator.db_action), walk=walk_name, **populator.run_metrics())
+
+    def build(self, project, targeted_tables):
+        """
+        GENERATEs and LOADs the targeted tables, following `table_dag`. With table_workers above 1, independent
+        GENERATE nodes run concurrently in worker processes, each table is LOADed as soon as its backup is ready, and
+        dependent tables start as soon as their dependencies are LOADed. LOADs run one at a time in this process
+
+        :param project: the project to be saved and loaded
+        :type project: Project
+        :param targeted_tables: What populators to run
+        :type targeted_tables: list
+        """
+        dag = table_dag(targeted_tables)
+        ordered_nodes = topological_order(dag)
+        table_workers = get_processing_option('table_workers', 1)
+
+        if table_workers <= 1:
+            for node in ordered_nodes:
+                _run_node(self.incremental, project, node)
+            return
+
+        pending = dict(dag)
+        done = set()
+        running = {}
+        with ProcessPoolExecutor(max_workers=table_workers, initializer=init_resource_limits,
+                                 initargs=(current_resource_semaphores(),)) as generate_executor, \
+                ThreadPoolExecutor(max_workers=1) as load_executor:
+            while len(pending) > 0 or len(running) > 0:
+                for node in [node for node, prerequisites in pending.items() if prerequisites <= done]:
+                    del pending[node]
+                    executor = load_executor if node[0] == DbAction.LOAD else generate_executor
+                    running[executor.submit(_run_node, self.incremental, project, node)] = node
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    del running[future]
+                    done.add(future.result())
+
+
+def check_multi_table_load():
+    """
+    LOADs two tables of a stub project in one `PopulatorManager.execute`, into a scratch database and backup folder,
+    once alone and once while another connection holds the database open (as a LOAD in another process would), and
+    asserts that both tables are loaded, that a repeated LOAD replaces their rows, and that it leaves other projects'
+    rows alone
+    """
+    import os
+    import sqlite3
+    import tempfile
+    import types
+    from contextlib import closing
+
+    import database.backup_manifest as backup_manifest
+    import database.db_connection as db_connection
+    import database.db_file_backup as db_file_backup
+    from database.create_atdd import create_tables
+
+    project = types.SimpleNamespace(repo_name='stub', repo_path='stub', branch='main', github_link='git_link',
+                                    jira_link='jira_link')
+    default_paths = (db_connection.DB_ABSPATH, db_file_backup.OUTPUT_DIR, backup_manifest.MANIFEST_PATH,
+                     os.environ.get(run_metrics.METRICS_FILE_VARIABLE))
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        db_connection.DB_ABSPATH = os.path.join(scratch_dir, 'scratch.db')
+        db_file_backup.OUTPUT_DIR = os.path.join(scratch_dir, 'db_loadfiles')
+        backup_manifest.MANIFEST_PATH = os.path.join(scratch_dir, 'db_backup_manifest.db')
+        os.environ[run_metrics.METRICS_FILE_VARIABLE] = os.path.join(scratch_dir, 'metrics.jsonl')
+        os.makedirs(db_file_backup.OUTPUT_DIR)
+        try:
+            with closing(sqlite3.connect(db_connection.DB_ABSPATH)) as conn:
+                create_tables(conn)
+                # A link the stub project's backup no longer has, and another project's link
+                conn.executemany('INSERT INTO JIRA_ISSUES (project_name, key) VALUES (?, ?)',
+                                 [('stub', 'STUB-3'), ('other', 'OTHER-1')])
+                conn.executemany('INSERT INTO GIT_COMMIT_JIRA VALUES (?, ?)', [('STUB-3', 'c'), ('OTHER-1', 'd')])
+                conn.commit()
+            with db_file_backup.DbBackup('stub', 'GIT_COMMIT_JIRA', 'csv', mode='w') as backup:
+                backup.save_records([('STUB-1', 'a'), ('STUB-2', 'b')])
+
+            def load(tables):
+                PopulatorManager().execute(project, tables, DbAction(DbAction.LOAD))
+                with closing(sqlite3.connect(db_connection.DB_ABSPATH)) as conn:
+                    return {table_name: conn.execute(f'SELECT COUNT(*) FROM {table_name}').fetchone()[0]
+                            for table_name in ('PROJECTS', 'GIT_COMMIT_JIRA')}
+
+            assert load(['PROJECTS', 'GIT_COMMIT_JIRA']) == {'PROJECTS': 1, 'GIT_COMMIT_JIRA': 3}
+            with closing(sqlite3.connect(db_connection.DB_ABSPATH)) as other_conn:
+                other_conn.execute('PRAGMA journal_mode = WAL')
+                other_conn.execute('SELECT COUNT(*) FROM PROJECTS').fetchone()
+                assert load(['GIT_COMMIT_JIRA', 'PROJECTS']) == {'PROJECTS': 1, 'GIT_COMMIT_JIRA': 3}
+
+            # The database was left in WAL while the other connection was open; the next bulk LOAD switches it back
+            load(['PROJECTS'])
+            with closing(sqlite3.connect(db_connection.DB_ABSPATH)) as conn:
+                journal_mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+                assert journal_mode == db_connection.DEFAULT_JOURNAL_MODE.lower(), f'left in {journal_mode}'
+        finally:
+            db_connection.DB_ABSPATH, db_file_backup.OUTPUT_DIR, backup_manifest.MANIFEST_PATH, metrics_file = \
+                default_paths
+            if metrics_file is None:
+                os.environ.pop(run_metrics.METRICS_FILE_VARIABLE, None)
+            else:
+                os.environ[run_metrics.METRICS_FILE_VARIABLE] = metrics_file
+
+    print('Multi-table LOAD check passed')
+
 
-            for repo_state in repo_version_walker.walk():
-                for populator in requested_versioned_populators:
-                    print(populator.table_name)
-                    populator.execute(repo_state)
+if __name__ == '__main__':
+    check_multi_table_load()
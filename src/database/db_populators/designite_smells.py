@@ -1,13 +1,15 @@
-import csv
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 from database.populator_helpers import PerVersionPopulator
 from database.repo_version_walker import project_processing_path
-from utils import shell_interface
+from utils import config_interface, shell_interface
 
 designite_files_to_save = ['ArchitectureSmells.csv', 'DesignSmells.csv', 'ImplementationSmells.csv']
+designite_ignored_columns = ['Type Name', 'Method Name', 'Project Name']
+smell_columns = ['package', 'smell', 'cause']
 
 """
 This populator stores intermediate data in root/etc/designite_processing
@@ -24,17 +26,18 @@ def join_path(*paths):
 
 
 class DesigniteProcessingEnvironment:
-    def __init__(self, project):
-        self.processing_path = join_path(project_processing_path, f'{project.repo_name}_processing')
-        self.macro_packages_folder = join_path(self.processing_path, 'temp_macro_packages')
+    def __init__(self, repo_state):
+        self.processing_path = join_path(project_processing_path, f'{repo_state.project.repo_name}_processing')
         self.processed_out_folder = join_path(self.processing_path, 'designite_processed_out')
-        self.temp_repo_folder = join_path(self.processing_path, 'temp_repo', project.repo_name)
+        self.temp_repo_folder = join_path(repo_state.repo_path)
+        # Kept beside the checkout so that parallel worktrees never share a macro package folder
+        self.macro_packages_folder = join_path(os.path.dirname(self.temp_repo_folder), 'temp_macro_packages')
 
         self._make_dirs()
 
     def _make_dirs(self):
         if os.path.exists(self.macro_packages_folder):
-            os.system(f'rmdir /S /Q {self.macro_packages_folder}')
+            shutil.rmtree(self.macro_packages_folder, ignore_errors=True)
 
         os.mkdir(self.macro_packages_folder)
 
@@ -42,101 +45,230 @@ class DesigniteProcessingEnvironment:
         version_out_folder = join_path(self.processed_out_folder, repo_state.version.id_os_friendly)
 
         if os.path.exists(version_out_folder):
-            os.system(f'rmdir /S /Q {version_out_folder}')
+            shutil.rmtree(version_out_folder, ignore_errors=True)
         os.makedirs(version_out_folder, exist_ok=True)
 
         return version_out_folder
 
-    def extract_macro_packages(self, macro_package_paths):
+    def stage_macro_packages(self, macro_package_paths, all_macro_package_paths=None):
         """
-        This function copies every package and puts it into a macro_packages_folder.
-        Order matters; we copy deepest paths first, so we maintain more shallow '/java/' directories in the path
+        Stages every macro package in macro_packages_folder, named in order of the returned packages. Files are
+        hard-linked rather than moved, so the checkout is never modified.
+        Macro packages nested in another one are left out of the outer package's staging folder, so that every file
+        is analyzed once, with its innermost macro package
+
+        :param macro_package_paths: the macro packages to stage
+        :param all_macro_package_paths: every macro package of the version, if only some of them are staged
         """
         # Sort packages by depth in the file system
         package_dir_depths = [len(os.path.normpath(package_path).split(os.sep)) for package_path in macro_package_paths]
         _, sorted_macro_packages = zip(*sorted(zip(package_dir_depths, macro_package_paths), reverse=True))
 
-        # Copy paths to macro_packages_folder, name them in-order of packages list
+        all_macro_packages = {
+            os.path.normpath(package_path) for package_path in (all_macro_package_paths or sorted_macro_packages)
+        }
         for i, package_path in enumerate(sorted_macro_packages):
-            shutil.move(package_path, os.path.join(self.macro_packages_folder, str(i)))
+            nested_macro_packages = all_macro_packages - {os.path.normpath(package_path)}
+            link_tree(package_path, os.path.join(self.macro_packages_folder, str(i)), nested_macro_packages)
 
         return sorted_macro_packages
 
 
+def link_tree(source_folder, target_folder, excluded_folders):
+    """
+    Recreates source_folder's directory tree at target_folder, hard-linking every file (copying it where the file
+    system cannot link it). Folders in excluded_folders are skipped along with their contents
+    """
+    for dir_path, dir_names, file_names in os.walk(source_folder):
+        dir_names[:] = [
+            dir_name for dir_name in dir_names
+            if os.path.normpath(os.path.join(dir_path, dir_name)) not in excluded_folders
+        ]
+
+        target_dir_path = os.path.join(target_folder, os.path.relpath(dir_path, source_folder))
+        os.makedirs(target_dir_path, exist_ok=True)
+
+        for file_name in file_names:
+            source_file = os.path.join(dir_path, file_name)
+            target_file = os.path.join(target_dir_path, file_name)
+            try:
+                os.link(source_file, target_file)
+            except OSError:
+                shutil.copy2(source_file, target_file)
+
+
+def innermost_macro_package(path, macro_packages):
+    """
+    :return: the deepest macro package containing path (not counting path itself), or None
+    :rtype: str
+    """
+    containing_macro_packages = [
+        macro_package for macro_package in macro_packages if path.startswith(macro_package) and path != macro_package
+    ]
+    return max(containing_macro_packages, key=len) if len(containing_macro_packages) > 0 else None
+
+
+def changed_macro_packages(repo_state, macro_packages):
+    """
+    Finds the macro packages of a diff-walked version whose Designite results may differ from the previous version's:
+    new macro packages, those containing a changed java file, and those that gained or lost a nested macro package
+
+    :param repo_state: a state yielded by a diff-mode walk
+    :type repo_state: database.repo_version_walker.RepoState
+    :rtype: set
+    """
+    previous_macro_packages = repo_state.previous_state.identify_macro_packages()
+
+    changed = macro_packages - previous_macro_packages
+    for file_path in repo_state.changed_files:
+        if file_path.lower().endswith('java'):
+            changed.add(innermost_macro_package(file_path, macro_packages))
+    for nested_macro_package in macro_packages ^ previous_macro_packages:
+        changed.add(innermost_macro_package(nested_macro_package, macro_packages))
+
+    changed.discard(None)
+    return changed
+
+
+def carry_forward_smells(previous_records, repo_state, environment, macro_packages, unchanged_macro_packages):
+    """
+    :return: the previous version's smells in unchanged macro packages, restamped with repo_state's version
+    :rtype: list
+    """
+    # Smell packages start with their macro package's path relative to the repository, as written by
+    # _read_designite_output
+    package_prefixes = {
+        os.path.relpath(macro_package, environment.temp_repo_folder).replace('\\', '/') + '/': macro_package
+        for macro_package in macro_packages
+    }
+
+    carried_records = []
+    for record in previous_records:
+        matching_prefixes = [prefix for prefix in package_prefixes if record[2].startswith(prefix)]
+        if len(matching_prefixes) <= 0:
+            continue
+
+        if package_prefixes[max(matching_prefixes, key=len)] in unchanged_macro_packages:
+            carried_records.append([record[0], repo_state.version.id, *record[2:]])
+
+    return carried_records
+
+
+def concurrent_designite_runs():
+    """
+    Number of Designite JVMs a process may run at once: the designite memory_budget from configs/tools.yaml, shared
+    by the version_workers processes, divided by each JVM's max_allocation
+
+    :rtype: int
+    """
+    designite_config = config_interface.get_tool_path('designite')
+    max_allocation = shell_interface.jvm_memory_in_megabytes(designite_config['max_allocation'])
+    memory_budget = shell_interface.jvm_memory_in_megabytes(
+        designite_config.get('memory_budget', designite_config['max_allocation'])
+    )
+    version_workers = max(1, config_interface.get_processing_option('version_workers', 1))
+
+    return max(1, memory_budget // version_workers // max_allocation)
+
+
 class DesigniteSmellsPopulator(PerVersionPopulator):
     table_name = 'DESIGNITE_SMELLS'
     backup_ext = 'csv'
 
     @staticmethod
     def _read_designite_output(package_path_prefix, designite_out_path):
-        package_smells = pd.DataFrame(columns=['package', 'smell', 'cause'])
-
-        with open(designite_out_path, newline='') as csv_file:
-            csv_reader = csv.reader(csv_file, delimiter=',')
-            first_row = True
-            for file_row in csv_reader:
-                if first_row:
-                    row_headers = enumerate(file_row)
-                    row_numbers = [num for num, row in row_headers if row != 'Type Name'
-                                   and row != 'Method Name' and row != 'Project Name']
-                    first_row = False
-                else:
-                    file_row = [file_row[i] for i in row_numbers]
-
-                    package_smells = package_smells.append({
-                        'package': file_row[0],
-                        'smell': file_row[1],
-                        'cause': file_row[2]
-                    }, ignore_index=True)
-
-        package_smells['package'] = package_smells['package'].apply(
-            lambda local_package: f'{package_path_prefix}/{local_package.replace(".", "/")}'.replace("\\", "/")
-        )
+        """
+        Reads one Designite output file. Designite's smell files share the layout
+        [Project Name,] Package Name, [Type Name,] [Method Name,] <kind> Smell, Cause of the Smell, ...
+        so the package, smell and cause are the first three columns once the ignored ones are dropped
+
+        :param package_path_prefix: path of the macro package, relative to the repository root
+        :type package_path_prefix: str
+        :param designite_out_path: path of the Designite csv
+        :type designite_out_path: str
+        :return: the file's smells, with packages rewritten to their path in the repository
+        :rtype: pandas.DataFrame
+        """
+        try:
+            # index_col=False drops fields beyond the header (unquoted commas in a cause), as the csv module did
+            package_smells = pd.read_csv(
+                designite_out_path, dtype=str, keep_default_na=False, index_col=False,
+                usecols=lambda column: column not in designite_ignored_columns
+            )
+        except pd.errors.EmptyDataError:
+            package_smells = pd.DataFrame()
+
+        package_smells = package_smells.iloc[:, :3]
+        package_smells = package_smells.set_axis(smell_columns[:len(package_smells.columns)], axis=1)
+        package_smells = package_smells.reindex(columns=smell_columns, fill_value='').astype(str)
+
+        package_smells['package'] = (
+            f'{package_path_prefix}/' + package_smells['package'].str.replace('.', '/', regex=False)
+        ).str.replace('\\', '/', regex=False)
 
         return package_smells
 
-    def _execute_generate(self, repo_state):
+    def _generate_version_records(self, repo_state):
         # if repo_state.version.id != 'release-3.3.2':
         #     return
 
-        environment = DesigniteProcessingEnvironment(repo_state.project)
+        environment = DesigniteProcessingEnvironment(repo_state)
 
         macro_packages = repo_state.identify_macro_packages()
         if len(macro_packages) <= 0:
-            return
+            return []
+
+        # In a diff walk, macro packages without changed java files keep the previous version's rows
+        carried_records = []
+        macro_packages_to_analyze = macro_packages
+        previous_records = self._previous_version_records(repo_state)
+        if previous_records is not None:
+            macro_packages_to_analyze = changed_macro_packages(repo_state, macro_packages)
+            carried_records = carry_forward_smells(
+                previous_records, repo_state, environment, macro_packages, macro_packages - macro_packages_to_analyze
+            )
+            print(f'Analyzing {len(macro_packages_to_analyze)} changed macro packages of {len(macro_packages)}')
+            if len(macro_packages_to_analyze) <= 0:
+                return carried_records
 
-        extracted_macro_packages = environment.extract_macro_packages(macro_packages)
+        staged_macro_packages = environment.stage_macro_packages(macro_packages_to_analyze, macro_packages)
         version_out_path = environment.make_version_out_folder(repo_state)
 
-        smells_in_version = pd.DataFrame(columns=['package', 'smell', 'cause'])
-        for i, macro_package_true_path in enumerate(extracted_macro_packages):
+        designite_runs = []
+        for i, macro_package_true_path in enumerate(staged_macro_packages):
             macro_package_path = os.path.join(version_out_path, str(i))
             relative_true_path = os.path.relpath(macro_package_true_path, environment.temp_repo_folder)
             faux_path = os.path.join(environment.macro_packages_folder, str(i))
 
-            print(f'{macro_package_path=}')
-            print(f'{relative_true_path=}')
-            print(f'{faux_path=}')
-
             os.mkdir(macro_package_path)
+            designite_runs.append((faux_path, macro_package_path, relative_true_path))
 
+        # Macro packages are independent, so their JVMs run side by side, as many as the memory budget allows
+        def run_designite(i):
+            faux_path, macro_package_path, relative_true_path = designite_runs[i]
             print(
                 f'Starting Designite analysis on Package: {relative_true_path} '
-                f'({str(i)} of {len(macro_packages) - 1})\n'
+                f'({str(i)} of {len(designite_runs) - 1})\n'
             )
             shell_interface.run_designite(faux_path, macro_package_path)
-            print('\n\n')
 
             with open(os.path.join(macro_package_path, 'pkg_name.txt'), 'w') as f:
                 f.write(relative_true_path)
 
+        with ThreadPoolExecutor(max_workers=concurrent_designite_runs()) as executor:
+            list(executor.map(run_designite, range(len(designite_runs))))
+        print('\n\n')
+
+        version_smells = []
+        for faux_path, macro_package_path, relative_true_path in designite_runs:
             for designite_out_file in os.listdir(macro_package_path):
                 if designite_out_file in designite_files_to_save:
                     designite_out_path = os.path.join(macro_package_path, designite_out_file)
-                    smells_in_version = smells_in_version.append(
-                        self._read_designite_output(relative_true_path, designite_out_path),
-                        ignore_index=True
-                    )
+                    version_smells.append(self._read_designite_output(relative_true_path, designite_out_path))
+
+        smells_in_version = pd.DataFrame(columns=smell_columns)
+        if len(version_smells) > 0:
+            smells_in_version = pd.concat(version_smells, ignore_index=True)
 
         smells_in_version['project_name'] = self.project.repo_name
         smells_in_version['version'] = repo_state.version.id
@@ -144,9 +276,8 @@ class DesigniteSmellsPopulator(PerVersionPopulator):
             columns=['project_name', 'version', 'package', 'smell', 'cause']
         )
 
-        self.db_backup.save_records_to_csv(smells_in_version.to_numpy().tolist())
+        return carried_records + smells_in_version.to_numpy().tolist()
 
     def _execute_load(self):
-        cmd = "INSERT INTO DESIGNITE_SMELLS VALUES (?, ?, ?, ?, ?)"
-        commit_records = (self.db_backup.read_csv_data())
-        self.c.executemany(cmd, commit_records)
+        cmd = "INSERT INTO DESIGNITE_SMELLS (project_name, version, package, smell, cause) VALUES (?, ?, ?, ?, ?)"
+        self._load_records(cmd, self.db_backup.iter_records())
@@ -1,37 +1,70 @@
+import re
+from collections import defaultdict
+
 from database.populator_helpers import Populator
 
 
+def jira_key_pattern(jira_keys):
+    """
+    Builds one pattern matching any key shaped like the given keys (PROJECT-123), for every project prefix they use.
+    Matching is case-insensitive and bounded by word boundaries, like the per-key REGEXP queries it replaces
+
+    :param jira_keys: known Jira keys
+    :type jira_keys: iterable
+    :return: compiled pattern whose matches are candidate keys
+    :rtype: re.Pattern
+    """
+    prefixes = sorted({key.rsplit('-', 1)[0].upper() for key in jira_keys})
+    return re.compile(r'\b(?:' + '|'.join(re.escape(prefix) for prefix in prefixes) + r')-\d+\b', re.I)
+
+
 class GitCommitJiraPopulator(Populator):
     table_name = 'GIT_COMMIT_JIRA'
     backup_ext = 'csv'
+    depends_on = ('GIT_COMMITS', 'JIRA_ISSUES')
 
     def _execute_generate(self):
         # Get jira keys
-        cmd = f"select key from JIRA_ISSUES where project_name = '{self.project.repo_name}'"
-        self.c.execute(cmd)
+        cmd = "select key from JIRA_ISSUES where project_name = ?"
+        self.c.execute(cmd, (self.project.repo_name,))
         raw_keys = self.c.fetchall()
         raw_keys.reverse()
-        keys = (key[0] for key in raw_keys)
-        key_to_commit_records = []
+        keys = [key[0] for key in raw_keys]
+        keys_by_upper_case = {key.upper(): key for key in keys}
+        key_pattern = jira_key_pattern(keys)
+
+        # Scan every commit message once, collecting the known keys it mentions
+        commit_hashes_by_key = defaultdict(list)
+        cmd = "select commit_hash, commit_message from GIT_COMMITS where project_name = ?"
+        commits = self.c.execute(cmd, (self.project.repo_name,)) if len(keys) > 0 else []
+        for commit_hash, commit_message in commits:
+            if not commit_message:
+                continue
 
-        for key in keys:
-            cmd = f"select commit_hash, commit_message from GIT_COMMITS where project_name = '{self.project.repo_name}' and " \
-                  f"(commit_message REGEXP ('\\b{key}\\b'))"
-            self.c.execute(cmd)
-            commits = self.c.fetchall()
-            commit_hashes = (commit[0] for commit in commits)
+            mentioned_keys = dict.fromkeys(match.upper() for match in key_pattern.findall(commit_message))
+            for mentioned_key in mentioned_keys:
+                if mentioned_key in keys_by_upper_case:
+                    commit_hashes_by_key[keys_by_upper_case[mentioned_key]].append(commit_hash)
 
-            # Create a record for each commit pertaining to a jira key
-            for commit_hash in commit_hashes:
-                record = (key, commit_hash)
-                key_to_commit_records.append(record)
+        # Create a record for each commit pertaining to a jira key
+        key_to_commit_records = [
+            (key, commit_hash) for key in keys for commit_hash in commit_hashes_by_key.get(key, [])
+        ]
+        print(f'Found {len(key_to_commit_records)} total commits')
 
-            print(f'Found {len(key_to_commit_records)} total commits')
+        self.db_backup.save_records(key_to_commit_records)
 
-        self.db_backup.save_records_to_csv(key_to_commit_records)
+    def _delete_project_rows(self):
+        """
+        Links have no project_name; the project's are those to its issues or from its commits
+        """
+        self.conn.execute(
+            'DELETE FROM GIT_COMMIT_JIRA WHERE key IN (SELECT key FROM JIRA_ISSUES WHERE project_name = ?) '
+            'OR commit_hash IN (SELECT commit_hash FROM GIT_COMMITS WHERE project_name = ?)',
+            (self.project.repo_name, self.project.repo_name)
+        )
 
     def _execute_load(self):
-        cmd = "INSERT INTO GIT_COMMIT_JIRA(key, commit_hash) VALUES (?, ?)"
+        cmd = "INSERT OR REPLACE INTO GIT_COMMIT_JIRA(key, commit_hash) VALUES (?, ?)"
 
-        csv_records = self.db_backup.read_csv_data()
-        self.c.executemany(cmd, csv_records)
\ No newline at end of file
+        self._load_records(cmd, self.db_backup.iter_records())
\ No newline at end of file
@@ -1,11 +1,15 @@
-from database.populator_helpers import RECORDS_UNTIL_CSV_SAVE, Populator
+from database.populator_helpers import CommitStreamPopulator
 
-from pydriller import Repository
 
-class GitCommitsPopulator(Populator):
+class GitCommitsPopulator(CommitStreamPopulator):
     table_name = 'GIT_COMMITS'
     backup_ext = 'csv'
-    records = []
+    # Dates and flags keep the text they are loaded as
+    backup_schema = [
+        ('project_name', 'string'), ('commit_hash', 'string'), ('commit_message', 'string'), ('author', 'string'),
+        ('author_date', 'string'), ('author_timezone', 'int64'), ('committer', 'string'), ('committer_date', 'string'),
+        ('committer_timezone', 'int64'), ('in_main_branch', 'string'), ('merge', 'string'), ('parents', 'string'),
+    ]
 
     def _save_pydriller_commit(self, commit):
         c_hash = commit.hash
@@ -25,24 +29,11 @@ class GitCommitsPopulator(Populator):
         commit_record = (project, c_hash, msg, author_name, author_date, author_timezone, commiter_name,
                          commiter_date, commiter_timezone, in_main_branch, merge, parents)
 
-        if len(self.records) >= RECORDS_UNTIL_CSV_SAVE:
-            self.db_backup.save_records_to_csv(self.records)
-            self.records = []
-        else:
-            self.records.append(commit_record)
-
-    def _execute_generate(self):
-        for commit in Repository(self.project.repo_path, order='').traverse_commits():
-            self._save_pydriller_commit(commit)
-
-        # Get any remaining commits
-        self.db_backup.save_records_to_csv(self.records)
-
+        self._buffer_record(commit_record)
 
     def _execute_load(self):
-        cmd = "INSERT INTO GIT_COMMITS(project_name, commit_hash, commit_message, author, author_date, author_timezone, " \
-              "committer, committer_date, committer_timezone, in_main_branch, merge, parents) VALUES " \
+        cmd = "INSERT OR REPLACE INTO GIT_COMMITS(project_name, commit_hash, commit_message, author, author_date, " \
+              "author_timezone, committer, committer_date, committer_timezone, in_main_branch, merge, parents) VALUES " \
               "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
 
-        csv_records = self.db_backup.read_csv_data()
-        self.c.executemany(cmd, csv_records)
+        self._load_records(cmd, self.db_backup.iter_records())
@@ -1,11 +1,12 @@
 import numpy as np
-import requests
 from datetime import datetime
-import re
-from bs4 import BeautifulSoup
+from functools import lru_cache
+from lxml import html as lxml_html
 
 from database.db_connection import DB_ABSPATH
+from database.jira_fetcher import JiraFetcher, key_windows
 from database.populator_helpers import Populator
+from utils.config_interface import get_processing_option
 
 
 desired_jira_attributes = {
@@ -42,95 +43,104 @@ attributes_to_dateify = [
     'created', 'resolutiondate', 'updated', 'duedate'
 ]
 
+
+@lru_cache(maxsize=None)
+def parse_jira_date(value):
+    """
+    Parses a date as shown in Jira's HTML export (i.e, 04/Mar/21 10:05, or 04/Mar/21 for due dates). Exports repeat the
+    same dates many times, so results are cached
+
+    :return: the date in the database's format (i.e, 2021-03-04 10:05:00)
+    :rtype: str
+    """
+    try:
+        value_time_obj = datetime.strptime(value, '%d/%b/%y %H:%M')
+    except ValueError:
+        value_time_obj = datetime.strptime(value, '%d/%b/%y')
+    return str(value_time_obj)
+
+
+def parse_issue_rows(html):
+    """
+    Parses one window of Jira's HTML export. Each row's cells are read once and mapped to attributes by their class;
+    when several cells of a row share a class, the first one is used
+
+    :param html: one window of Jira's HTML export
+    :type html: str
+    :return: one record per issue, in the order of desired_jira_attributes, newest issue last
+    :rtype: list
+    """
+    if not html.strip():
+        return []
+
+    parser = lxml_html.HTMLParser(encoding='utf-8')
+    tbody = lxml_html.fromstring(html.encode('utf-8'), parser=parser).find('.//tbody')
+    if tbody is None:
+        return []
+
+    thousand_keys = []
+    for tr in tbody.iter('tr'):
+        cells = {}
+        for td in tr.iter('td'):
+            for html_attribute in td.get('class', '').split():
+                if html_attribute in desired_jira_attributes and html_attribute not in cells:
+                    cells[html_attribute] = td
+
+        key_attributes = []
+        for html_attribute in desired_jira_attributes.keys():
+            value = cells.get(html_attribute)
+
+            if value is None:
+                value = ''
+            else:
+                value = ''.join(text.strip() for text in value.xpath('.//text()'))
+
+            if html_attribute in attributes_to_listify:
+                value = value.split()
+            elif html_attribute in attributes_to_dateify and value != '':
+                value = parse_jira_date(value)
+
+            key_attributes.append(value)
+        thousand_keys.insert(0, key_attributes)
+
+    return thousand_keys
+
+
 class JiraIssuesPopulator(Populator):
     table_name = 'JIRA_ISSUES'
     backup_ext = 'csv'
+    # Incremental runs fetch issues created since the last run; issues already in the backup are not refreshed
+    supports_incremental = True
 
     def _execute_generate(self):
-        r = requests.get(f'{self.project.jira_link}/rest/api/2/search?jql=project={self.project.repo_name}' \
-                         f'+ORDER+BY+createdDate+DESC&maxResults=1&fields=updated')
-
-        # extracting data in json format
-        request_json = r.json()
-        latest_issue = request_json['issues'][0]
-        latest_key = latest_issue['key']
-        last_key_number = int(latest_key[latest_key.find('-')+1:])
-
-        last_iteration = False
-        step_size = 1000
-        key_1 = 1
-        key_2 = 1000
-
-        while not last_iteration:
-            if key_2 > last_key_number:
-                key_2 = last_key_number
-                last_iteration = True
-
-            request_str = f'{self.project.jira_link}' \
-                          f'/sr/jira.issueviews:searchrequest-html-all-fields/temp/SearchRequest.html?jqlQuery=' \
-                          f'project%3D{self.project.repo_name}' \
-                          f'%20AND%20key%3E%3D{self.project.repo_name}-{str(key_1)}' \
-                          f'%20AND%20key%3C%3D{self.project.repo_name}-{str(key_2)}'
-
-            r = requests.get(request_str)
-
-            # If key_1 or key_2 is a moved key, we'll get an error. so we'll get the next key and try again
-            if r.status_code == 400 and r.text.find('moved issue'):
-                regex_str = f'{self.project.repo_name.upper()}\\-(\\d+)'
-                problematic_key = re.search(regex_str, r.text).groups()[0]
-                problematic_key = int(problematic_key)
-
-                # Edge case: key_1 gets incremented to key_2 due to 1000 moves.........
-                if problematic_key == key_1:
-                    key_1 = key_1 + 1
-                    key_2 = key_2 + 1
-                elif problematic_key == key_2:
-                    key_2 = key_2 + 1
-
-                continue
-
-
-            parsed_html = BeautifulSoup(r.text, 'html.parser')
-            parsed_html = parsed_html.find('tbody')
-
-            thousand_keys = []
-            for tr in parsed_html.find_all('tr'):
-                key_attributes = []
-                for i, html_attribute in enumerate(desired_jira_attributes.keys()):
-                    value = tr.find('td', attrs={'class': html_attribute})
-
-                    if value is None:
-                        value = ''
-                    else:
-                        value = value.get_text(strip=True)
-
-                    if html_attribute in attributes_to_listify:
-                        value = value.split()
-                    elif html_attribute in attributes_to_dateify and value != '':
-                        value_time_obj = None
-                        try:
-                            value_time_obj = datetime.strptime(value, '%d/%b/%y %H:%M')
-                        except:
-                            value_time_obj = datetime.strptime(value, '%d/%b/%y')
-                        value = str(value_time_obj)
-
-                    key_attributes.append(value)
-                thousand_keys.insert(0, key_attributes)
-
-            key_1 = key_2 + 1
-            key_2 = key_2 + step_size
-
-            self.db_backup.save_records_to_csv(thousand_keys)
-
+        fetcher = JiraFetcher(
+            self.project.jira_link,
+            self.project.repo_name,
+            workers=get_processing_option('jira_fetch_workers', 4),
+            requests_per_second=get_processing_option('jira_requests_per_second', 2.0)
+        )
+
+        with fetcher:
+            last_key_number = fetcher.latest_key_number()
+            first_key_number = self.watermark.get('last_key_number', 0) + 1
+
+            if first_key_number > last_key_number:
+                print(f'No new {self.project.repo_name} issues since '
+                      f'{self.project.repo_name.upper()}-{first_key_number - 1}')
+                return
+
+            # Windows arrive in key order, so the watermark only ever covers windows that are saved
+            for (key_1, key_2), html in fetcher.fetch_windows(key_windows(first_key_number, last_key_number)):
+                if html is not None:
+                    self.db_backup.save_records(parse_issue_rows(html))
+
+                self.watermark.set('last_key_number', key_2)
+                self._save_watermark()
 
     def _execute_load(self):
-        cmd = f"INSERT INTO JIRA_ISSUES(project_name, {', '.join(desired_jira_attributes.values())}) VALUES (?, {', '.join(['?']*len(desired_jira_attributes))})"
+        cmd = f"INSERT OR REPLACE INTO JIRA_ISSUES(project_name, {', '.join(desired_jira_attributes.values())}) VALUES (?, {', '.join(['?']*len(desired_jira_attributes))})"
         print(cmd)
-        csv_records = self.db_backup.read_csv_data()
-        csv_records = [[self.project.repo_name] + record for record in csv_records]
-        #csv_records = np.asarray(csv_records)
-        # print(csv_records[:5])
-        # csv_records.push(0, [self.project.repo_name])
-        self.c.executemany(cmd, csv_records)
+        csv_records = ([self.project.repo_name] + record for record in self.db_backup.iter_records())
+        self._load_records(cmd, csv_records)
 
 # 'https://issues.apache.org/jira/sr/jira.issueviews:searchrequest-html-all-fields/temp/SearchRequest.html?jqlQuery=project+%3D+AMBARI+AND+key+%3E%3D+AMBARI-1+AND+key+%3C%3D+AMBARI-1000'
\ No newline at end of file
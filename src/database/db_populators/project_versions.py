@@ -6,7 +6,7 @@ class ProjectVersionsPopulator(Populator):
     table_name = 'PROJECT_VERSIONS'
 
     def _execute_load(self):
-        cmd = 'INSERT INTO PROJECT_VERSIONS ' \
+        cmd = 'INSERT OR REPLACE INTO PROJECT_VERSIONS ' \
               '(project_name, version, commit_hash, author_date, previous_version) ' \
               'VALUES (?, ?, ?, ?, ?)'
 
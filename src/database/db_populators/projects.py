@@ -5,5 +5,5 @@ class ProjectInfoPopulator(Populator):
     table_name = 'PROJECTS'
 
     def _execute_load(self):
-        cmd = 'INSERT INTO PROJECTS (project_name, git_link, jira_link) VALUES (?, ?, ?)'
+        cmd = 'INSERT OR REPLACE INTO PROJECTS (project_name, git_link, jira_link) VALUES (?, ?, ?)'
         self.c.execute(cmd, (self.project.repo_name, self.project.github_link, self.project.jira_link))
\ No newline at end of file
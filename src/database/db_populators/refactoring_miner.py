@@ -1,9 +1,33 @@
-import json
+import ijson
 
 from database.populator_helpers import Populator
 from utils import shell_interface
 
 
+def iter_refactoring_records(ref_file, project_name):
+    """
+    Streams the refactorings of a RefactoringMiner output file with an incremental JSON parser, so that only one
+    commit's refactorings are in memory at a time, however large the file
+
+    :param ref_file: the RefactoringMiner json output, opened in binary mode
+    :param project_name: the project the refactorings belong to
+    :type project_name: str
+    :return: (project_name, commit_hash, refactoring_type, refactoring_detail, refactoring_path, package) records
+    """
+    for commit_refs in ijson.items(ref_file, 'commits.item'):
+        for ref_action in commit_refs['refactorings']:
+            ref_left_side = ref_action['leftSideLocations']
+
+            ref_path = None
+            ref_package = None
+            if ref_left_side and len(ref_left_side) > 0:
+                ref_path = ref_left_side[0]['filePath']
+                ref_package = '/'.join(ref_path.split('/')[:-1])
+
+            yield (project_name, commit_refs['sha1'], ref_action['type'], ref_action['description'], ref_path,
+                   ref_package)
+
+
 class RefMinerPopulator(Populator):
     table_name = 'REFACTORING_MINER'
     backup_ext = 'json'
@@ -16,29 +40,8 @@ class RefMinerPopulator(Populator):
         print(response)
 
     def _execute_load(self):
-        ref_file = open(self.db_backup.backup_file)
-        refs_json = json.load(ref_file)
-        ref_file.close()
-
-        num_commits = 0
-        num_empty_commits = 0
-        for commit_refs in refs_json['commits']:
-            num_commits = num_commits + 1
-            if len(commit_refs['refactorings']) == 0:
-                num_empty_commits = num_empty_commits + 1
-
-            for ref_action in commit_refs['refactorings']:
-                ref_type = ref_action['type']
-                ref_detail = ref_action['description']
-                ref_left_side = ref_action['leftSideLocations']
-
-                ref_path = None
-                ref_package = None
-                if ref_left_side and len(ref_left_side) > 0:
-                    ref_path = ref_left_side[0]['filePath']
-                    ref_package = '/'.join(ref_path.split('/')[:-1])
-                cmd = "INSERT INTO 'REFACTORING_MINER'(project_name,commit_hash," \
-                      "refactoring_type,refactoring_detail,refactoring_path, package) VALUES (?, ?, ?, ?, ?, ?);"
-
-                record = (self.project.repo_name, commit_refs['sha1'], ref_type, ref_detail, ref_path, ref_package)
-                self.c.execute(cmd, record)
+        cmd = "INSERT INTO REFACTORING_MINER (project_name, commit_hash, refactoring_type, refactoring_detail, " \
+              "refactoring_path, package) VALUES (?, ?, ?, ?, ?, ?)"
+
+        with open(self.db_backup.backup_file, 'rb') as ref_file:
+            self._load_records(cmd, iter_refactoring_records(ref_file, self.project.repo_name))
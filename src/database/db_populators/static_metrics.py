@@ -1,60 +1,154 @@
 import os
 
+from database.lizard_cache import LizardCache, LIZARD_CACHE_MAX_ENTRIES, cache_report, file_blob_sha, \
+    lizard_file_key, read_cache_counters, read_file_source
+from database.git_objects import GitObjectReader, decode_source
 from database.populator_helpers import PerVersionPopulator
-import lizard
+from utils import resource_limits
+from utils.config_interface import get_processing_option
 
 
 class StaticMetricsPopulator(PerVersionPopulator):
     table_name = 'STATIC_METRICS'
     backup_ext = 'csv'
+    backup_schema = [
+        ('project_name', 'string'), ('package', 'string'), ('version', 'string'), ('pkg_files', 'int64'),
+        ('pkg_loc', 'int64'), ('pkg_tokens', 'int64'), ('pkg_cc', 'int64'), ('pkg_average_loc', 'float64'),
+        ('pkg_average_cc', 'float64'), ('pkg_average_tokens', 'float64'),
+    ]
+    # Files are read from the object database when no other requested populator needs a checkout
+    needs_working_tree = False
+
+    # Opened by the first analyzed version
+    lizard_cache = None
+
+    def __init__(self, project, db_action, *args, **kwargs):
+        super().__init__(project, db_action, *args, **kwargs)
+
+        # The cache is shared by worker processes, so the run's hit rate is the change in its lifetime counters
+        if db_action.is_generate():
+            self.cache_counters_at_start = read_cache_counters()
+
+    def _generate_version_records(self, repo_state):
+        if self.lizard_cache is None:
+            self.lizard_cache = LizardCache(
+                max_entries=get_processing_option('lizard_cache_max_entries', LIZARD_CACHE_MAX_ENTRIES)
+            )
+        tree_blobs = repo_state.tree_blobs()
 
-    def _execute_generate(self, repo_state):
         package_records = []
+        packages_to_analyze = repo_state.packages
         print(repo_state.packages)
         print(repo_state.version.id)
         print(repo_state.version.hash_id)
-        for package_path in repo_state.packages:
-            local_path_flag = f'/{repo_state.project.repo_name}/'
-            local_package_path = package_path[package_path.find(local_path_flag)+len(local_path_flag):]
-
-            # NOTE: .JAV FILES DO NOT WORK, ONLY .JAVA
-            analyzed_files = lizard.analyze([package_path], exclude_pattern=[os.path.join(package_path, '*/*')])
-            n_files = 0
-            n_loc = 0
-            cc = 0
-            n_tokens = 0
-            # total_depth = 0
-            for file_info in analyzed_files:
-                n_files = n_files + 1
-                n_loc = n_loc + file_info.nloc
-                cc = cc + file_info.CCN
-                n_tokens = n_tokens + file_info.token_count
+
+        # In a diff walk, packages without changes keep the previous version's rows
+        previous_records = self._previous_version_records(repo_state)
+        if previous_records is not None:
+            packages_to_analyze = repo_state.added_packages | repo_state.modified_packages
+            unchanged_packages = {
+                self._local_package_path(repo_state, package_path)
+                for package_path in repo_state.packages - packages_to_analyze
+            }
+            package_records = [
+                (record[0], record[1], repo_state.version.id, *record[3:])
+                for record in previous_records if record[1] in unchanged_packages
+            ]
+            print(f'Analyzing {len(packages_to_analyze)} changed packages of {len(repo_state.packages)}')
+
+        object_reader = GitObjectReader(repo_state.repo_path) if not repo_state.has_working_tree else None
+        # The reader runs git cat-file; it is closed however the analysis ends
+        try:
+            for package_path in packages_to_analyze:
+                local_package_path = self._local_package_path(repo_state, package_path)
+
+                # Only the files directly in the package. NOTE: .JAV FILES DO NOT WORK, ONLY .JAVA
+                if repo_state.has_working_tree:
+                    package_files = self._working_tree_package_files(repo_state, package_path, tree_blobs)
+                else:
+                    package_files = self._object_package_files(repo_state, package_path, object_reader)
+
+                # Lizard is CPU-bound; concurrent projects and version workers share a limited number of analyses, held
+                # one package at a time
+                with resource_limits.acquire('cpu'):
+                    n_files, n_loc, cc, n_tokens = self.lizard_cache.package_metrics(package_files)
                 # total_depth = total_depth + file_info.ND
 
-            if n_files <= 0:
+                if n_files <= 0:
+                    continue
+
+                avg_n_loc = n_loc / n_files
+                avg_tokens = n_tokens / n_files
+                avg_cc = cc / n_files
+                # average_depth = total_depth / total_files
+
+                package_record = (repo_state.project.repo_name, local_package_path, repo_state.version.id,
+                                  n_files, n_loc, n_tokens, cc, avg_n_loc, avg_cc, avg_tokens)
+                package_records.append(package_record)
+        finally:
+            if object_reader is not None:
+                object_reader.close()
+
+        self.lizard_cache.flush()
+        return package_records
+
+    @staticmethod
+    def _working_tree_package_files(repo_state, package_path, tree_blobs):
+        """
+        :return: the package's files lizard reads, from the checkout, as LizardCache.package_metrics takes them
+        :rtype: list
+        """
+        package_files = []
+        for file_name in os.listdir(package_path):
+            file_path = os.path.join(package_path, file_name)
+            if not os.path.isfile(file_path):
                 continue
 
-            # git reset --hard
-            # print(analyzed_files)
-            # print(package_path)
-            # print(local_package_path)
-            # input()
+            repo_file_path = os.path.relpath(file_path, repo_state.repo_path).replace('\\', '/')
+            blob_sha = tree_blobs.get(repo_file_path) or file_blob_sha(file_path)
+            file_key = lizard_file_key(blob_sha, file_path)
+            if file_key is not None:
+                package_files.append((file_key, file_path, read_file_source(file_path)))
+
+        return package_files
+
+    @staticmethod
+    def _object_package_files(repo_state, package_path, object_reader):
+        """
+        :return: the package's files lizard reads, from the object database, as LizardCache.package_metrics takes them
+        :rtype: list
+        """
+        package_files = []
+        for file_path, blob_sha in repo_state.tree_package_files(package_path):
+            file_key = lizard_file_key(blob_sha, file_path)
+            if file_key is not None:
+                package_files.append(
+                    (file_key, file_path, lambda blob_sha=blob_sha: decode_source(object_reader.read_blob(blob_sha)))
+                )
+
+        return package_files
+
+    @staticmethod
+    def _local_package_path(repo_state, package_path):
+        local_path_flag = f'/{repo_state.project.repo_name}/'
+        return package_path[package_path.find(local_path_flag)+len(local_path_flag):]
 
-            avg_n_loc = n_loc / n_files
-            avg_tokens = n_tokens / n_files
-            avg_cc = cc / n_files
-            # average_depth = total_depth / total_files
+    def close_analysis(self):
+        if self.lizard_cache is not None:
+            self.lizard_cache.close()
+            self.lizard_cache = None
 
-            package_record = (repo_state.project.repo_name, local_package_path, repo_state.version.id,
-                              n_files, n_loc, n_tokens, cc, avg_n_loc, avg_cc, avg_tokens)
-            package_records.append(package_record)
+    def finish(self):
+        # Flushes the cache's counters before they are read
+        self.close_analysis()
+        if self.db_action.is_generate():
+            print(f'{self.project.repo_name}: {cache_report(self.cache_counters_at_start, read_cache_counters())}')
 
-        self.db_backup.save_records_to_csv(package_records)
+        super().finish()
 
     def _execute_load(self):
-        cmd = "INSERT INTO STATIC_METRICS (project_name, package, version, pkg_files, pkg_loc, pkg_tokens, pkg_cc," \
-              "pkg_average_loc, pkg_average_cc, pkg_average_tokens) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+        cmd = "INSERT OR REPLACE INTO STATIC_METRICS (project_name, package, version, pkg_files, pkg_loc, pkg_tokens, " \
+              "pkg_cc, pkg_average_loc, pkg_average_cc, pkg_average_tokens) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
 
-        metrics_records = (self.db_backup.read_csv_data())
-        self.c.executemany(cmd, metrics_records)
+        self._load_records(cmd, self.db_backup.iter_records())
         # self.conn.commit()
@@ -0,0 +1,67 @@
+"""
+Reads file contents straight from a repository's object database, so versions can be analyzed without checking them
+out. One `git cat-file --batch` process serves every blob requested through a GitObjectReader.
+"""
+import codecs
+import locale
+
+from utils import shell_interface
+
+
+class GitObjectReader:
+    """
+    Streams blobs from a repository with a single `git cat-file --batch` process. Use as a context manager, or call
+    `close`
+
+    :param repo_path: path to the local repository, or any of its worktrees
+    :type repo_path: str
+    """
+
+    def __init__(self, repo_path):
+        self.repo_path = repo_path
+        self.process = shell_interface.open_cat_file_batch(repo_path)
+
+    def read_blob(self, blob_sha):
+        """
+        :return: the blob's contents
+        :rtype: bytes
+        """
+        self.process.stdin.write(f'{blob_sha}\n'.encode())
+        self.process.stdin.flush()
+
+        header = self.process.stdout.readline().decode().split()
+        if len(header) != 3 or header[1] != 'blob':
+            raise KeyError(f'{blob_sha} is not a blob of {self.repo_path}')
+
+        contents = self.process.stdout.read(int(header[2]))
+        self.process.stdout.read(1)  # The newline that terminates every object
+        return contents
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+        self.process.stdout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def decode_source(contents):
+    """
+    Decodes a blob the way lizard reads a file from disk (lizard_ext.auto_read): UTF-8 with BOM when one is present,
+    otherwise the locale's encoding with universal newlines, and UTF-8 ignoring errors if that fails
+
+    :param contents: the blob's contents
+    :type contents: bytes
+    :rtype: str
+    """
+    encoding = 'utf-8-sig' if contents[:32].startswith(codecs.BOM_UTF8) else locale.getpreferredencoding(False)
+    try:
+        source = contents.decode(encoding)
+    except UnicodeDecodeError:
+        return contents.decode('utf8', 'ignore')
+
+    return source.replace('\r\n', '\n').replace('\r', '\n')
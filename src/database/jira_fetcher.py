@@ -0,0 +1,312 @@
+"""
+Fetches a Jira project's issues as HTML exports, several key-range windows at a time.
+
+All requests go through one pooled requests.Session. Concurrency is bounded by the number of workers, requests are
+spaced to respect a rate limit, and connection errors, 429s and 5xx responses are retried with exponential backoff, or
+after the delay the server asks for with Retry-After. Windows are always returned in key order, however the requests
+complete.
+
+Run this module to check the fetcher against a local stub Jira server.
+"""
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from utils import resource_limits
+
+JIRA_WINDOW_SIZE = 1000
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def retry_after_seconds(response):
+    """
+    :return: the delay a response's Retry-After header asks for, given in seconds or as an HTTP date, or None if the
+        header is missing or unreadable
+    :rtype: float
+    """
+    retry_after = response.headers.get('Retry-After')
+    if retry_after is None:
+        return None
+
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+
+    try:
+        retry_time = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    if retry_time.tzinfo is None:
+        retry_time = retry_time.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_time - datetime.now(timezone.utc)).total_seconds())
+
+
+def key_windows(first_key_number, last_key_number, window_size=JIRA_WINDOW_SIZE):
+    """
+    Splits an inclusive range of key numbers into consecutive windows
+
+    :return: (first key number, last key number) of each window, in order
+    :rtype: list
+    """
+    return [
+        (key_1, min(key_1 + window_size - 1, last_key_number))
+        for key_1 in range(first_key_number, last_key_number + 1, window_size)
+    ]
+
+
+class JiraFetcher:
+    """
+    Concurrent, rate-limited client for one project of a Jira instance
+
+    :param jira_link: base url of the Jira instance (i.e, https://issues.apache.org/jira)
+    :type jira_link: str
+    :param project_key: the Jira project key (i.e, hive)
+    :type project_key: str
+    :param workers: maximum number of requests in flight
+    :type workers: int
+    :param max_retries: attempts per request after the first, for connection errors, 429s and 5xx responses
+    :type max_retries: int
+    :param backoff: seconds before the first retry; doubled for every further retry. A longer Retry-After wins
+    :type backoff: float
+    :param requests_per_second: upper bound on the rate requests are started at. 0 disables rate limiting
+    :type requests_per_second: float
+    :param timeout: seconds to wait for a response
+    :type timeout: float
+    """
+
+    def __init__(self, jira_link, project_key, workers=4, max_retries=5, backoff=1.0, requests_per_second=2.0,
+                 timeout=120):
+        self.jira_link = jira_link.rstrip('/')
+        self.project_key = project_key
+        self.workers = max(1, workers)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._min_request_interval = 1 / requests_per_second if requests_per_second > 0 else 0
+        self._next_request_time = 0
+        self._rate_lock = threading.Lock()
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _wait_for_rate_limit(self):
+        with self._rate_lock:
+            now = time.monotonic()
+            wait_time = self._next_request_time - now
+            self._next_request_time = max(now, self._next_request_time) + self._min_request_interval
+
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+    def _pause_requests(self, seconds):
+        """
+        Holds back every worker's next request for seconds, as a server answering with Retry-After is likely to refuse
+        them all until then
+        """
+        with self._rate_lock:
+            self._next_request_time = max(self._next_request_time, time.monotonic() + seconds)
+
+    def _get(self, url):
+        """
+        GETs a url, retrying with exponential backoff on connection errors, 429s and 5xx responses. A response's
+        Retry-After delay is waited out instead when it is longer than the backoff
+
+        :return: the final response. Other error responses (i.e, 400) are returned to the caller to handle
+        :rtype: requests.Response
+        """
+        for attempt in range(self.max_retries + 1):
+            self._wait_for_rate_limit()
+            delay = self.backoff * 2 ** attempt
+            try:
+                # Held per request, not while backing off, so retries do not keep other projects off the network
+                with resource_limits.acquire('network'):
+                    response = self.session.get(url, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                    return response
+
+                retry_after = retry_after_seconds(response)
+                if retry_after is not None and retry_after > delay:
+                    delay = retry_after
+                    self._pause_requests(retry_after)
+
+            time.sleep(delay)
+
+    def latest_key_number(self):
+        """
+        :return: the number of the project's most recently created issue
+        :rtype: int
+        """
+        response = self._get(f'{self.jira_link}/rest/api/2/search?jql=project={self.project_key}'
+                             f'+ORDER+BY+createdDate+DESC&maxResults=1&fields=updated')
+        response.raise_for_status()
+
+        latest_key = response.json()['issues'][0]['key']
+        return int(latest_key[latest_key.find('-') + 1:])
+
+    def window_url(self, key_1, key_2):
+        return f'{self.jira_link}' \
+               f'/sr/jira.issueviews:searchrequest-html-all-fields/temp/SearchRequest.html?jqlQuery=' \
+               f'project%3D{self.project_key}' \
+               f'%20AND%20key%3E%3D{self.project_key}-{str(key_1)}' \
+               f'%20AND%20key%3C%3D{self.project_key}-{str(key_2)}'
+
+    def fetch_window(self, key_1, key_2):
+        """
+        Fetches the HTML export of the issues with key numbers key_1 to key_2.
+
+        Jira answers 400 when a bound of the range is a key that was moved to another project. The window is then
+        narrowed past the moved key and requested again; it never grows, so concurrent windows never overlap
+
+        :return: the HTML export, or None if every key of the window was moved
+        :rtype: str
+        """
+        while key_1 <= key_2:
+            response = self._get(self.window_url(key_1, key_2))
+
+            if response.status_code == 400 and 'moved issue' in response.text:
+                problematic_key = re.search(f'{self.project_key.upper()}\\-(\\d+)', response.text)
+                problematic_key = int(problematic_key.groups()[0]) if problematic_key else None
+
+                if problematic_key == key_1:
+                    key_1 = key_1 + 1
+                    continue
+                elif problematic_key == key_2:
+                    key_2 = key_2 - 1
+                    continue
+
+            response.raise_for_status()
+            return response.text
+
+        return None
+
+    def fetch_windows(self, windows):
+        """
+        Fetches windows concurrently. At most `workers` windows are in flight, and at most twice that many fetched
+        windows are held in memory while waiting for an earlier, slower window
+
+        :param windows: (key_1, key_2) pairs, i.e. from `key_windows`
+        :type windows: list
+        :return: generator of ((key_1, key_2), html) in the order of windows
+        """
+        windows = iter(windows)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque()
+            for window in windows:
+                pending.append((window, executor.submit(self.fetch_window, *window)))
+                if len(pending) >= 2 * self.workers:
+                    window, future = pending.popleft()
+                    yield window, future.result()
+
+            while len(pending) > 0:
+                window, future = pending.popleft()
+                yield window, future.result()
+
+
+def check_against_stub_server():
+    """
+    Fetches a stub project of 2500 issues from a local stub Jira server and asserts that transient failures are retried
+    (one 503, and one 429 whose Retry-After outlasts the backoff), that requests are started no faster than the rate
+    limit, that a window bounded by a moved key is narrowed, and that every other key arrives once, in order
+    """
+    import random
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import unquote
+
+    requests_per_second = 20
+    retry_after = 1
+    request_times = []
+    window_requests = {}
+    lock = threading.Lock()
+
+    class StubJiraHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            query = unquote(self.path)
+            if '/rest/api/2/search' in query:
+                return self._respond(200, '{"issues": [{"key": "STUB-2500"}]}')
+
+            key_1, key_2 = (int(number) for number in re.findall(r'STUB-(\d+)', query, re.I))
+            with lock:
+                request_times.append(time.monotonic())
+                window_requests.setdefault((key_1, key_2), []).append(time.monotonic())
+                n_requests = len(window_requests[(key_1, key_2)])
+
+            if key_1 == 1001 and n_requests == 1:
+                return self._respond(503, 'unavailable')
+            if key_1 == 1501 and n_requests == 1:
+                return self._respond(429, 'slow down', {'Retry-After': str(retry_after)})
+            if key_2 == 2000:
+                return self._respond(400, 'An issue with key STUB-2000 is a moved issue')
+
+            time.sleep(random.random() / 10)
+            self._respond(200, f'<table><tbody><tr><td class="issuekey">STUB-{key_1}..STUB-{key_2}</td></tr>'
+                               f'</tbody></table>')
+
+        def _respond(self, status, body, headers=None):
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body.encode())
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubJiraHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        with JiraFetcher(f'http://127.0.0.1:{server.server_port}', 'stub', workers=4, backoff=0.05,
+                         requests_per_second=requests_per_second) as fetcher:
+            last_key_number = fetcher.latest_key_number()
+            fetched = list(fetcher.fetch_windows(key_windows(1, last_key_number, window_size=250)))
+    finally:
+        server.shutdown()
+
+    assert last_key_number == 2500
+    assert [window for window, _ in fetched] == key_windows(1, 2500, window_size=250), 'windows out of order'
+
+    # Every key but the moved one, once
+    fetched_ranges = [re.findall(r'STUB-(\d+)', html) for _, html in fetched]
+    fetched_keys = [key for key_1, key_2 in fetched_ranges for key in range(int(key_1), int(key_2) + 1)]
+    assert fetched_keys == [key for key in range(1, 2501) if key != 2000], 'keys missing or repeated'
+    assert (1751, 1999) in window_requests, 'the window ending on a moved key was not narrowed'
+
+    assert len(window_requests[(1001, 1250)]) == 2, '503 not retried once'
+    assert len(window_requests[(1501, 1750)]) == 2, '429 not retried once'
+    retry_wait = window_requests[(1501, 1750)][1] - window_requests[(1501, 1750)][0]
+    assert retry_wait >= retry_after * 0.95, f'Retry-After ignored: retried after {retry_wait:.2f}s'
+
+    # Allow for scheduling jitter between the fetcher starting a request and the server receiving it
+    request_gaps = [later - earlier for earlier, later in zip(request_times, request_times[1:])]
+    assert min(request_gaps) >= 0.5 / requests_per_second, f'rate limit exceeded: {min(request_gaps):.3f}s apart'
+    assert len(request_times) / (request_times[-1] - request_times[0]) <= requests_per_second * 1.1, \
+        'rate limit exceeded on average'
+
+    print(f'Stub server check passed: {len(request_times)} window requests, {len(fetched_keys)} keys')
+
+
+if __name__ == '__main__':
+    check_against_stub_server()
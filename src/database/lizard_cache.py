@@ -0,0 +1,238 @@
+"""
+On-disk cache of lizard results, addressed by file contents instead of by path or version.
+
+Each file's metrics are stored under its git blob SHA (and the lizard reader its name selects), and each package's
+totals under a hash of its files' keys. A file or package that did not change between two versions, or between two
+runs, is therefore never parsed again. The cache lives in root/etc/project_processing and is shared by all projects.
+
+Worker processes (version_workers, project_workers) share the cache database, which allows one writer at a time. New
+results are therefore committed one package at a time, never while lizard runs, so no process holds the write lock for
+long.
+"""
+import hashlib
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+import lizard
+from lizard_ext import auto_read
+from lizard_languages import get_reader_for
+
+from database.repo_version_walker import project_processing_path
+
+LIZARD_CACHE_PATH = os.path.join(project_processing_path, 'lizard_cache.db')
+# A cap on the number of entries, not on the cache's size. Entries are small and of about the same size (some 150 bytes
+# each, with their indexes), so the cache database stays under about 300 MB at the default cap. Evicted entries free
+# pages that later entries reuse; the file itself does not shrink
+LIZARD_CACHE_MAX_ENTRIES = 1000000
+
+create_cache_tables = [
+    'CREATE TABLE IF NOT EXISTS CACHE_INFO (name TEXT PRIMARY KEY, value TEXT)',
+    'CREATE TABLE IF NOT EXISTS FILE_METRICS (file_key TEXT PRIMARY KEY, nloc INTEGER, ccn INTEGER, '
+    'token_count INTEGER, last_used REAL)',
+    'CREATE TABLE IF NOT EXISTS PACKAGE_METRICS (package_key TEXT PRIMARY KEY, n_files INTEGER, nloc INTEGER, '
+    'ccn INTEGER, token_count INTEGER, last_used REAL)',
+    'CREATE INDEX IF NOT EXISTS FILE_METRICS_LAST_USED ON FILE_METRICS (last_used)',
+    'CREATE INDEX IF NOT EXISTS PACKAGE_METRICS_LAST_USED ON PACKAGE_METRICS (last_used)',
+]
+
+cache_counters = ['file_hits', 'file_misses', 'package_hits', 'package_misses']
+
+
+def lizard_file_key(blob_sha, file_name):
+    """
+    :return: the cache key of a file, or None if lizard has no reader for the file, and so would not analyze it
+    :rtype: str
+    """
+    reader = get_reader_for(file_name)
+    if reader is None:
+        return None
+    return f'{blob_sha}:{reader.__name__}'
+
+
+def read_cache_counters(cache_path=LIZARD_CACHE_PATH):
+    """
+    :return: the cache's lifetime hit and miss counts, by counter name. Diff two readings to get one run's counts
+    :rtype: dict
+    """
+    counters = dict.fromkeys(cache_counters, 0)
+    if not os.path.exists(cache_path):
+        return counters
+
+    with closing(sqlite3.connect(cache_path, timeout=60)) as conn:
+        conn.execute(create_cache_tables[0])
+        for name, value in conn.execute('SELECT name, value FROM CACHE_INFO'):
+            if name in counters:
+                counters[name] = int(value)
+        conn.commit()
+
+    return counters
+
+
+class LizardCache:
+    """
+    :param cache_path: the cache database
+    :type cache_path: str
+    :param max_entries: number of files, and of packages, kept once the cache is flushed. Least recently used entries
+        are evicted first. An entry count, not a size; see LIZARD_CACHE_MAX_ENTRIES
+    :type max_entries: int
+    """
+
+    def __init__(self, cache_path=LIZARD_CACHE_PATH, max_entries=LIZARD_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.analyzer = lizard.FileAnalyzer(lizard.get_extensions([]))
+        self.counters = dict.fromkeys(cache_counters, 0)
+        self.used_file_keys = set()
+        self.used_package_keys = set()
+        # Files analyzed for the current package, written along with its totals
+        self.new_file_rows = []
+
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        self.conn = sqlite3.connect(cache_path, timeout=60)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        for create_statement in create_cache_tables:
+            self.conn.execute(create_statement)
+
+        # Results from another lizard version may differ, so they are discarded
+        cached_version = self.conn.execute("SELECT value FROM CACHE_INFO WHERE name = 'lizard_version'").fetchone()
+        if cached_version is None or cached_version[0] != lizard.version:
+            self.conn.execute('DELETE FROM FILE_METRICS')
+            self.conn.execute('DELETE FROM PACKAGE_METRICS')
+            self.conn.execute("INSERT OR REPLACE INTO CACHE_INFO VALUES ('lizard_version', ?)", (lizard.version,))
+        self.conn.commit()
+
+    def package_metrics(self, package_files):
+        """
+        Sums lizard's metrics over a package's files, as `lizard.analyze` on the package folder would. Files with the
+        same contents are counted once, as lizard skips duplicate files
+
+        :param package_files: (file_key, file_name, read_source) of each file lizard reads in the package, where
+            read_source returns the file's source code. Keys come from `lizard_file_key`
+        :type package_files: list
+        :return: (number of files, nloc, cyclomatic complexity, token count)
+        :rtype: tuple
+        """
+        unique_files = {}
+        for file_key, file_name, read_source in sorted(package_files, key=lambda package_file: package_file[1]):
+            unique_files.setdefault(file_key.split(':')[0], (file_key, file_name, read_source))
+
+        package_key = hashlib.sha1('\n'.join(sorted(file[0] for file in unique_files.values())).encode()).hexdigest()
+        self.used_package_keys.add(package_key)
+
+        package_row = self.conn.execute(
+            'SELECT n_files, nloc, ccn, token_count FROM PACKAGE_METRICS WHERE package_key = ?', (package_key,)
+        ).fetchone()
+        if package_row is not None:
+            self.counters['package_hits'] = self.counters['package_hits'] + 1
+            return tuple(package_row)
+        self.counters['package_misses'] = self.counters['package_misses'] + 1
+
+        n_files = 0
+        n_loc = 0
+        cc = 0
+        n_tokens = 0
+        for file_key, file_name, read_source in unique_files.values():
+            file_nloc, file_cc, file_tokens = self.file_metrics(file_key, file_name, read_source)
+            n_files = n_files + 1
+            n_loc = n_loc + file_nloc
+            cc = cc + file_cc
+            n_tokens = n_tokens + file_tokens
+
+        self._write_new_results((package_key, n_files, n_loc, cc, n_tokens, time.time()))
+        return n_files, n_loc, cc, n_tokens
+
+    def _write_new_results(self, package_row):
+        """
+        Writes a package's totals and the files analyzed for it in one short transaction, committed right away
+        """
+        self.conn.executemany('INSERT OR REPLACE INTO FILE_METRICS VALUES (?, ?, ?, ?, ?)', self.new_file_rows)
+        self.conn.execute('INSERT OR REPLACE INTO PACKAGE_METRICS VALUES (?, ?, ?, ?, ?, ?)', package_row)
+        self.conn.commit()
+        self.new_file_rows = []
+
+    def file_metrics(self, file_key, file_name, read_source):
+        """
+        :return: (nloc, cyclomatic complexity, token count) of one file, analyzed only on a cache miss. New results
+            are written with the package's, by `package_metrics`
+        :rtype: tuple
+        """
+        self.used_file_keys.add(file_key)
+
+        file_row = self.conn.execute(
+            'SELECT nloc, ccn, token_count FROM FILE_METRICS WHERE file_key = ?', (file_key,)
+        ).fetchone()
+        if file_row is not None:
+            self.counters['file_hits'] = self.counters['file_hits'] + 1
+            return tuple(file_row)
+        self.counters['file_misses'] = self.counters['file_misses'] + 1
+
+        # Unreadable files count with no lines, as in lizard.FileAnalyzer
+        try:
+            file_info = self.analyzer.analyze_source_code(file_name, read_source())
+            file_metrics = (file_info.nloc, file_info.CCN, file_info.token_count)
+        except (UnicodeDecodeError, IOError):
+            file_metrics = (0, 0, 0)
+
+        self.new_file_rows.append((file_key, *file_metrics, time.time()))
+        return file_metrics
+
+    def flush(self):
+        """
+        Marks the entries used since the last flush as recently used, adds the hit and miss counts to the cache's
+        lifetime counters, and evicts the least recently used entries beyond max_entries (a number of rows per table,
+        not a size), in one transaction
+        """
+        now = time.time()
+        self.conn.executemany('UPDATE FILE_METRICS SET last_used = ? WHERE file_key = ?',
+                              ((now, file_key) for file_key in self.used_file_keys))
+        self.conn.executemany('UPDATE PACKAGE_METRICS SET last_used = ? WHERE package_key = ?',
+                              ((now, package_key) for package_key in self.used_package_keys))
+        self.used_file_keys = set()
+        self.used_package_keys = set()
+
+        for name, count in self.counters.items():
+            self.conn.execute("INSERT OR IGNORE INTO CACHE_INFO VALUES (?, '0')", (name,))
+            self.conn.execute('UPDATE CACHE_INFO SET value = CAST(value AS INTEGER) + ? WHERE name = ?', (count, name))
+        self.counters = dict.fromkeys(cache_counters, 0)
+
+        for table_name, key_column in (('FILE_METRICS', 'file_key'), ('PACKAGE_METRICS', 'package_key')):
+            self.conn.execute(f'DELETE FROM {table_name} WHERE {key_column} IN ('
+                              f'SELECT {key_column} FROM {table_name} ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                              (self.max_entries,))
+        self.conn.commit()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+def file_blob_sha(file_path):
+    """
+    :return: the git blob SHA of a file on disk, for files git does not track
+    :rtype: str
+    """
+    with open(file_path, 'rb') as file:
+        contents = file.read()
+    return hashlib.sha1(b'blob %d\0' % len(contents) + contents).hexdigest()
+
+
+def read_file_source(file_path):
+    """
+    :return: a function reading a file on disk the way lizard does
+    """
+    return lambda: auto_read(file_path)
+
+
+def cache_report(counters_at_start, counters_at_end):
+    """
+    :return: one line with the file and package hit rates between two readings of `read_cache_counters`
+    :rtype: str
+    """
+    counts = {name: counters_at_end[name] - counters_at_start[name] for name in cache_counters}
+
+    def hit_rate(kind):
+        lookups = counts[f'{kind}_hits'] + counts[f'{kind}_misses']
+        return f'{counts[f"{kind}_hits"]}/{lookups} ({counts[f"{kind}_hits"] / lookups:.1%})' if lookups else '0/0'
+
+    return f'lizard cache hits: packages {hit_rate("package")}, files {hit_rate("file")}'
@@ -1,28 +1,158 @@
+import os
 from abc import ABC, abstractmethod
+from itertools import islice
 
-from database.db_connection import get_db_connection
+from database.create_atdd import restore_indexes
+from database.db_connection import get_db_connection, drop_table_indexes, create_indexes, bump_data_version, \
+    end_bulk_load
 from database.db_file_backup import DbBackup
-from pydriller import Repository
+from database.rollups import refresh_rollups
+from database.commit_stream import CommitStream, END_LOOP_FLAG
+from database.watermark import Watermark
+from utils import resource_limits
+from utils.config_interface import get_processing_option
 
 RECORDS_UNTIL_CSV_SAVE = 200
-END_LOOP_FLAG = -1
+RECORDS_PER_LOAD_BATCH = 10000
+
+
+def iter_batches(records, batch_size):
+    """
+    Splits any iterable of records into lists of at most batch_size records, without materializing the iterable
+    """
+    records = iter(records)
+    while True:
+        batch = list(islice(records, batch_size))
+        if len(batch) == 0:
+            return
+        yield batch
 
 
 class Populator(ABC):
-    def __init__(self, project, db_action):
+    def __init__(self, project, db_action, incremental=False, bulk_load=False):
         self.project = project
-        self.conn, self.c = get_db_connection(use_regex=True)
+        self.bulk_load = bulk_load and db_action.is_load()
+        self.conn, self.c = get_db_connection(use_regex=True, bulk_load=self.bulk_load)
         self.db_action = db_action
+        self.incremental = incremental and self.supports_incremental and db_action.is_generate()
+        # Tables with a backup_schema are backed up as parquet when backup_format says so (configs)
+        if self.backup_schema is not None and get_processing_option('backup_format', 'csv') == 'parquet':
+            self.backup_ext = 'parquet'
+        # Parquet backups cannot be appended to, or checkpointed before they are closed (see db_file_backup.DbBackup)
+        if self.incremental and self.backup_ext == 'parquet':
+            print(f'{self.table_name} backups are parquet, which cannot be resumed; generating from scratch')
+            self.incremental = False
 
         # All Populator objects have a backup, but don't need to use it.
-        self.db_backup = DbBackup(
+        self.db_backup = self._open_backup('a' if self.incremental else 'w' if db_action.is_generate() else 'r')
+
+        # The watermark describes what is already in the backup being generated
+        self.watermark = Watermark(self.project.repo_name, self.table_name)
+        if db_action.is_generate():
+            if not self.incremental:
+                self.watermark.reset()
+                self.watermark.set('backup_file', os.path.basename(self.db_backup.backup_file))
+            elif self.watermark.get('backup_file') != os.path.basename(self.db_backup.backup_file):
+                print(f'No watermark matches the latest {self.table_name} backup; generating from scratch')
+                self._generate_from_scratch()
+            else:
+                # Rows saved after the watermark are regenerated, so they are cut from the backup first
+                self.db_backup.truncate(self.watermark.get('backup_size'))
+
+    backup_ext = ''
+
+    # (column name, type name) of each record field, for typed backup formats (backup_format: parquet). See
+    # db_file_backup.DbBackup
+    backup_schema = None
+
+    @property
+    def db_table_name(self):
+        """
+        Name of the database table LOAD inserts into. Overridden where it differs from table_name
+        """
+        return self.table_name
+
+    # Whether GENERATE can resume from the watermark and append to the latest backup
+    supports_incremental = False
+
+    # Tables whose data GENERATE reads from the database, and so must be LOADed first. See PopulatorManager.build
+    depends_on = ()
+
+    def _load_records(self, cmd, records):
+        """
+        Inserts an iterable of records (i.e, `db_backup.iter_records()`) in batches, so that memory use does not grow
+        with the size of the backup. Each batch is committed, unless in bulk-load mode, where the table is committed
+        once by `_run_load`
+
+        :param cmd: the parameterized INSERT statement. INSERT OR REPLACE for keyed tables (see create_atdd)
+        :type cmd: str
+        :param records: the records to insert
+        :return: the number of records inserted
+        :rtype: int
+        """
+        batch_size = get_processing_option('load_batch_size', RECORDS_PER_LOAD_BATCH)
+
+        n_records = 0
+        for batch in iter_batches(records, batch_size):
+            self.c.executemany(cmd, batch)
+            if not self.bulk_load:
+                self.conn.commit()
+            n_records = n_records + len(batch)
+
+        self.rows_loaded = self.rows_loaded + n_records
+        return n_records
+
+    rows_loaded = 0
+
+    def run_metrics(self):
+        """
+        :return: rows and bytes produced so far, as recorded by utils.run_metrics: backup rows and bytes on GENERATE,
+            rows inserted on LOAD
+        :rtype: dict
+        """
+        if self.db_action.is_load():
+            return {'rows': self.rows_loaded, 'bytes_written': 0}
+        return {'rows': self.db_backup.rows_saved, 'bytes_written': self.db_backup.bytes_written}
+
+    def _generate_from_scratch(self):
+        """
+        Gives up resuming: GENERATE writes a new backup, and the watermark starts over with it
+        """
+        self.incremental = False
+        self.db_backup = self._open_backup('w')
+        self.watermark.reset()
+        self.watermark.set('backup_file', os.path.basename(self.db_backup.backup_file))
+
+    def _open_backup(self, mode):
+        return DbBackup(
             project_id=self.project.repo_name,
             file_identifier=self.table_name,
             file_ext=self.backup_ext,
-            mode='w' if db_action.is_generate() else 'r'
+            mode=mode,
+            schema=self.backup_schema
         )
 
-    backup_ext = ''
+    def _save_watermark(self):
+        """
+        Saves the watermark once the records it describes are on disk: at the backup's next due checkpoint, and at the
+        latest once `finish` has closed the backup. An interrupted run then regenerates the records saved since the
+        last durable point instead of trusting a watermark ahead of its backup
+        """
+        if self.db_backup.checkpoint():
+            self._write_watermark()
+        else:
+            self.watermark_pending = True
+
+    watermark_pending = False
+
+    def _write_watermark(self):
+        """
+        Writes the watermark along with the backup's synced size, which a resumed run truncates the backup to
+        """
+        if self.db_backup.synced_size is not None:
+            self.watermark.set('backup_size', self.db_backup.synced_size)
+        self.watermark.save()
+        self.watermark_pending = False
 
     @abstractmethod
     def table_name(self):
@@ -34,13 +164,64 @@ class Populator(ABC):
     def _execute_load(self):
         pass
 
+    def _delete_project_rows(self):
+        """
+        Deletes the project's rows of db_table_name, which `_run_load` then loads again. Overridden for tables without
+        a project_name column
+        """
+        self.conn.execute(f'DELETE FROM {self.db_table_name} WHERE project_name = ?', (self.project.repo_name,))
+
     def execute(self, db_action):
         if db_action.is_generate():
             self._execute_generate()
         elif db_action.is_load():
+            self._run_load()
+
+        self.finish()
+
+    def _run_load(self):
+        """
+        Replaces the project's rows of the table with those of `_execute_load`, and rebuilds the project's rollups of
+        the table (database.rollups) before the final commit. The backup holds all of the project's rows (incremental
+        GENERATEs append to it), so the rows a previous LOAD inserted are deleted first, in the same transaction. In
+        bulk-load mode the table's indexes are dropped first and rebuilt once all rows are in, and the whole table is
+        loaded in one transaction. Indexes an interrupted bulk LOAD left dropped are created first
+        """
+        # SQLite allows a single writer, so LOADs running in other processes wait their turn
+        with resource_limits.acquire('database'):
+            # This table's indexes are rebuilt after the load instead, when its rows are in
+            restore_indexes(self.conn, skip_tables=[self.db_table_name] if self.bulk_load else [])
+            self.conn.commit()
+
+            # Committed along with the loaded rows, so a failed LOAD keeps the rows loaded before
+            self._delete_project_rows()
+
+            deferred_indexes = []
+            if self.bulk_load:
+                deferred_indexes = drop_table_indexes(self.conn, self.db_table_name)
+
             self._execute_load()
+            refresh_rollups(self.conn, self.db_table_name, [self.project.repo_name])
+            bump_data_version(self.conn)
+            self.conn.commit()
+
+            if self.bulk_load:
+                create_indexes(self.conn, deferred_indexes)
+                restore_indexes(self.conn)
+                self.conn.commit()
+
+    def finish(self):
+        """
+        Closes the backup, saving any watermark that was waiting on it, then commits and closes the populator's
+        database connection. Called once the populator has no work left
+        """
+        self.db_backup.close()
+        if self.watermark_pending:
+            self._write_watermark()
 
         self.conn.commit()
+        if self.bulk_load:
+            end_bulk_load(self.conn)
         self.conn.close()
 
 
@@ -48,18 +229,176 @@ class PerVersionPopulator(Populator):
     def table_name(self):
         pass
 
+    supports_incremental = True
+
+    @classmethod
+    def version_analyzer(cls, project):
+        """
+        Builds a populator that can only run `_generate_version_records`. Unlike a full populator it opens no database
+        connection, backup or watermark, so worker processes (RepoVersionWalker.walk_parallel) build one per version
+        cheaply. Call `close_analysis` once done with it
+
+        :param project: the project whose versions are analyzed
+        :type project: utils.project.Project
+        """
+        analyzer = cls.__new__(cls)
+        analyzer.project = project
+        return analyzer
+
+    def close_analysis(self):
+        """
+        Releases whatever `_generate_version_records` opened. Called by `finish`, and on version analyzers
+        """
+        pass
+
+    def finish(self):
+        self.close_analysis()
+        super().finish()
+
     # noinspection PyMethodOverriding
     def execute(self, repo_state=None):
         if self.db_action.is_generate():
-            self._execute_generate(repo_state)
+            if repo_state.version.id not in self.analyzed_versions():
+                self._execute_generate(repo_state)
         elif self.db_action.is_load():
-            self._execute_load()
+            self._run_load()
 
         self.conn.commit()
 
     # noinspection PyMethodOverriding
     def _execute_generate(self, repo_state):
-        pass
+        self.save_version_records(repo_state.version, self._generate_version_records(repo_state))
+
+    def analyzed_versions(self):
+        """
+        :return: ids of the versions already saved to the backup
+        :rtype: set
+        """
+        return set(self.watermark.get('versions', []))
+
+    def save_version_records(self, version, records):
+        """
+        Saves one version's records and marks the version as analyzed. Versions that are already in the backup are
+        ignored, so a resumed walk never duplicates them
+        """
+        if version.id in self.analyzed_versions():
+            return
+
+        self.db_backup.save_records(records)
+        self.watermark.set('versions', self.watermark.get('versions', []) + [version.id])
+        self._save_watermark()
+
+        self.previous_version_id = version.id
+        self.previous_version_records = records
+
+    # The records last saved, which a diff-mode walk carries forward for packages that did not change
+    previous_version_id = None
+    previous_version_records = None
+
+    def _previous_version_records(self, repo_state):
+        """
+        :return: the records saved for repo_state's previous version, when the walk is diff-based and this populator
+            saved that version itself; otherwise None, and the version must be analyzed in full
+        :rtype: list
+        """
+        if repo_state.previous_version is None or repo_state.previous_version.id != self.previous_version_id:
+            return None
+        return self.previous_version_records
+
+    def _generate_version_records(self, repo_state):
+        """
+        Analyzes one version of the repository. Must not touch the database or the backup, so that versions can be
+        analyzed in worker processes and saved afterwards by the parent. Only `project` and the class attributes are
+        set on a version analyzer, so state created in `__init__` is not available here
+
+        :param repo_state: the checked-out version to analyze
+        :type repo_state: database.repo_version_walker.RepoState
+        :return: the records to be saved to the backup for this version
+        :rtype: list
+        """
+        return []
 
     per_version_saving = True
 
+    # Whether the populator reads the checked-out version from disk. When no requested populator does, versions are
+    # read from the object database and never checked out
+    needs_working_tree = True
+
+
+class CommitStreamPopulator(Populator):
+    """
+    A Populator whose GENERATE step consumes the project's git history one commit at a time.
+
+    PopulatorManager subscribes every CommitStreamPopulator to one shared CommitStream, so the history is only
+    traversed once no matter how many commit-level tables are requested. Run standalone, a CommitStreamPopulator
+    walks the history by itself.
+    """
+    commit_stream_subscriber = True
+    supports_incremental = True
+
+    def table_name(self):
+        pass
+
+    def _execute_generate(self):
+        commit_stream = CommitStream(self.project.repo_path, self.project.branch)
+        commit_stream.subscribe(self)
+        commit_stream.walk()
+
+    def _start_commit_stream(self):
+        """
+        Called once before the first commit is handed to the populator
+        """
+        self.records = []
+        self.last_commit_hash = self.watermark.get('last_commit')
+        # Commits up to and including the watermarked commit are already in the backup
+        self.caught_up = self.last_commit_hash is None
+
+    def _receive_commit(self, commit):
+        """
+        Called by the CommitStream for every commit. Skips commits that are already in the backup (cheap, since
+        PyDriller only parses a commit's contents when they are accessed), and saves progress at commit boundaries so
+        that the watermark never points into the middle of a commit
+        """
+        if not self.caught_up:
+            self.caught_up = commit.hash == self.last_commit_hash
+            return
+
+        result = self._save_pydriller_commit(commit)
+        self.last_commit_hash = commit.hash
+
+        if len(self.records) >= RECORDS_UNTIL_CSV_SAVE or result == END_LOOP_FLAG:
+            self._checkpoint()
+
+        return result
+
+    def _save_pydriller_commit(self, commit):
+        """
+        Called for every commit in the stream. Returning END_LOOP_FLAG unsubscribes the populator from the stream
+
+        :param commit: the commit currently being traversed
+        :type commit: pydriller.Commit
+        """
+        pass
+
+    def _finish_commit_stream(self):
+        """
+        Called once the stream is exhausted, or once the populator unsubscribes. Saves any remaining records
+        """
+        if not self.caught_up:
+            print(f'{self.table_name}: watermarked commit {self.last_commit_hash} was not found in the history; '
+                  f'no commits were saved')
+
+        self._checkpoint()
+
+    def _checkpoint(self):
+        """
+        Saves the buffered records, then records the last commit they cover in the watermark
+        """
+        self.db_backup.save_records(self.records)
+        self.records = []
+
+        self.watermark.set('last_commit', self.last_commit_hash)
+        self._save_watermark()
+
+    def _buffer_record(self, record):
+        self.records.append(record)
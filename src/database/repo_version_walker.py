@@ -3,11 +3,16 @@ Gets all repo version information
 """
 
 import csv
+import multiprocessing
 import os
 import sys
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
 from database.db_connection import get_db_connection
-from utils import shell_interface
+from utils import run_metrics, shell_interface
+from utils.resource_limits import current_resource_semaphores, init_resource_limits
 from utils.top_level_paths import etc_directory
 from internal_configs import version_getter
 
@@ -16,8 +21,6 @@ project_processing_path = os.path.abspath(os.path.join(etc_directory, 'project_p
 
 maxInt = sys.maxsize
 
-hash_omit_list = []
-
 while True:
     # decrease the maxInt value by factor 10
     # as long as the OverflowError occurs.
@@ -30,14 +33,96 @@ while True:
 
 class RepoState:
     """
+    One checked-out version of a repository, with its java files and packages.
 
+    States yielded by a diff-mode walk (see :mod:`from_diff <RepoState.from_diff>`) also describe what changed since
+    the previously walked version; for other states, previous_state is None and every package is new.
     """
 
-    def __init__(self, project, repo_path, version):
+    def __init__(self, project, repo_path, version, java_files=None):
         self.project = project
+        self.repo_path = repo_path
         self.version = version
-        self.java_files = self.find_files(directory=repo_path, extension='java')
+        if java_files is None:
+            java_files = self.find_files(directory=repo_path, extension='java')
+        self.java_files = java_files
         self.packages = self.get_packages_from_files(self.java_files)
+        self._tree_blobs = None
+        self._tree_package_files = None
+
+        # False for states built from the object database, whose version is not checked out at repo_path
+        self.has_working_tree = True
+
+        self.previous_state = None
+        self.changed_files = None
+        self.added_packages = self.packages
+        self.modified_packages = set()
+        self.deleted_packages = set()
+
+    @classmethod
+    def from_diff(cls, previous_state, version):
+        """
+        Builds the state of version, already checked out in previous_state's repository, from the files git reports
+        as changed since previous_state's version. The working tree is not walked, so untracked files that appear
+        between versions are not picked up
+
+        :param previous_state: the state of the previously walked version
+        :type previous_state: RepoState
+        :param version: the version now checked out
+        :rtype: RepoState
+        """
+        repo_path = previous_state.repo_path
+        changes = shell_interface.diff_name_status(repo_path, previous_state.version.hash_id, version.hash_id)
+        changes = changes.split('\0')
+
+        java_files = set(previous_state.java_files)
+        changed_files = set()
+        for status, path in zip(changes[0::2], changes[1::2]):
+            file_path = os.path.join(repo_path, path).replace('\\', '/')
+            changed_files.add(file_path)
+
+            if file_path.lower().endswith('java'):
+                if status == 'D':
+                    java_files.discard(file_path)
+                else:
+                    java_files.add(file_path)
+
+        repo_state = cls(previous_state.project, repo_path, version, java_files=sorted(java_files))
+        repo_state.has_working_tree = previous_state.has_working_tree
+
+        # Only the directly previous state is kept, so states do not chain through the whole walk
+        previous_state.previous_state = None
+        repo_state.previous_state = previous_state
+        repo_state.changed_files = changed_files
+
+        changed_dirs = {os.path.dirname(file_path) for file_path in changed_files}
+        repo_state.added_packages = repo_state.packages - previous_state.packages
+        repo_state.deleted_packages = previous_state.packages - repo_state.packages
+        repo_state.modified_packages = (repo_state.packages & previous_state.packages) & changed_dirs
+
+        return repo_state
+
+    @classmethod
+    def from_tree(cls, project, repo_path, version):
+        """
+        Builds the state of version from the object database alone (`git ls-tree`), without checking it out. File
+        contents are then read with :mod:`GitObjectReader <database.git_objects.GitObjectReader>`
+
+        :rtype: RepoState
+        """
+        tree_blobs = cls._list_tree_blobs(repo_path, version.hash_id)
+        java_files = sorted(
+            os.path.join(repo_path, path).replace('\\', '/') for path in tree_blobs if path.lower().endswith('java')
+        )
+
+        repo_state = cls(project, repo_path, version, java_files=java_files)
+        repo_state._tree_blobs = tree_blobs
+        repo_state.has_working_tree = False
+        return repo_state
+
+    @property
+    def previous_version(self):
+        return self.previous_state.version if self.previous_state is not None else None
 
     def find_files(self, directory='.', extension=''):
         """
@@ -74,6 +159,45 @@ class RepoState:
 
         return package_paths
 
+    def tree_blobs(self):
+        """
+        Maps every file of the version, by path relative to the repository root, to its git blob SHA. Listed once,
+        from the object database, so unchanged files can be recognized without reading them
+
+        :rtype: dict
+        """
+        if self._tree_blobs is None:
+            self._tree_blobs = self._list_tree_blobs(self.repo_path, self.version.hash_id)
+
+        return self._tree_blobs
+
+    def tree_package_files(self, package_path):
+        """
+        :param package_path: a package, as in `packages`
+        :return: (file path, blob SHA) of every file directly in the package, from the object database
+        :rtype: list
+        """
+        if self._tree_package_files is None:
+            self._tree_package_files = defaultdict(list)
+            for path, blob_sha in self.tree_blobs().items():
+                file_path = os.path.join(self.repo_path, path).replace('\\', '/')
+                self._tree_package_files[os.path.dirname(file_path)].append((file_path, blob_sha))
+
+        return self._tree_package_files.get(package_path, [])
+
+    @staticmethod
+    def _list_tree_blobs(repo_path, commit_hash):
+        tree_blobs = {}
+        for entry in shell_interface.list_tree(repo_path, commit_hash).split('\0'):
+            if entry == '':
+                continue
+            object_info, path = entry.split('\t', 1)
+            _, object_type, object_sha = object_info.split(' ')
+            if object_type == 'blob':
+                tree_blobs[path] = object_sha
+
+        return tree_blobs
+
     def identify_macro_packages(self):
         java_files = self.java_files
 
@@ -93,8 +217,16 @@ class RepoState:
 
 
 class RepoVersionWalker:
-    def __init__(self, project):
+    def __init__(self, project, omit_versions=None, walk_mode='full'):
+        """
+        :param omit_versions: ids of versions that need no analysis, i.e, versions every requested populator saved
+        :param walk_mode: 'full' walks the checkout at every version; 'diff' derives each version's files from the
+            git diff against the previously walked version (see :mod:`from_diff <RepoState.from_diff>`)
+        :type walk_mode: str
+        """
         self.project = project
+        self.omit_versions = set(omit_versions) if omit_versions else set()
+        self.walk_mode = walk_mode
 
         self.processing_path = os.path.abspath(os.path.join(project_processing_path, f'{project.repo_name}_processing'))
         self.temp_repo = os.path.abspath(os.path.join(self.processing_path, f'temp_repo'))
@@ -127,25 +259,110 @@ class RepoVersionWalker:
         :type project: utils.project.Project
         """
         print(f'Cloning temporary repo from {project.github_link}...')
-        os.system(f'git clone  -v {project.github_link} {self.repo_path}')
-        os.system(f'git -C {self.repo_path} config core.longpaths true')
+        shell_interface.clone_repository(project.github_link, self.repo_path, long_paths=True)
 
-    def walk(self):
+    def walk(self, checkout=True):
         """
-        Walks through all versions by using the :mod:`checkout_commit <RepoState._checkout_commit>` method
+        Walks through all versions by using the :mod:`checkout_commit <RepoState._checkout_commit>` method.
+        In 'diff' walk mode, every state after the first also carries the packages added, modified and deleted since
+        the previously walked version
 
+        :param checkout: whether versions are checked out. Without a checkout, states are read from the object
+            database (see :mod:`from_tree <RepoState.from_tree>`), for populators that need no working tree
+        :type checkout: bool
         :return: The repo state for a specific project at different versions
         """
 
+        previous_state = None
         for version_i, version in enumerate(self.versions):
-            if version.id in hash_omit_list:
+            if version.id in self.omit_versions:
                 continue
 
-            print(f'Moving head to {version.hash_id}...')
+            with run_metrics.measure('version_state', self.project.repo_name, version=version.id,
+                                     walk_mode=self.walk_mode, checkout=checkout):
+                if checkout:
+                    print(f'Moving head to {version.hash_id}...')
+                    shell_interface.checkout_commit(self.repo_path, version.hash_id)  # '7f0336380f9c1061834b41c671917e53a18332e0'
+
+                if self.walk_mode == 'diff' and previous_state is not None:
+                    repo_state = RepoState.from_diff(previous_state, version)
+                elif checkout:
+                    repo_state = RepoState(self.project, self.repo_path, version)
+                else:
+                    repo_state = RepoState.from_tree(self.project, self.repo_path, version)
+
+            previous_state = repo_state
+            yield repo_state
+
+    def walk_parallel(self, populator_classes, n_workers, analyzed_versions=None):
+        """
+        Analyzes versions across n_workers processes. Each worker checks versions out into its own git worktree of the
+        temporary clone, and runs the `_generate_version_records` of every populator that has not yet saved the
+        version. The worktrees are removed once the walk ends, however it ends.
+
+        Results are yielded in version order, regardless of which worker finishes first, so backups are written in
+        the same order as :mod:`walk <RepoVersionWalker.walk>` would write them.
+
+        :param populator_classes: the PerVersionPopulator classes to run on each version
+        :type populator_classes: list
+        :param n_workers: number of worker processes (and worktrees)
+        :type n_workers: int
+        :param analyzed_versions: ids of the versions each populator already saved (PerVersionPopulator
+            .analyzed_versions), in populator_classes order. Those populators are not run again on them
+        :type analyzed_versions: list[set]
+        :return: (version, list of records per populator class, in populator_classes order). Records are None for
+            populators that skipped the version
+        """
+        if analyzed_versions is None:
+            analyzed_versions = [set() for _ in populator_classes]
+
+        # The versions to analyze, and whether each populator runs on them
+        versions = []
+        versions_runs = []
+        for version in self.versions:
+            runs = [version.id not in populator_analyzed_versions for populator_analyzed_versions in analyzed_versions]
+            if version.id not in self.omit_versions and any(runs):
+                versions.append(version)
+                versions_runs.append(runs)
+        if len(versions) <= 0:
+            return
+
+        n_workers = min(n_workers, len(versions))
+        worktree_paths = self._make_worktrees(n_workers, versions[0].hash_id)
+        try:
+            worktree_queue = multiprocessing.Queue()
+            for worktree_path in worktree_paths:
+                worktree_queue.put(worktree_path)
+
+            analyze = partial(_analyze_version, self.project, populator_classes=populator_classes)
+            with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_version_worker,
+                                     initargs=(worktree_queue, current_resource_semaphores())) as executor:
+                for version, version_records in zip(versions, executor.map(analyze, versions, versions_runs)):
+                    yield version, version_records
+        finally:
+            self._remove_worktrees(worktree_paths)
+
+    def _make_worktrees(self, n_worktrees, commit_hash):
+        """
+        Adds one git worktree per worker. The last path component stays the repo name, as populators locate
+        local package paths by it. Worktrees left behind by an interrupted run are pruned first, so their paths can be
+        added again
+        """
+        shell_interface.prune_worktrees(self.repo_path)
+
+        worktree_paths = []
+        for i in range(n_worktrees):
+            worktree_path = os.path.join(self.temp_repo, 'worktrees', str(i), self.project.repo_name)
+            os.makedirs(os.path.dirname(worktree_path), exist_ok=True)
+            shell_interface.add_worktree(self.repo_path, worktree_path, commit_hash)
+            worktree_paths.append(worktree_path)
 
-            shell_interface.checkout_commit(self.repo_path, version.hash_id)  # '7f0336380f9c1061834b41c671917e53a18332e0'
+        return worktree_paths
 
-            yield RepoState(self.project, self.repo_path, version)
+    def _remove_worktrees(self, worktree_paths):
+        for worktree_path in worktree_paths:
+            shell_interface.remove_worktree(self.repo_path, worktree_path)
+        shell_interface.prune_worktrees(self.repo_path)
 
     def cleanup(self):
         """
@@ -155,12 +372,56 @@ class RepoVersionWalker:
         pass
 
 
+# The worktree owned by this worker process; assigned once by _init_version_worker
+_worker_repo_path = None
+
+
+def _init_version_worker(worktree_queue, semaphores):
+    """
+    Claims a worktree for this worker process, and installs the resource semaphores of the process that started the
+    walk, so lizard and JVM runs in version workers count towards the same limits
+    """
+    global _worker_repo_path
+    _worker_repo_path = worktree_queue.get()
+    init_resource_limits(semaphores)
+
+
+def _analyze_version(project, version, runs, populator_classes):
+    """
+    Runs in a worker process of :mod:`walk_parallel <RepoVersionWalker.walk_parallel>`. Checks the version out into
+    the worker's worktree and returns the records of every populator whose runs flag is set, None for the others.
+    Populators are built as version analyzers (see PerVersionPopulator.version_analyzer), without a database
+    connection, backup or watermark
+    """
+    if any(populator_class.needs_working_tree for populator_class, run in zip(populator_classes, runs) if run):
+        print(f'Moving head to {version.hash_id} in {_worker_repo_path}...')
+        shell_interface.checkout_commit(_worker_repo_path, version.hash_id)
+        repo_state = RepoState(project, _worker_repo_path, version)
+    else:
+        repo_state = RepoState.from_tree(project, _worker_repo_path, version)
+
+    version_records = []
+    for populator_class, run in zip(populator_classes, runs):
+        if not run:
+            version_records.append(None)
+            continue
+
+        with run_metrics.measure('version', populator_class.table_name, project=project.repo_name,
+                                 version=version.id) as metric:
+            analyzer = populator_class.version_analyzer(project)
+            try:
+                version_records.append(analyzer._generate_version_records(repo_state))
+            finally:
+                analyzer.close_analysis()
+            metric['rows'] = len(version_records[-1])
+
+    return version_records
+
+
 if __name__ == '__main__':
     conn, c = get_db_connection()
 
 
-    # omit_list is used in case progress gets interrupted, and needs to be restarted without re-analyzing certain commits
-
     # save_smells_info(projects_with_jira['ambari'])
 
     # for project in projects_with_jira.values():
@@ -0,0 +1,97 @@
+"""
+Materialized rollups of the largest tables, so analysis queries (utils.project_sql) select pre-aggregated rows instead
+of pivoting millions of rows in pandas on every call.
+
+Each rollup is rebuilt from its source table for the project whose rows were just LOADed, in the same transaction as
+the LOAD (see Populator._run_load). Databases migrated to schema version 3 build them from the rows already loaded.
+
+- DESIGNITE_SMELLS_WIDE: number of smells of each type (all_smell_types) per package-version
+- REFACTORING_MINER_WIDE: number of refactorings of each type (all_refactoring_types) per commit and package
+- STATIC_METRICS_PV: STATIC_METRICS with package names relative to the project folder
+"""
+from internal_configs import all_refactoring_types, all_smell_types
+
+pkg_metric_columns = ['pkg_files', 'pkg_loc', 'pkg_tokens', 'pkg_cc', 'pkg_average_loc', 'pkg_average_cc',
+                      'pkg_average_tokens']
+
+
+def type_count_select(source_table, group_columns, type_column, all_types, conditions):
+    """
+    :return: a SELECT counting the source's rows of each type (all_types) per group, one column per type. Types are
+        matched as rq1_helpers.standardize_columns_by_list names them (lower case, spaces as underscores), and types
+        outside all_types are not counted. Rows are first grouped by type, so each row's type is normalized once
+    :rtype: str
+    """
+    group_list = ', '.join(group_columns)
+    type_counts = ', '.join(f'SUM(CASE WHEN type_name = \'{type_name}\' THEN n ELSE 0 END) AS "{type_name}"'
+                            for type_name in all_types)
+    return (f'SELECT {group_list}, {type_counts} FROM ('
+            f"SELECT {group_list}, REPLACE(LOWER({type_column}), ' ', '_') AS type_name, COUNT(*) AS n "
+            f'FROM {source_table} WHERE {conditions} GROUP BY {group_list}, type_name) '
+            f'GROUP BY {group_list}')
+
+
+def type_sum_columns(all_types, table_name):
+    """
+    :return: one `SUM(<table>."<type>") AS "<type>"` column per type, to add up rollup rows
+    :rtype: str
+    """
+    return ', '.join(f'SUM({table_name}."{type_name}") AS "{type_name}"' for type_name in all_types)
+
+
+# Rollup table -> (source table, SELECT building the rollup's rows of the projects matching {project_filter})
+rollup_definitions = {
+    'DESIGNITE_SMELLS_WIDE': (
+        'DESIGNITE_SMELLS',
+        type_count_select('DESIGNITE_SMELLS', ['project_name', 'version', 'package'], 'smell', all_smell_types,
+                          '{project_filter} AND package IS NOT NULL AND version IS NOT NULL')
+    ),
+    'REFACTORING_MINER_WIDE': (
+        'REFACTORING_MINER',
+        type_count_select('REFACTORING_MINER', ['project_name', 'commit_hash', 'package'], 'refactoring_type',
+                          all_refactoring_types, '{project_filter}')
+    ),
+    'STATIC_METRICS_PV': (
+        'STATIC_METRICS',
+        'SELECT project_name, SUBSTR(package, INSTR(package, project_name) + LENGTH(project_name) + 1), version, '
+        f'{", ".join(pkg_metric_columns)} FROM STATIC_METRICS WHERE {{project_filter}}'
+    ),
+}
+
+
+def _existing_tables(conn):
+    return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+
+def rollups_available(conn):
+    """
+    :return: whether the database has every rollup table, i.e. was created or migrated at schema version 3 or later
+    :rtype: bool
+    """
+    return rollup_definitions.keys() <= _existing_tables(conn)
+
+
+def refresh_rollups(conn, source_table, project_names=None):
+    """
+    Rebuilds the rollups of a source table, for some projects or for all of them. Does not commit, so the rollups
+    change in the same transaction as their source. Rollup tables missing from the database (older schema) are skipped
+
+    :param source_table: the table whose rows changed, i.e. DESIGNITE_SMELLS
+    :type source_table: str
+    :param project_names: the projects to rebuild, or None for every project
+    :type project_names: list[str]
+    """
+    existing_tables = _existing_tables(conn)
+    for rollup_table, (rollup_source, select_rows) in rollup_definitions.items():
+        if rollup_source != source_table or rollup_table not in existing_tables:
+            continue
+
+        if project_names is None:
+            conn.execute(f'DELETE FROM {rollup_table}')
+            conn.execute(f'INSERT INTO {rollup_table} {select_rows.format(project_filter="1")}')
+            continue
+
+        project_filter = f'project_name IN ({", ".join("?" for _ in project_names)})'
+        conn.execute(f'DELETE FROM {rollup_table} WHERE {project_filter}', list(project_names))
+        conn.execute(f'INSERT INTO {rollup_table} {select_rows.format(project_filter=project_filter)}',
+                     list(project_names))
@@ -0,0 +1,54 @@
+"""
+Records how far a populator's GENERATE step got, so that an incremental rerun only processes new data.
+
+Each (project, table) pair has one small JSON file in root/database/db_watermarks. A watermark always describes the
+backup file it was written alongside; GENERATE appends to that backup only while the two still match.
+"""
+import json
+import os
+
+from utils.top_level_paths import database_directory
+
+WATERMARK_DIR = os.path.join(database_directory, 'db_watermarks')
+
+
+class Watermark:
+    """
+    Per-project, per-table progress marker (i.e, the last commit hash saved, or the versions analyzed)
+
+    :param project_id: name of the project
+    :type project_id: str
+    :param table_name: name of the table the populator fills
+    :type table_name: str
+    """
+
+    def __init__(self, project_id, table_name):
+        self.file_path = os.path.join(WATERMARK_DIR, f'{project_id}_{table_name}.json')
+        self.values = {}
+
+        if os.path.exists(self.file_path):
+            with open(self.file_path, 'r') as file:
+                self.values = json.load(file)
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def set(self, key, value):
+        self.values[key] = value
+
+    def reset(self):
+        """
+        Forgets all progress. Nothing is written until the next `save`
+        """
+        self.values = {}
+
+    def save(self):
+        """
+        Writes the watermark to disk. The file is replaced atomically, so a crash never leaves a partial watermark
+        """
+        os.makedirs(WATERMARK_DIR, exist_ok=True)
+
+        temp_path = f'{self.file_path}.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(self.values, file, indent=2)
+        os.replace(temp_path, self.file_path)
@@ -5,20 +5,58 @@ will save the information to csv files, or load existing csv files into the data
 `db_populator_manger`
 """
 import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+from database.backup_manifest import BackupManifest, format_backups
 from database.db_action import DbAction
+from database.db_file_backup import OUTPUT_DIR
 from database.db_populator_manager import PopulatorManager
-from utils.config_interface import get_database_configs, get_all_projects
-from database.create_atdd import create_atdd
-
-
-def process_projects(db_action, targeted_tables, projects):
-    for project in projects:
-        if project.repo_name != 'test':
-            project.assert_local_repository(update_if_exists=True)
-
-        populator_runner = PopulatorManager()
+from utils.config_interface import get_database_configs, get_all_projects, get_processing_option
+from database.create_atdd import create_atdd, migrate_atdd
+from utils import run_metrics
+from utils.resource_limits import create_resource_semaphores, init_resource_limits
+
+
+def process_project(db_action, targeted_tables, project, incremental=False):
+    """
+    :param db_action: GENERATE or LOAD the targeted tables, or None to GENERATE and LOAD them in dependency order
+    :type db_action: DbAction
+    """
+    if project.repo_name != 'test':
+        project.assert_local_repository(update_if_exists=True)
+
+    populator_runner = PopulatorManager(incremental=incremental)
+    if db_action is None:
+        populator_runner.build(project, targeted_tables)
+    else:
         populator_runner.execute(project, targeted_tables, db_action)
+    return project.repo_name
+
+
+def process_projects(db_action, targeted_tables, projects, incremental=False):
+    """
+    GENERATE handles up to project_workers projects at once, each in its own process and writing only its own
+    backups. Network, CPU and JVM use is bounded across those processes by resource_limits. LOAD always handles one
+    project at a time, as SQLite allows a single writer. Without a db_action, each project's tables are GENERATEd and
+    LOADed (see PopulatorManager.build); their LOADs still take turns through the 'database' resource
+    """
+    projects = list(projects)
+    project_workers = min(get_processing_option('project_workers', 1), len(projects))
+
+    if (db_action is not None and db_action.is_load()) or project_workers <= 1:
+        for project in projects:
+            process_project(db_action, targeted_tables, project, incremental=incremental)
+        return
+
+    semaphores = create_resource_semaphores(get_processing_option('resource_limits'))
+    with ProcessPoolExecutor(max_workers=project_workers, initializer=init_resource_limits,
+                             initargs=(semaphores,)) as executor:
+        futures = [
+            executor.submit(process_project, db_action, targeted_tables, project, incremental)
+            for project in projects
+        ]
+        for future in as_completed(futures):
+            print(f'Finished {future.result()}')
 
 
 def auto_populate(specific_project=None):
@@ -27,39 +65,41 @@ def auto_populate(specific_project=None):
     else:
         all_projects = get_all_projects().values()
 
-    process_projects(DbAction(DbAction.GENERATE), [
-        'PROJECTS',
-        'PROJECT_VERSIONS',
-        'GIT_COMMITS',
-        'GIT_COMMIT_VERSION',
-        'GIT_COMMIT_CHANGES',
-        # 'GIT_COMMIT_JIRA',
-        'JIRA_ISSUES',
-        'REFACTORING_MINER',
-        'DESIGNITE_SMELLS',
-        'STATIC_METRICS'
-    ], all_projects)
+    incremental = get_processing_option('incremental', False)
 
-    process_projects(DbAction(DbAction.LOAD), [
+    # Tables are GENERATEd and LOADed in dependency order (i.e, GIT_COMMIT_JIRA after GIT_COMMITS and JIRA_ISSUES)
+    process_projects(None, [
         'PROJECTS',
         'PROJECT_VERSIONS',
         'GIT_COMMITS',
         'GIT_COMMIT_VERSION',
         'GIT_COMMIT_CHANGES',
-        # 'GIT_COMMIT_JIRA',
+        'GIT_COMMIT_JIRA',
         'JIRA_ISSUES',
         'REFACTORING_MINER',
         'DESIGNITE_SMELLS',
         'STATIC_METRICS'
-    ], all_projects)
+    ], all_projects, incremental=incremental)
 
-    process_projects(DbAction(DbAction.GENERATE), ['GIT_COMMIT_JIRA'], all_projects)
-    process_projects(DbAction(DbAction.LOAD), ['GIT_COMMIT_JIRA'], all_projects)
+
+def list_backups(project_name=None, table_names=None):
+    """
+    Prints the backups in the backup manifest, of one project or of all, optionally only of some tables
+    """
+    backups = BackupManifest(OUTPUT_DIR).backups(project_name)
+    if table_names is not None:
+        backups = [backup for backup in backups if backup['table_name'] in table_names]
+    print(format_backups(backups))
 
 
 def process_by_config():
     db_action, targeted_tables, projects_to_process = get_database_configs()
-    process_projects(db_action, targeted_tables, projects_to_process.values())
+    if db_action.is_load():
+        for project in projects_to_process.values():
+            list_backups(project.repo_name, targeted_tables)
+
+    process_projects(db_action, targeted_tables, projects_to_process.values(),
+                     incremental=get_processing_option('incremental', False))
 
 
 class CmdLineDriver:
@@ -83,14 +123,30 @@ class CmdLineDriver:
                 project = argv[2]
             except IndexError:
                 pass
-            auto_populate(specific_project=project)
+            self.run_with_metrics(auto_populate, specific_project=project)
         elif flag == '-config':
-            process_by_config()
+            self.run_with_metrics(process_by_config)
         elif flag == 'create_db':
             create_atdd()
+        elif flag == 'migrate_db':
+            migrate_atdd()
+        elif flag == '-list_backups':
+            list_backups(argv[2] if n > 2 else None)
         else:
             self.help()
 
+    @staticmethod
+    def run_with_metrics(process, *args, **kwargs):
+        """
+        Runs a processing function with a fresh run metrics file, then prints the run's summary
+        """
+        metrics_file = run_metrics.start_run()
+        try:
+            process(*args, **kwargs)
+        finally:
+            print(run_metrics.summary(metrics_file))
+            print(f'Run metrics: {metrics_file}')
+
     @staticmethod
     def help():
         """
@@ -105,7 +161,11 @@ class CmdLineDriver:
             '      - WARNING: Read database_processing yaml before choosing this option\n'
             '      - Performs data operations specified in root/configs/database_processing.yaml\n'
             ' > python src/main.py -create_db\n'
-            '      -Creates an empty ATDD at root/database/augmented_tdd.db'
+            '      -Creates an empty ATDD at root/database/augmented_tdd.db\n'
+            ' > python src/main.py migrate_db\n'
+            '      -Upgrades an existing root/database/augmented_tdd.db to the current schema, keeping its data\n'
+            ' > python src/main.py -list_backups <project>\n'
+            '      -Lists the backup files of all projects (or a specified project name) in root/database/db_loadfiles'
         )
 
 
@@ -36,6 +36,19 @@ def get_database_configs():
     return database_action, targeted_tables, projects_to_process
 
 
+def get_processing_option(option_name, default=None):
+    """
+    Reads a single optional setting from configs/database_processing.yaml, such as the number of worker processes
+
+    Returns the following:
+        option: The declared value, or default if the option is not declared
+    """
+    with open(configs_directory + '/database_processing.yaml', 'r') as file:
+        database_processing_declarations = yaml.safe_load(file)
+
+    return database_processing_declarations.get(option_name, default)
+
+
 def get_tool_path(desired_tool):
     """
     The calling function requests a particular tool by name. This function extracts the requested tool data from
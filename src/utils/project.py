@@ -1,14 +1,182 @@
+import functools
+import glob
+import hashlib
 import os
+from abc import ABC, abstractmethod
+from collections import OrderedDict
 
 import pandas as pd
-from database.db_connection import get_db_connection
-from utils.rq1_helpers import standardize_refactoring_columns, standardize_smells_columns
-from utils.top_level_paths import repo_directory
-from utils import shell_interface
-from internal_configs import all_smell_types
+from database.db_connection import get_db_connection, read_data_stamp
+from utils.top_level_paths import repo_directory, etc_directory
+from utils import project_sql, shell_interface
+
+# Cached query results of each project are evicted, least recently used first, beyond this many bytes
+QUERY_CACHE_MAX_BYTES = 1024 ** 3
+# Where query results are persisted, when Project.persist_query_results is set
+QUERY_CACHE_DIR = os.path.join(etc_directory, 'query_cache')
+
+
+def _result_size(result):
+    """
+    :return: approximate memory use of a query result, in bytes
+    :rtype: int
+    """
+    if isinstance(result, pd.DataFrame):
+        return int(result.memory_usage(index=True, deep=True).sum())
+    return sum(len(str(value)) for value in result) if isinstance(result, list) else 0
+
+
+def _copy_result(result):
+    # Callers may modify what they are given, which must not change the cached result
+    return result.copy() if isinstance(result, (pd.DataFrame, list)) else result
+
+
+def cached_query(method):
+    """
+    Memoizes a Project query by its arguments and the database's data stamp (database.db_connection.read_data_stamp):
+    its data version, which every LOAD bumps, and a random data id, so results of a recreated or swapped database are
+    never reused. Results are kept in an LRU cache bounded by QUERY_CACHE_MAX_BYTES and, when
+    Project.persist_query_results is set, persisted as Parquet in QUERY_CACHE_DIR so later sessions reuse them.
+    Databases without a data stamp (older schemas; see create_atdd.migrate_atdd) are never cached
+    """
+
+    @functools.wraps(method)
+    def cached_method(self, *args, **kwargs):
+        data_stamp = read_data_stamp(self.connection)
+        if data_stamp is None:
+            return method(self, *args, **kwargs)
+
+        cache_key = (method.__name__, args, tuple(sorted(kwargs.items())))
+        cached = self._cached_sql_results.get(cache_key)
+        if cached is not None and cached[0] == data_stamp:
+            self._cached_sql_results.move_to_end(cache_key)
+            return _copy_result(cached[1])
+
+        result = self._read_persisted_result(cache_key, data_stamp)
+        if result is None:
+            result = method(self, *args, **kwargs)
+            self._persist_result(cache_key, data_stamp, result)
+
+        self._cache_result(cache_key, data_stamp, result)
+        return _copy_result(result)
+
+    return cached_method
+
+
+class CachedQueries(ABC):
+    """
+    Database connection and query result cache shared by Project and ProjectSet; see cached_query
+
+    :param use_test_db: whether queries read the test database
+    :type use_test_db: bool
+    """
+    _cached_sql_results = None
+    _cached_sql_bytes = 0
+    _conn = None
+
+    # Whether cached query results are also persisted to disk (see cached_query)
+    persist_query_results = False
+
+    def __init__(self, use_test_db=False):
+        self.use_test_db = use_test_db
+
+        self._cached_sql_results = OrderedDict()
+        self._cached_sql_bytes = 0
+        self._conn = None
+
+    @property
+    @abstractmethod
+    def query_cache_name(self):
+        """
+        Name of the folder in QUERY_CACHE_DIR where results are persisted
+        """
+        pass
+
+    @property
+    def connection(self):
+        """
+        The database connection, opened on first use and shared by every query
+        """
+        if self._conn is None:
+            self._conn, _ = get_db_connection(use_regex=True, test_db=self.use_test_db)
+        return self._conn
+
+    def __getstate__(self):
+        # Connections cannot be pickled, and cached results would make every copy sent to a worker process large
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        state['_cached_sql_results'] = OrderedDict()
+        state['_cached_sql_bytes'] = 0
+        return state
+
+    def clear_query_cache(self):
+        self._cached_sql_results = OrderedDict()
+        self._cached_sql_bytes = 0
+
+    def close(self):
+        """
+        Closes the database connection. The next query opens a new one, i.e. to the database db_connection points at
+        by then
+        """
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _cache_result(self, cache_key, data_stamp, result):
+        """
+        Keeps a result in the in-memory cache, evicting least recently used results beyond QUERY_CACHE_MAX_BYTES
+        """
+        previous = self._cached_sql_results.pop(cache_key, None)
+        if previous is not None:
+            self._cached_sql_bytes = self._cached_sql_bytes - previous[2]
+
+        size = _result_size(result)
+        self._cached_sql_results[cache_key] = (data_stamp, result, size)
+        self._cached_sql_bytes = self._cached_sql_bytes + size
+
+        while self._cached_sql_bytes > QUERY_CACHE_MAX_BYTES and len(self._cached_sql_results) > 1:
+            _, (_, _, evicted_size) = self._cached_sql_results.popitem(last=False)
+            self._cached_sql_bytes = self._cached_sql_bytes - evicted_size
+
+    def _persisted_result_prefix(self, cache_key):
+        database_name = 'test' if self.use_test_db else 'atdd'
+        key_hash = hashlib.sha1(repr(cache_key[1:]).encode()).hexdigest()[:16]
+        return os.path.join(QUERY_CACHE_DIR, f'{database_name}_{self.query_cache_name}', f'{cache_key[0]}_{key_hash}_')
+
+    def _read_persisted_result(self, cache_key, data_stamp):
+        """
+        :return: the result persisted for this data stamp, or None
+        :rtype: pandas.DataFrame
+        """
+        file_path = f'{self._persisted_result_prefix(cache_key)}{data_stamp}.parquet'
+        if not self.persist_query_results or not os.path.exists(file_path):
+            return None
+        return pd.read_parquet(file_path)
+
+    def _persist_result(self, cache_key, data_stamp, result):
+        """
+        Saves a DataFrame result for this data stamp, replacing results of older stamps. Results Parquet cannot
+        hold (i.e, columns of mixed types) stay in memory only
+        """
+        if not self.persist_query_results or not isinstance(result, pd.DataFrame):
+            return
+
+        prefix = self._persisted_result_prefix(cache_key)
+        os.makedirs(os.path.dirname(prefix), exist_ok=True)
+        for stale_file_path in glob.glob(f'{glob.escape(prefix)}*.parquet'):
+            os.remove(stale_file_path)
+
+        file_path = f'{prefix}{data_stamp}.parquet'
+        try:
+            result.to_parquet(f'{file_path}.tmp')
+            os.replace(f'{file_path}.tmp', file_path)
+        except (ValueError, TypeError, ImportError) as e:
+            print(f'Not persisting {cache_key[0]} of {self.query_cache_name}: {e}')
+            if os.path.exists(f'{file_path}.tmp'):
+                os.remove(f'{file_path}.tmp')
 
 
-class Project:
+class Project(CachedQueries):
     github_owner = '',
     repo_name = '',
     repo_path = '',
@@ -16,8 +184,6 @@ class Project:
     github_link = '',
     jira_link = '',
 
-    _cached_sql_results = None
-
     def __init__(self, github_owner, repo_name, branch, github_link, jira_link=''):
         """
         Multifunction class. Can create a project, or get information for a project, assuming that it is in the database
@@ -40,9 +206,11 @@ class Project:
         self.github_link = github_link
         self.jira_link = jira_link
 
-        self._cached_sql_results = {}
-        
-        self.use_test_db = self.repo_name == 'test'
+        super().__init__(use_test_db=self.repo_name == 'test')
+
+    @property
+    def query_cache_name(self):
+        return self.repo_name
 
     def dump(self):
         """
@@ -80,6 +248,7 @@ class Project:
         else:
             shell_interface.clone_repository(self.github_link, self.repo_path)
 
+    @cached_query
     def get_version_history(self, order='oldest_to_newest'):
         """
         Uses database to select all versions of project
@@ -89,7 +258,7 @@ class Project:
         :return: list of orderings
         :rtype: list
         """
-        conn, cursor = get_db_connection(test_db=self.use_test_db)
+        conn = self.connection
         df = pd.read_sql_query(f'SELECT DISTINCT version FROM GIT_COMMIT_RELEASE '
                                f'WHERE project_name=\'{self.repo_name}\'', conn)
         ret_val = df['version'].tolist()
@@ -101,6 +270,7 @@ class Project:
             raise Exception(f'Invalid order parameter {order}')
         return ret_val
 
+    @cached_query
     def get_issue_times(self):
         """
         Uses database to select all jira keys and time_spent values for given project, given that there is a time_spent,
@@ -109,14 +279,9 @@ class Project:
         :return: pandas dataframe of query result
         :rtype: pandas.DataFrame
         """
-        conn, cursor = get_db_connection(test_db=self.use_test_db)
-        return pd.read_sql_query((
-            'SELECT key, time_spent '
-            'FROM JIRA_ISSUES '
-            'WHERE project_name=\'?\' and time_spent != \'\' '
-            'AND time_spent != 0 ORDER BY key ASC'
-        ), conn, params=[self.repo_name])
+        return self._single_project(project_sql.issue_times(self.connection, [self.repo_name]))
 
+    @cached_query
     def get_packages_belonging_to_keys(self):
         """
         Selects packages which belong to keys
@@ -124,42 +289,13 @@ class Project:
         :return: dataframe containing the project name, package name, and version
         :rtype: pandas.DataFrame
         """
-        conn, cursor = get_db_connection(test_db=self.use_test_db)
-
-        df = pd.read_sql_query((
-            'SELECT REPLACE(GIT_COMMITS_CHANGES.new_path, "\\", "/") AS path, '
-            'GIT_COMMIT_JIRA.[key], JIRA_ISSUES.time_spent, GIT_COMMIT_RELEASE.version '
-            'FROM GIT_COMMIT_RELEASE '
-            'INNER JOIN GIT_COMMITS_CHANGES ON GIT_COMMIT_RELEASE.commit_hash = GIT_COMMITS_CHANGES.commit_hash '
-            'INNER JOIN GIT_COMMIT_JIRA ON GIT_COMMITS_CHANGES.commit_hash = GIT_COMMIT_JIRA.commit_hash '
-            'INNER JOIN JIRA_ISSUES ON JIRA_ISSUES.[key] = GIT_COMMIT_JIRA.[key] '
-            'WHERE GIT_COMMIT_RELEASE.project_name=\'?\' AND old_path != "" AND new_path != "" AND '
-            'JIRA_ISSUES.time_spent != "" AND GIT_COMMIT_RELEASE.project_name=\'?\' AND path LIKE "%.java" '
-            'GROUP BY GIT_COMMIT_JIRA.[key], GIT_COMMITS_CHANGES.old_path, GIT_COMMIT_RELEASE.version '
-            'ORDER BY GIT_COMMIT_JIRA.[key] ASC'
-        ), conn, params=[self.repo_name, self.repo_name])
-
-        df['package'] = df['path'].apply(lambda path: path[:path.rfind('/')])
-        df = df.drop('path', axis='columns')
-        # df = df.drop_duplicates(subset=['package', 'version'])
-        
-        return df
+        return self._single_project(project_sql.packages_belonging_to_keys(self.connection, [self.repo_name]))
 
+    @cached_query
     def get_all_pv_metrics(self):
-        conn, cursor = get_db_connection(test_db=self.use_test_db)
-
-        package_versions = pd.read_sql_query((
-            'SELECT package, version, pkg_files, pkg_loc, pkg_tokens, pkg_cc, pkg_average_loc, pkg_average_cc, '
-            'pkg_average_tokens '
-            'FROM STATIC_METRICS WHERE project_name = \'?\''
-        ), conn, params=[self.repo_name])
-
-        package_versions['package'] = package_versions['package'].apply(
-            lambda x: x[x.find(self.repo_name) + len(self.repo_name) + 1:]
-        )
-
-        return package_versions
+        return self._single_project(project_sql.all_pv_metrics(self.connection, [self.repo_name]))
 
+    @cached_query
     def get_issue_pv_metrics(self):
         """
         Returns a DF containing all keys and their aggregated package metrics
@@ -168,136 +304,134 @@ class Project:
         version, unlike refactorings which are snapshotted per commit. The package may exist at the time of the
         refactoring, but not by the end of the version.
         """
-        keys_and_pv = self.get_packages_belonging_to_keys()
-        static_pv_metrics = self.get_all_pv_metrics()
-
-        joined_static_metrics = keys_and_pv.merge(
-            static_pv_metrics,
-            on=['package', 'version'],
-            how='left',
-        ).fillna(0)
-
-        # Aggregate PV metrics by key
-        issue_pv_metrics = joined_static_metrics.groupby('key')[[
-            'pkg_files', 'pkg_loc', 'pkg_tokens', 'pkg_cc', 'pkg_average_loc', 'pkg_average_cc', 'pkg_average_tokens'
-        ]].sum().reset_index()
-
-        return issue_pv_metrics
+        return project_sql.issue_pv_metrics(self.get_packages_belonging_to_keys(), self.get_all_pv_metrics())
 
+    @cached_query
     def get_issue_refactorings(self):
-        conn, cursor = get_db_connection(test_db=self.use_test_db)
-
-        df = pd.read_sql_query((
-            'SELECT GIT_COMMIT_JIRA.[key], refactoring_type '
-            'FROM REFACTORING_MINER '
-            'INNER JOIN GIT_COMMIT_JIRA '
-            'ON REFACTORING_MINER.commit_hash = GIT_COMMIT_JIRA.commit_hash '
-            'INNER JOIN JIRA_ISSUES ON GIT_COMMIT_JIRA.[key] = JIRA_ISSUES.[key] '
-            'WHERE REFACTORING_MINER.project_name=\'?\' AND '
-            'JIRA_ISSUES.time_spent IS NOT "" '
-            'ORDER BY GIT_COMMIT_JIRA.[key] ASC'
-        ), con=conn, params=[self.repo_name])
-
-        df = df.pivot_table(
-            index='key',
-            columns='refactoring_type',
-            aggfunc=len
-        ).fillna(0).reset_index()
-
-        return standardize_refactoring_columns(df)
+        return self._single_project(project_sql.issue_refactorings(self.connection, [self.repo_name]))
 
+    @cached_query
     def get_issue_smells(self):
-        keys_and_pv = self.get_packages_belonging_to_keys()
-        pv_smells = self.get_pv_smells()
-
-        joined_smells = keys_and_pv.merge(
-            pv_smells,
-            on=['package', 'version'],
-            how='left'
-        ).fillna(0)
+        return project_sql.issue_smells(self.get_packages_belonging_to_keys(), self.get_pv_smells())
 
-        # Aggregate PV smells by key
-        key_static_metrics = joined_smells.groupby('key')[all_smell_types].sum().reset_index()
+    @cached_query
+    def get_issue_commit_metrics(self):
+        return self._single_project(project_sql.issue_commit_metrics(self.connection, [self.repo_name]))
 
-        return key_static_metrics
+    @cached_query
+    def build_issue_feature_matrix(self):
+        """
+        The issue-level dataset in one pass (see project_sql.issue_feature_matrix): every column of
+        get_issue_commit_metrics, get_issue_pv_metrics, get_issue_refactorings and get_issue_smells, with the issue to
+        package-version links computed once and the aggregation done in SQL
 
-    def get_issue_commit_metrics(self):
-        conn, cursor = get_db_connection(use_regex=True)
-
-        key_commit_metrics = pd.read_sql_query((
-            'SELECT GIT_COMMIT_JIRA.key, version, REPLACE(new_path, "\\", "/") AS path, '
-            'lines_added AS commits_loc_added, lines_removed AS commits_loc_removed '
-            'FROM (GIT_COMMIT_JIRA '
-            'LEFT JOIN '
-            'GIT_COMMIT_RELEASE ON GIT_COMMIT_JIRA.commit_hash = GIT_COMMIT_RELEASE.commit_hash '
-            'LEFT JOIN '
-            'GIT_COMMITS_CHANGES ON GIT_COMMIT_RELEASE.commit_hash = GIT_COMMITS_CHANGES.commit_hash) '
-            'WHERE '
-            'GIT_COMMIT_RELEASE.project_name = \'?\' AND PATH LIKE \'%.java\''
-        ), conn, params=[self.repo_name]).fillna(0)
-
-        key_commit_metrics = key_commit_metrics.astype({
-            'commits_loc_added': 'int', 'commits_loc_removed': 'int'
-        })
-
-        key_commit_metrics['n_commits'] = 1
-        key_commit_metrics['commits_code_churn'] = key_commit_metrics['commits_loc_added'] - key_commit_metrics[
-            'commits_loc_removed']
-
-        new_paths = [path[:path.rfind('/')] for path in key_commit_metrics.path]
-        key_commit_metrics = key_commit_metrics.drop('path', axis='columns')
-        key_commit_metrics['package'] = new_paths
-
-        # Aggregate commit metrics from keys
-        key_commit_metrics = key_commit_metrics.groupby(['key'])[
-            ['commits_loc_added', 'commits_loc_removed', 'commits_code_churn', 'n_commits']].agg('sum').reset_index()
-
-        return key_commit_metrics
+        :return: one row per issue with time spent, with its key, time_spent and every commit, package, refactoring and
+            smell column
+        :rtype: pandas.DataFrame
+        """
+        return self._single_project(project_sql.issue_feature_matrix(self.connection, [self.repo_name]))
 
+    @cached_query
     def get_pv_linked_refactorings(self):
         """
         Returns aggregated refactorings across all package-versions *WITH* time_spent values
         """
-        conn, cursor = get_db_connection(test_db=self.use_test_db)
-        df = pd.read_sql_query((
-            'SELECT REFACTORING_MINER.refactoring_type, '
-            'REFACTORING_MINER.package, GIT_COMMIT_RELEASE.version '
-            'FROM REFACTORING_MINER '
-            'INNER JOIN GIT_COMMIT_RELEASE '
-            'ON REFACTORING_MINER.commit_hash = GIT_COMMIT_RELEASE.commit_hash '
-            'INNER JOIN GIT_COMMIT_JIRA '
-            'ON GIT_COMMIT_RELEASE.commit_hash = GIT_COMMIT_JIRA.commit_hash '
-            'INNER JOIN JIRA_ISSUES '
-            'ON GIT_COMMIT_JIRA.[key] = JIRA_ISSUES.[key] '
-            'WHERE GIT_COMMIT_RELEASE.project_name=\'?\' AND '
-            'JIRA_ISSUES.time_spent != ""'
-        ), con=conn, params=[self.repo_name])
-
-        df = df.pivot_table(
-            index=['package', 'version'],
-            columns='refactoring_type',
-            aggfunc=len
-        ).fillna(0)
-
-        df.reset_index(inplace=True)
-
-        return standardize_refactoring_columns(df)
+        return self._single_project(project_sql.pv_linked_refactorings(self.connection, [self.repo_name]))
 
+    @cached_query
     def get_pv_smells(self):
-        conn, cursor = get_db_connection(test_db=self.use_test_db)
+        return self._single_project(project_sql.pv_smells(self.connection, [self.repo_name]))
+
+    @staticmethod
+    def _single_project(df):
+        return df.drop('project_name', axis='columns')
+
 
-        df = pd.read_sql_query('SELECT version, package, smell FROM DESIGNITE_SMELLS WHERE project_name=\'?\'',
-            conn, params=[self.repo_name])
+class ProjectSet(CachedQueries):
+    """
+    Runs the Project queries for several projects at once. Each query reads its tables once for all of them, filtering
+    with `project_name IN (...)`, and returns one frame with a project_name column ahead of the columns the Project
+    query returns
 
-        df = df.pivot_table(
-            index=['version', 'package'],
-            columns=['smell'],
-            aggfunc=len
-        ).fillna(0)
+    :param projects: the projects to query, i.e. values of utils.config_interface.get_all_projects()
+    :type projects: list[Project]
+    """
 
-        df.reset_index(inplace=True)
+    def __init__(self, projects):
+        projects = list(projects)
+        if len(projects) == 0:
+            raise ValueError('A ProjectSet needs at least one project')
+        if len({project.use_test_db for project in projects}) > 1:
+            raise ValueError('Projects of the test database cannot be queried together with other projects')
 
-        return standardize_smells_columns(df)
+        self.projects = {project.repo_name: project for project in projects}
+        super().__init__(use_test_db=projects[0].use_test_db)
+
+    @classmethod
+    def from_config(cls, project_names=None, include_test=False):
+        """
+        :param project_names: names of the projects in configs/projects.yaml to select. Defaults to all of them
+        :type project_names: list[str]
+        :rtype: ProjectSet
+        """
+        from utils.config_interface import get_all_projects
+
+        all_projects = get_all_projects(include_test=include_test)
+        if project_names is None:
+            return cls(all_projects.values())
+
+        unknown_names = set(project_names) - all_projects.keys()
+        if len(unknown_names) > 0:
+            raise ValueError(f'Unknown projects {sorted(unknown_names)}')
+        return cls(all_projects[project_name] for project_name in project_names)
+
+    @property
+    def project_names(self):
+        return sorted(self.projects)
+
+    @property
+    def query_cache_name(self):
+        return 'projects_' + hashlib.sha1(','.join(self.project_names).encode()).hexdigest()[:16]
+
+    @cached_query
+    def get_issue_times(self):
+        return project_sql.issue_times(self.connection, self.project_names)
+
+    @cached_query
+    def get_packages_belonging_to_keys(self):
+        return project_sql.packages_belonging_to_keys(self.connection, self.project_names)
+
+    @cached_query
+    def get_all_pv_metrics(self):
+        return project_sql.all_pv_metrics(self.connection, self.project_names)
+
+    @cached_query
+    def get_issue_pv_metrics(self):
+        return project_sql.issue_pv_metrics(self.get_packages_belonging_to_keys(), self.get_all_pv_metrics())
+
+    @cached_query
+    def get_issue_refactorings(self):
+        return project_sql.issue_refactorings(self.connection, self.project_names)
+
+    @cached_query
+    def get_issue_smells(self):
+        return project_sql.issue_smells(self.get_packages_belonging_to_keys(), self.get_pv_smells())
+
+    @cached_query
+    def get_issue_commit_metrics(self):
+        return project_sql.issue_commit_metrics(self.connection, self.project_names)
+
+    @cached_query
+    def build_issue_feature_matrix(self):
+        return project_sql.issue_feature_matrix(self.connection, self.project_names)
+
+    @cached_query
+    def get_pv_linked_refactorings(self):
+        return project_sql.pv_linked_refactorings(self.connection, self.project_names)
+
+    @cached_query
+    def get_pv_smells(self):
+        return project_sql.pv_smells(self.connection, self.project_names)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,404 @@
+"""
+The queries behind Project and ProjectSet. Each one reads any number of projects in a single pass, filtering with
+`project_name IN (...)`, and returns a frame with a project_name column ahead of the columns a Project query returns.
+Project drops that column again; ProjectSet returns it, so its frames hold every selected project at once.
+
+Databases with the rollup tables (database.rollups, schema version 3) are read through them; older databases are
+pivoted in pandas, with the same result.
+"""
+import pandas as pd
+
+from database.rollups import pkg_metric_columns, rollups_available, type_sum_columns
+from internal_configs import all_refactoring_types, all_smell_types
+from utils.rq1_helpers import standardize_refactoring_columns, standardize_smells_columns
+
+commit_metric_columns = ['commits_loc_added', 'commits_loc_removed', 'commits_code_churn', 'n_commits']
+
+
+def _placeholders(project_names):
+    return ', '.join('?' for _ in project_names)
+
+
+def _project_columns(df):
+    # Frames of a single Project no longer hold project_name
+    return ['project_name'] if 'project_name' in df.columns else []
+
+
+def _float_counts(df, all_types):
+    # Rollup counts are integers, pivoted counts are floats (rq1_helpers.standardize_columns_by_list)
+    df[all_types] = df[all_types].astype(float)
+    return df
+
+
+def _pivot_counts(counts, column_name, all_types):
+    """
+    Turns (project_name, key, <column_name>, n) rows into one row per issue and one column per type, named as
+    rq1_helpers.standardize_columns_by_list names them. Types outside all_types are dropped
+
+    :rtype: pandas.DataFrame
+    """
+    counts[column_name] = counts[column_name].str.lower().str.replace(' ', '_')
+    wide = counts.groupby(['project_name', 'key', column_name])['n'].sum().unstack(fill_value=0)
+    return wide.reindex(columns=all_types, fill_value=0)
+
+
+def issue_times(conn, project_names):
+    """
+    :return: the key and time_spent of every issue with a time_spent that is not 0
+    :rtype: pandas.DataFrame
+    """
+    return pd.read_sql_query((
+        'SELECT project_name, key, time_spent '
+        'FROM JIRA_ISSUES '
+        f'WHERE project_name IN ({_placeholders(project_names)}) and time_spent != \'\' '
+        'AND time_spent != 0 ORDER BY project_name ASC, key ASC'
+    ), conn, params=list(project_names))
+
+
+def packages_belonging_to_keys(conn, project_names):
+    """
+    :return: the key, time_spent, version and package of every Java file changed for an issue with a time_spent
+    :rtype: pandas.DataFrame
+    """
+    df = pd.read_sql_query((
+        'SELECT GIT_COMMIT_RELEASE.project_name, REPLACE(GIT_COMMITS_CHANGES.new_path, "\\", "/") AS path, '
+        'GIT_COMMIT_JIRA.[key], JIRA_ISSUES.time_spent, GIT_COMMIT_RELEASE.version '
+        'FROM GIT_COMMIT_RELEASE '
+        'INNER JOIN GIT_COMMITS_CHANGES ON GIT_COMMIT_RELEASE.commit_hash = GIT_COMMITS_CHANGES.commit_hash '
+        'INNER JOIN GIT_COMMIT_JIRA ON GIT_COMMITS_CHANGES.commit_hash = GIT_COMMIT_JIRA.commit_hash '
+        'INNER JOIN JIRA_ISSUES ON JIRA_ISSUES.[key] = GIT_COMMIT_JIRA.[key] '
+        f'WHERE GIT_COMMIT_RELEASE.project_name IN ({_placeholders(project_names)}) AND old_path != "" AND '
+        'new_path != "" AND JIRA_ISSUES.time_spent != "" AND path LIKE "%.java" '
+        'GROUP BY GIT_COMMIT_RELEASE.project_name, GIT_COMMIT_JIRA.[key], GIT_COMMITS_CHANGES.old_path, '
+        'GIT_COMMIT_RELEASE.version '
+        'ORDER BY GIT_COMMIT_RELEASE.project_name ASC, GIT_COMMIT_JIRA.[key] ASC'
+    ), conn, params=list(project_names))
+
+    df['package'] = df['path'].apply(lambda path: path[:path.rfind('/')])
+    return df.drop('path', axis='columns')
+
+
+def all_pv_metrics(conn, project_names):
+    """
+    :return: the static metrics of every package-version, with package names relative to the project folder
+    :rtype: pandas.DataFrame
+    """
+    if rollups_available(conn):
+        return pd.read_sql_query((
+            f'SELECT project_name, package, version, {", ".join(pkg_metric_columns)} '
+            f'FROM STATIC_METRICS_PV WHERE project_name IN ({_placeholders(project_names)}) '
+            'ORDER BY project_name ASC, package ASC, version ASC'
+        ), conn, params=list(project_names))
+
+    package_versions = pd.read_sql_query((
+        f'SELECT project_name, package, version, {", ".join(pkg_metric_columns)} '
+        f'FROM STATIC_METRICS WHERE project_name IN ({_placeholders(project_names)})'
+    ), conn, params=list(project_names))
+
+    package_versions['package'] = [
+        package[package.find(project_name) + len(project_name) + 1:]
+        for project_name, package in zip(package_versions['project_name'], package_versions['package'])
+    ]
+
+    return package_versions
+
+
+def issue_pv_metrics(keys_and_pv, pv_metrics):
+    """
+    Sums the metrics of the package-versions each issue changed
+
+    :param keys_and_pv: result of `packages_belonging_to_keys`
+    :type keys_and_pv: pandas.DataFrame
+    :param pv_metrics: result of `all_pv_metrics`
+    :type pv_metrics: pandas.DataFrame
+    :rtype: pandas.DataFrame
+    """
+    project_columns = _project_columns(keys_and_pv)
+    joined_static_metrics = keys_and_pv.merge(
+        pv_metrics,
+        on=project_columns + ['package', 'version'],
+        how='left',
+    ).fillna(0)
+
+    return joined_static_metrics.groupby(project_columns + ['key'])[pkg_metric_columns].sum().reset_index()
+
+
+def issue_refactorings(conn, project_names):
+    """
+    :return: the number of refactorings of each type in the commits of every issue with a time_spent
+    :rtype: pandas.DataFrame
+    """
+    if rollups_available(conn):
+        return _float_counts(pd.read_sql_query((
+            'SELECT REFACTORING_MINER_WIDE.project_name, GIT_COMMIT_JIRA.[key], '
+            f'{type_sum_columns(all_refactoring_types, "REFACTORING_MINER_WIDE")} '
+            'FROM REFACTORING_MINER_WIDE '
+            'INNER JOIN GIT_COMMIT_JIRA ON REFACTORING_MINER_WIDE.commit_hash = GIT_COMMIT_JIRA.commit_hash '
+            'INNER JOIN JIRA_ISSUES ON GIT_COMMIT_JIRA.[key] = JIRA_ISSUES.[key] '
+            f'WHERE REFACTORING_MINER_WIDE.project_name IN ({_placeholders(project_names)}) AND '
+            'JIRA_ISSUES.time_spent IS NOT "" '
+            'GROUP BY REFACTORING_MINER_WIDE.project_name, GIT_COMMIT_JIRA.[key] '
+            'ORDER BY REFACTORING_MINER_WIDE.project_name ASC, GIT_COMMIT_JIRA.[key] ASC'
+        ), con=conn, params=list(project_names)), all_refactoring_types)
+
+    df = pd.read_sql_query((
+        'SELECT REFACTORING_MINER.project_name, GIT_COMMIT_JIRA.[key], refactoring_type '
+        'FROM REFACTORING_MINER '
+        'INNER JOIN GIT_COMMIT_JIRA '
+        'ON REFACTORING_MINER.commit_hash = GIT_COMMIT_JIRA.commit_hash '
+        'INNER JOIN JIRA_ISSUES ON GIT_COMMIT_JIRA.[key] = JIRA_ISSUES.[key] '
+        f'WHERE REFACTORING_MINER.project_name IN ({_placeholders(project_names)}) AND '
+        'JIRA_ISSUES.time_spent IS NOT "" '
+        'ORDER BY REFACTORING_MINER.project_name ASC, GIT_COMMIT_JIRA.[key] ASC'
+    ), con=conn, params=list(project_names))
+
+    df = df.pivot_table(
+        index=['project_name', 'key'],
+        columns='refactoring_type',
+        aggfunc=len
+    ).fillna(0).reset_index()
+
+    return standardize_refactoring_columns(df)
+
+
+def issue_smells(keys_and_pv, pv_smells):
+    """
+    Sums the smells of the package-versions each issue changed
+
+    :param keys_and_pv: result of `packages_belonging_to_keys`
+    :type keys_and_pv: pandas.DataFrame
+    :param pv_smells: result of `pv_smells`
+    :type pv_smells: pandas.DataFrame
+    :rtype: pandas.DataFrame
+    """
+    project_columns = _project_columns(keys_and_pv)
+    joined_smells = keys_and_pv.merge(
+        pv_smells,
+        on=project_columns + ['package', 'version'],
+        how='left'
+    ).fillna(0)
+
+    return joined_smells.groupby(project_columns + ['key'])[all_smell_types].sum().reset_index()
+
+
+def issue_commit_metrics(conn, project_names):
+    """
+    :return: lines added, removed and churned in Java files, and the number of such file changes, of every issue
+    :rtype: pandas.DataFrame
+    """
+    key_commit_metrics = pd.read_sql_query((
+        'SELECT GIT_COMMIT_RELEASE.project_name, GIT_COMMIT_JIRA.key, version, '
+        'REPLACE(new_path, "\\", "/") AS path, '
+        'lines_added AS commits_loc_added, lines_removed AS commits_loc_removed '
+        'FROM (GIT_COMMIT_JIRA '
+        'LEFT JOIN '
+        'GIT_COMMIT_RELEASE ON GIT_COMMIT_JIRA.commit_hash = GIT_COMMIT_RELEASE.commit_hash '
+        'LEFT JOIN '
+        'GIT_COMMITS_CHANGES ON GIT_COMMIT_RELEASE.commit_hash = GIT_COMMITS_CHANGES.commit_hash) '
+        'WHERE '
+        f'GIT_COMMIT_RELEASE.project_name IN ({_placeholders(project_names)}) AND PATH LIKE \'%.java\''
+    ), conn, params=list(project_names)).fillna(0)
+
+    key_commit_metrics = key_commit_metrics.astype({
+        'commits_loc_added': 'int', 'commits_loc_removed': 'int'
+    })
+
+    key_commit_metrics['n_commits'] = 1
+    key_commit_metrics['commits_code_churn'] = key_commit_metrics['commits_loc_added'] - key_commit_metrics[
+        'commits_loc_removed']
+
+    # Aggregate commit metrics from keys
+    return key_commit_metrics.groupby(['project_name', 'key'])[commit_metric_columns].agg('sum').reset_index()
+
+
+def pv_linked_refactorings(conn, project_names):
+    """
+    :return: the number of refactorings of each type in every package-version, counting only the commits of issues
+        with a time_spent
+    :rtype: pandas.DataFrame
+    """
+    if rollups_available(conn):
+        return _float_counts(pd.read_sql_query((
+            'SELECT GIT_COMMIT_RELEASE.project_name, REFACTORING_MINER_WIDE.package, GIT_COMMIT_RELEASE.version, '
+            f'{type_sum_columns(all_refactoring_types, "REFACTORING_MINER_WIDE")} '
+            'FROM REFACTORING_MINER_WIDE '
+            'INNER JOIN GIT_COMMIT_RELEASE '
+            'ON REFACTORING_MINER_WIDE.commit_hash = GIT_COMMIT_RELEASE.commit_hash '
+            'INNER JOIN GIT_COMMIT_JIRA '
+            'ON GIT_COMMIT_RELEASE.commit_hash = GIT_COMMIT_JIRA.commit_hash '
+            'INNER JOIN JIRA_ISSUES '
+            'ON GIT_COMMIT_JIRA.[key] = JIRA_ISSUES.[key] '
+            f'WHERE GIT_COMMIT_RELEASE.project_name IN ({_placeholders(project_names)}) AND '
+            'JIRA_ISSUES.time_spent != "" AND REFACTORING_MINER_WIDE.package IS NOT NULL AND '
+            'GIT_COMMIT_RELEASE.version IS NOT NULL '
+            'GROUP BY GIT_COMMIT_RELEASE.project_name, REFACTORING_MINER_WIDE.package, GIT_COMMIT_RELEASE.version '
+            'ORDER BY GIT_COMMIT_RELEASE.project_name ASC, REFACTORING_MINER_WIDE.package ASC, '
+            'GIT_COMMIT_RELEASE.version ASC'
+        ), con=conn, params=list(project_names)), all_refactoring_types)
+
+    df = pd.read_sql_query((
+        'SELECT GIT_COMMIT_RELEASE.project_name, REFACTORING_MINER.refactoring_type, '
+        'REFACTORING_MINER.package, GIT_COMMIT_RELEASE.version '
+        'FROM REFACTORING_MINER '
+        'INNER JOIN GIT_COMMIT_RELEASE '
+        'ON REFACTORING_MINER.commit_hash = GIT_COMMIT_RELEASE.commit_hash '
+        'INNER JOIN GIT_COMMIT_JIRA '
+        'ON GIT_COMMIT_RELEASE.commit_hash = GIT_COMMIT_JIRA.commit_hash '
+        'INNER JOIN JIRA_ISSUES '
+        'ON GIT_COMMIT_JIRA.[key] = JIRA_ISSUES.[key] '
+        f'WHERE GIT_COMMIT_RELEASE.project_name IN ({_placeholders(project_names)}) AND '
+        'JIRA_ISSUES.time_spent != ""'
+    ), con=conn, params=list(project_names))
+
+    df = df.pivot_table(
+        index=['project_name', 'package', 'version'],
+        columns='refactoring_type',
+        aggfunc=len
+    ).fillna(0)
+
+    df.reset_index(inplace=True)
+
+    return standardize_refactoring_columns(df)
+
+
+def pv_smells(conn, project_names):
+    """
+    :return: the number of smells of each type in every package-version
+    :rtype: pandas.DataFrame
+    """
+    if rollups_available(conn):
+        smell_columns = ', '.join(f'"{smell_type}"' for smell_type in all_smell_types)
+        return _float_counts(pd.read_sql_query((
+            f'SELECT project_name, version, package, {smell_columns} FROM DESIGNITE_SMELLS_WIDE '
+            f'WHERE project_name IN ({_placeholders(project_names)}) '
+            'ORDER BY project_name ASC, version ASC, package ASC'
+        ), conn, params=list(project_names)), all_smell_types)
+
+    df = pd.read_sql_query(
+        f'SELECT project_name, version, package, smell FROM DESIGNITE_SMELLS '
+        f'WHERE project_name IN ({_placeholders(project_names)})',
+        conn, params=list(project_names))
+
+    df = df.pivot_table(
+        index=['project_name', 'version', 'package'],
+        columns=['smell'],
+        aggfunc=len
+    ).fillna(0)
+
+    df.reset_index(inplace=True)
+
+    return standardize_smells_columns(df)
+
+
+def issue_feature_matrix(conn, project_names):
+    """
+    The issue-level dataset in one pass: the columns of `issue_commit_metrics`, `issue_pv_metrics`,
+    `issue_refactorings` and `issue_smells`, aggregated in SQL. The issue to package-version links
+    (`packages_belonging_to_keys`) are computed once, into a temporary table both the package metrics and the smells
+    are joined against. With the rollup tables, no per-row pivot is left: every family is a sum over rollup rows
+
+    :return: one row per issue with time spent, with its key, time_spent and every commit, package, refactoring
+        (all_refactoring_types) and smell (all_smell_types) column. Missing values are 0
+    :rtype: pandas.DataFrame
+    """
+    project_filter = f'IN ({_placeholders(project_names)})'
+    project_names = list(project_names)
+    use_rollups = rollups_available(conn)
+
+    conn.execute('DROP TABLE IF EXISTS temp.ISSUE_PACKAGES')
+    # As in packages_belonging_to_keys; RTRIM strips the file name, leaving the folder and its trailing /
+    conn.execute((
+        'CREATE TEMP TABLE ISSUE_PACKAGES AS '
+        'SELECT project_name, [key], version, SUBSTR(folder, 1, LENGTH(folder) - 1) AS package FROM ('
+        'SELECT project_name, [key], version, RTRIM(path, REPLACE(path, "/", "")) AS folder FROM ('
+        'SELECT GIT_COMMIT_RELEASE.project_name, REPLACE(GIT_COMMITS_CHANGES.new_path, "\\", "/") AS path, '
+        'GIT_COMMIT_JIRA.[key], GIT_COMMIT_RELEASE.version '
+        'FROM GIT_COMMIT_RELEASE '
+        'INNER JOIN GIT_COMMITS_CHANGES ON GIT_COMMIT_RELEASE.commit_hash = GIT_COMMITS_CHANGES.commit_hash '
+        'INNER JOIN GIT_COMMIT_JIRA ON GIT_COMMITS_CHANGES.commit_hash = GIT_COMMIT_JIRA.commit_hash '
+        'INNER JOIN JIRA_ISSUES ON JIRA_ISSUES.[key] = GIT_COMMIT_JIRA.[key] '
+        f'WHERE GIT_COMMIT_RELEASE.project_name {project_filter} AND old_path != "" AND new_path != "" AND '
+        'JIRA_ISSUES.time_spent != "" AND path LIKE "%.java" '
+        'GROUP BY GIT_COMMIT_RELEASE.project_name, GIT_COMMIT_JIRA.[key], GIT_COMMITS_CHANGES.old_path, '
+        'GIT_COMMIT_RELEASE.version))'
+    ), project_names)
+
+    try:
+        pkg_sums = ', '.join(f'TOTAL({column}) AS {column}' for column in pkg_metric_columns)
+        matrix = pd.read_sql_query((
+            'WITH ISSUES AS ('
+            'SELECT DISTINCT GIT_COMMIT_RELEASE.project_name, JIRA_ISSUES.[key], JIRA_ISSUES.time_spent '
+            'FROM JIRA_ISSUES '
+            'INNER JOIN GIT_COMMIT_JIRA ON JIRA_ISSUES.[key] = GIT_COMMIT_JIRA.[key] '
+            'INNER JOIN GIT_COMMIT_RELEASE ON GIT_COMMIT_JIRA.commit_hash = GIT_COMMIT_RELEASE.commit_hash '
+            f'WHERE GIT_COMMIT_RELEASE.project_name {project_filter} AND JIRA_ISSUES.time_spent != ""), '
+            'COMMIT_METRICS AS ('
+            'SELECT GIT_COMMIT_RELEASE.project_name, GIT_COMMIT_JIRA.[key], '
+            'TOTAL(lines_added) AS commits_loc_added, TOTAL(lines_removed) AS commits_loc_removed, '
+            'TOTAL(lines_added) - TOTAL(lines_removed) AS commits_code_churn, COUNT(*) AS n_commits '
+            'FROM GIT_COMMIT_JIRA '
+            'INNER JOIN GIT_COMMIT_RELEASE ON GIT_COMMIT_JIRA.commit_hash = GIT_COMMIT_RELEASE.commit_hash '
+            'INNER JOIN GIT_COMMITS_CHANGES ON GIT_COMMIT_RELEASE.commit_hash = GIT_COMMITS_CHANGES.commit_hash '
+            f'WHERE GIT_COMMIT_RELEASE.project_name {project_filter} '
+            'AND REPLACE(new_path, "\\", "/") LIKE "%.java" '
+            'GROUP BY GIT_COMMIT_RELEASE.project_name, GIT_COMMIT_JIRA.[key]), '
+            # Package names as all_pv_metrics strips them
+            'PV_METRICS AS ('
+            + (f'SELECT project_name, package, version, {", ".join(pkg_metric_columns)} FROM STATIC_METRICS_PV '
+               if use_rollups else
+               'SELECT project_name, SUBSTR(package, INSTR(package, project_name) + LENGTH(project_name) + 1) '
+               f'AS package, version, {", ".join(pkg_metric_columns)} FROM STATIC_METRICS ')
+            + f'WHERE project_name {project_filter}), '
+            'ISSUE_PV_METRICS AS ('
+            f'SELECT ISSUE_PACKAGES.project_name, ISSUE_PACKAGES.[key], {pkg_sums} FROM ISSUE_PACKAGES '
+            'LEFT JOIN PV_METRICS ON ISSUE_PACKAGES.project_name = PV_METRICS.project_name '
+            'AND ISSUE_PACKAGES.package = PV_METRICS.package AND ISSUE_PACKAGES.version = PV_METRICS.version '
+            'GROUP BY ISSUE_PACKAGES.project_name, ISSUE_PACKAGES.[key]) '
+            f'SELECT ISSUES.project_name, ISSUES.[key], ISSUES.time_spent, {", ".join(commit_metric_columns)}, '
+            f'{", ".join(pkg_metric_columns)} FROM ISSUES '
+            'LEFT JOIN COMMIT_METRICS ON ISSUES.project_name = COMMIT_METRICS.project_name '
+            'AND ISSUES.[key] = COMMIT_METRICS.[key] '
+            'LEFT JOIN ISSUE_PV_METRICS ON ISSUES.project_name = ISSUE_PV_METRICS.project_name '
+            'AND ISSUES.[key] = ISSUE_PV_METRICS.[key] '
+            'ORDER BY ISSUES.project_name ASC, ISSUES.[key] ASC'
+        ), conn, params=project_names * 3)
+
+        if use_rollups:
+            refactorings = issue_refactorings(conn, project_names).set_index(['project_name', 'key'])
+            smells = pd.read_sql_query((
+                'SELECT ISSUE_PACKAGES.project_name, ISSUE_PACKAGES.[key], '
+                f'{type_sum_columns(all_smell_types, "DESIGNITE_SMELLS_WIDE")} FROM ISSUE_PACKAGES '
+                'INNER JOIN DESIGNITE_SMELLS_WIDE ON ISSUE_PACKAGES.project_name = DESIGNITE_SMELLS_WIDE.project_name '
+                'AND ISSUE_PACKAGES.package = DESIGNITE_SMELLS_WIDE.package '
+                'AND ISSUE_PACKAGES.version = DESIGNITE_SMELLS_WIDE.version '
+                'GROUP BY ISSUE_PACKAGES.project_name, ISSUE_PACKAGES.[key]'
+            ), conn).set_index(['project_name', 'key'])
+        else:
+            refactorings = _pivot_counts(pd.read_sql_query((
+                'SELECT REFACTORING_MINER.project_name, GIT_COMMIT_JIRA.[key], refactoring_type, COUNT(*) AS n '
+                'FROM REFACTORING_MINER '
+                'INNER JOIN GIT_COMMIT_JIRA ON REFACTORING_MINER.commit_hash = GIT_COMMIT_JIRA.commit_hash '
+                'INNER JOIN JIRA_ISSUES ON GIT_COMMIT_JIRA.[key] = JIRA_ISSUES.[key] '
+                f'WHERE REFACTORING_MINER.project_name {project_filter} AND JIRA_ISSUES.time_spent IS NOT "" '
+                'GROUP BY REFACTORING_MINER.project_name, GIT_COMMIT_JIRA.[key], refactoring_type'
+            ), conn, params=project_names), 'refactoring_type', all_refactoring_types)
+
+            smells = _pivot_counts(pd.read_sql_query((
+                'WITH PV_SMELLS AS ('
+                'SELECT project_name, package, version, smell, COUNT(*) AS n FROM DESIGNITE_SMELLS '
+                f'WHERE project_name {project_filter} '
+                'GROUP BY project_name, package, version, smell) '
+                'SELECT ISSUE_PACKAGES.project_name, ISSUE_PACKAGES.[key], smell, SUM(n) AS n FROM ISSUE_PACKAGES '
+                'INNER JOIN PV_SMELLS ON ISSUE_PACKAGES.project_name = PV_SMELLS.project_name '
+                'AND ISSUE_PACKAGES.package = PV_SMELLS.package AND ISSUE_PACKAGES.version = PV_SMELLS.version '
+                'GROUP BY ISSUE_PACKAGES.project_name, ISSUE_PACKAGES.[key], smell'
+            ), conn, params=project_names), 'smell', all_smell_types)
+    finally:
+        conn.execute('DROP TABLE IF EXISTS temp.ISSUE_PACKAGES')
+
+    matrix = matrix.set_index(['project_name', 'key']).join([refactorings, smells]).fillna(0)
+
+    # The float columns are built in one frame and joined at once, rather than assigned column by column
+    feature_columns = commit_metric_columns + pkg_metric_columns + all_refactoring_types + all_smell_types
+    features = matrix[feature_columns].astype(float)
+    return pd.concat([matrix.drop(columns=feature_columns), features], axis=1).reset_index()
@@ -0,0 +1,79 @@
+"""
+Bounds how many processes use a shared resource at once, across the worker processes that handle projects
+concurrently (see main.process_projects).
+
+Each resource has one semaphore, created in the main process and handed to every worker process with
+`init_resource_limits`, and on to nested worker pools (table and version workers) with `current_resource_semaphores`.
+Code that uses a resource wraps each unit of work (a request, a commit, a package, a tool run) in
+`with acquire(<resource>):`, rather than a whole phase, so no process holds a resource while it is not using it. In a
+process without limits (i.e, projects handled one after another) `acquire` does nothing.
+"""
+import multiprocessing
+from contextlib import contextmanager
+
+# Resource name -> what it bounds
+RESOURCES = {
+    'network': 'clones, fetches and Jira downloads',
+    'cpu': 'lizard analysis and PyDriller history walks',
+    'jvm': 'Designite and RefactoringMiner runs',
+    'database': 'LOADs into the SQLite database, which allows a single writer',
+}
+
+DEFAULT_RESOURCE_LIMITS = {
+    'network': 2,
+    'cpu': max(1, multiprocessing.cpu_count() - 1),
+    'jvm': 4,
+    'database': 1,
+}
+
+_semaphores = {}
+
+
+def create_resource_semaphores(resource_limits=None):
+    """
+    :param resource_limits: resource name -> the most concurrent users. Missing resources use
+        DEFAULT_RESOURCE_LIMITS
+    :type resource_limits: dict
+    :return: resource name -> semaphore, to pass to `init_resource_limits` in every worker process
+    :rtype: dict
+    """
+    limits = dict(DEFAULT_RESOURCE_LIMITS, **(resource_limits or {}))
+    unknown_resources = limits.keys() - RESOURCES.keys()
+    if len(unknown_resources) > 0:
+        raise ValueError(f'Unknown resources {sorted(unknown_resources)}; expected some of {list(RESOURCES)}')
+
+    return {name: multiprocessing.BoundedSemaphore(max(1, limit)) for name, limit in limits.items()}
+
+
+def init_resource_limits(semaphores):
+    """
+    Installs the semaphores in the current process. Used as a process pool initializer
+    """
+    global _semaphores
+    _semaphores = semaphores
+
+
+def current_resource_semaphores():
+    """
+    :return: the semaphores installed in the current process, to hand on to a nested process pool
+    :rtype: dict
+    """
+    return _semaphores
+
+
+@contextmanager
+def acquire(resource_name):
+    """
+    Holds one unit of a resource for the duration of the block, waiting for one to be released if all are in use
+    """
+    semaphore = _semaphores.get(resource_name)
+    if semaphore is None:
+        yield
+        return
+
+    with semaphore:
+        yield
+
+
+if __name__ == '__main__':
+    print('This module has no main-run functionality')
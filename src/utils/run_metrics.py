@@ -0,0 +1,148 @@
+"""
+Records how long each step of a database run takes and what it produces, as JSON lines in root/etc/metrics.
+
+Every measured step (a populator, one populator's work on one version, an external tool call) appends one line with
+its wall and CPU time, rows produced, bytes written and the peak RSS reached so far. All processes of a run, including
+worker processes, append to the same file, so two runs can be compared line by line or through `summary`.
+"""
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from utils.top_level_paths import etc_directory
+
+try:
+    import resource
+except ImportError:  # Windows has no getrusage; CPU time of tools and peak RSS are then not recorded
+    resource = None
+
+METRICS_DIR = os.path.join(etc_directory, 'metrics')
+# Worker processes inherit the run's metrics file through this environment variable
+METRICS_FILE_VARIABLE = 'ATDD_METRICS_FILE'
+
+
+def start_run():
+    """
+    Starts a new metrics file for this run and every process started from now on
+
+    :return: path of the metrics file
+    :rtype: str
+    """
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    file_name = f'run_{datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}_{os.getpid()}.jsonl'
+    os.environ[METRICS_FILE_VARIABLE] = os.path.join(METRICS_DIR, file_name)
+    return os.environ[METRICS_FILE_VARIABLE]
+
+
+def metrics_file():
+    """
+    :return: path of the current run's metrics file, starting a run if there is none
+    :rtype: str
+    """
+    return os.environ.get(METRICS_FILE_VARIABLE) or start_run()
+
+
+def _megabytes(max_rss):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return max_rss / 1024 ** 2 if sys.platform == 'darwin' else max_rss / 1024
+
+
+def _resource_usage(who):
+    """
+    :return: (CPU seconds, peak RSS in MB) of this process or of its finished child processes, or (0, None) without
+        getrusage
+    :rtype: tuple
+    """
+    if resource is None:
+        return (time.process_time(), None) if who == 'self' else (0, None)
+
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime, _megabytes(usage.ru_maxrss)
+
+
+def record(kind, name, **fields):
+    """
+    Appends one metric line. Lines are written with a single append, so concurrent processes do not interleave them
+
+    :param kind: what was measured (i.e, populator, version, tool)
+    :type kind: str
+    :param name: which one (i.e, the table name, or the tool)
+    :type name: str
+    """
+    line = json.dumps(dict({'time': datetime.now().isoformat(timespec='seconds'), 'pid': os.getpid(), 'kind': kind,
+                            'name': name}, **fields), default=str)
+    with open(metrics_file(), 'a', encoding='utf-8') as file:
+        file.write(line + '\n')
+
+
+@contextmanager
+def measure(kind, name, child_processes=False, **fields):
+    """
+    Measures the block and records it once the block is done, even if it raised. The block may fill in the yielded
+    dict, i.e. `metric['rows'] = n_records`; its values are recorded with the timings
+
+    :param child_processes: whether the block's work happens in child processes (i.e, an external tool), whose CPU
+        time and peak RSS are then recorded instead of this process's
+    :type child_processes: bool
+    """
+    who = 'children' if child_processes else 'self'
+    metric = dict(fields)
+    cpu_at_start, _ = _resource_usage(who)
+    wall_at_start = time.perf_counter()
+    try:
+        yield metric
+    finally:
+        cpu_at_end, peak_rss_mb = _resource_usage(who)
+        metric['wall_seconds'] = round(time.perf_counter() - wall_at_start, 3)
+        metric['cpu_seconds'] = round(cpu_at_end - cpu_at_start, 3)
+        metric['peak_rss_mb'] = None if peak_rss_mb is None else round(peak_rss_mb, 1)
+        record(kind, name, **metric)
+
+
+def read_metrics(file_path=None):
+    """
+    :return: the metric lines of a run, as dicts. Defaults to the current run
+    :rtype: list
+    """
+    file_path = file_path or metrics_file()
+    if not os.path.exists(file_path):
+        return []
+
+    with open(file_path, 'r', encoding='utf-8') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def summary(file_path=None):
+    """
+    :return: a table with one row per (kind, name): how often it ran, and its total wall time, CPU time, rows and
+        bytes written, and its highest peak RSS. Sorted by total wall time, longest first
+    :rtype: str
+    """
+    totals = {}
+    for metric in read_metrics(file_path):
+        total = totals.setdefault((metric['kind'], metric['name']), {
+            'count': 0, 'wall_seconds': 0, 'cpu_seconds': 0, 'rows': 0, 'bytes_written': 0, 'peak_rss_mb': 0
+        })
+        total['count'] = total['count'] + 1
+        for field in ('wall_seconds', 'cpu_seconds', 'rows', 'bytes_written'):
+            total[field] = total[field] + (metric.get(field) or 0)
+        total['peak_rss_mb'] = max(total['peak_rss_mb'], metric.get('peak_rss_mb') or 0)
+
+    lines = [f'{"kind":<15}{"name":<40}{"count":>7}{"wall (s)":>11}{"cpu (s)":>11}{"rows":>12}{"written (MB)":>14}'
+             f'{"peak RSS (MB)":>15}']
+    for (kind, name), total in sorted(totals.items(), key=lambda item: item[1]['wall_seconds'], reverse=True):
+        lines.append(f'{kind:<15}{name[:39]:<40}{total["count"]:>7}{total["wall_seconds"]:>11.1f}'
+                     f'{total["cpu_seconds"]:>11.1f}{total["rows"]:>12}{total["bytes_written"] / 1024 ** 2:>14.1f}'
+                     f'{total["peak_rss_mb"]:>15.1f}')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    # Summarizes a saved run: python -m utils.run_metrics root/etc/metrics/<run>.jsonl
+    if len(sys.argv) > 1:
+        print(summary(sys.argv[1]))
+    else:
+        print('Usage: python -m utils.run_metrics <metrics file>')
@@ -1,14 +1,33 @@
+import os
 import subprocess
-from utils import config_interface
+from utils import config_interface, resource_limits, run_metrics
+
+
+def _tool_name(cmd):
+    """
+    :return: a short name for a command, for run metrics (i.e, 'git checkout', 'DesigniteJava.jar')
+    :rtype: str
+    """
+    if '-jar' in cmd:
+        return os.path.basename(cmd[cmd.index('-jar') + 1])
+
+    tool = os.path.basename(cmd[0])
+    if tool == 'git':
+        arguments = cmd[1:]
+        if arguments[:1] == ['-C']:
+            arguments = arguments[2:]
+        return f'git {arguments[0]}' if arguments else tool
+    return tool
 
 
 def _run_process(cmd, check_out=False):
     response = None
 
-    if check_out:
-        response = subprocess.check_output(cmd, shell=False, stderr=subprocess.STDOUT).decode("utf-8")
-    else:
-        subprocess.run(cmd, shell=False, stderr=subprocess.STDOUT)
+    with run_metrics.measure('tool', _tool_name(cmd), child_processes=True):
+        if check_out:
+            response = subprocess.check_output(cmd, shell=False, stderr=subprocess.STDOUT).decode("utf-8")
+        else:
+            subprocess.run(cmd, shell=False, stderr=subprocess.STDOUT)
 
     return response
 
@@ -31,7 +50,24 @@ def run_designite(dir_to_analyze, output_path):
         '-i', dir_to_analyze,
         '-o', output_path
     ]
-    return _run_process(cmd)
+    with resource_limits.acquire('jvm'):
+        return _run_process(cmd)
+
+
+def jvm_memory_in_megabytes(memory_size):
+    """
+    Converts a JVM memory size, as passed to -Xmx (i.e, '4g', '512m'), to megabytes
+
+    :param memory_size: the memory size
+    :type memory_size: str
+    :rtype: int
+    """
+    memory_size = str(memory_size).strip().lower()
+    units = {'k': 1 / 1024, 'm': 1, 'g': 1024, 't': 1024 * 1024}
+
+    if memory_size[-1] in units:
+        return int(float(memory_size[:-1]) * units[memory_size[-1]])
+    return int(memory_size) // (1024 * 1024)
 
 
 def run_ref_miner(repo_to_analyze, branch, output_file):
@@ -49,7 +85,8 @@ def run_ref_miner(repo_to_analyze, branch, output_file):
     ref_miner_config = config_interface.get_tool_path("refactoring_miner")
 
     cmd = [ref_miner_config["path"], '-a', repo_to_analyze, branch, '-json', output_file]
-    return _run_process(cmd)
+    with resource_limits.acquire('jvm'):
+        return _run_process(cmd)
 
 
 def run_weka_filter(filter_method, filter_options, input_file, output_file):
@@ -132,20 +169,95 @@ def checkout_commit(repo_path, commit_hash):
     return _run_process(cmd)
 
 
+def list_tree(repo_path, commit_hash):
+    """
+    Lists every file of a commit, recursively, as NUL-separated '<mode> <type> <object>\t<path>' entries
+    """
+    cmd = ['git', '-C', repo_path, 'ls-tree', '-r', '-z', '--full-tree', commit_hash]
+    return _run_process(cmd, check_out=True)
+
+
+def diff_name_status(repo_path, from_commit_hash, to_commit_hash):
+    """
+    Lists the files added (A), modified (M), deleted (D) or changed in type (T) between two commits, as NUL-separated
+    status and path pairs. Renames are reported as a deletion and an addition
+    """
+    cmd = ['git', '-C', repo_path, 'diff', '--name-status', '--no-renames', '-z', from_commit_hash, to_commit_hash]
+    return _run_process(cmd, check_out=True)
+
+
+def open_cat_file_batch(repo_path):
+    """
+    Starts `git cat-file --batch`, which prints each object whose name is written to its stdin
+
+    :return: the running process, with binary stdin and stdout pipes
+    :rtype: subprocess.Popen
+    """
+    cmd = ['git', '-C', repo_path, 'cat-file', '--batch']
+    return subprocess.Popen(cmd, shell=False, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+
+def add_worktree(repo_path, worktree_path, commit_hash):
+    cmd = ['git', '-C', repo_path, 'worktree', 'add', '--detach', '-f', worktree_path, commit_hash]
+    return _run_process(cmd)
+
+
+def remove_worktree(repo_path, worktree_path):
+    cmd = ['git', '-C', repo_path, 'worktree', 'remove', '--force', worktree_path]
+    return _run_process(cmd)
+
+
+def prune_worktrees(repo_path):
+    """
+    Forgets the worktrees whose folders no longer exist, i.e, those left behind by an interrupted run
+    """
+    cmd = ['git', '-C', repo_path, 'worktree', 'prune']
+    return _run_process(cmd)
+
+
+def head_commit(repo_path):
+    """
+    :return: the hash of the commit checked out in a repository
+    :rtype: str
+    """
+    cmd = ['git', '-C', repo_path, 'rev-parse', 'HEAD']
+    return _run_process(cmd, check_out=True).strip()
+
+
+def branch_ref(repo_path, branch):
+    """
+    :return: the ref of a branch: the local branch, else its remote-tracking branch, or None if neither exists
+    :rtype: str
+    """
+    for ref in (f'refs/heads/{branch}', f'refs/remotes/origin/{branch}'):
+        cmd = ['git', '-C', repo_path, 'rev-parse', '--verify', '--quiet', ref]
+        if subprocess.run(cmd, shell=False, stdout=subprocess.DEVNULL).returncode == 0:
+            return ref
+    return None
+
+
 def update_repository(repo_path):
-    cmd = ['git', '-C', repo_path, 'fetch', '--tags']
-    _run_process(cmd)
+    with resource_limits.acquire('network'):
+        cmd = ['git', '-C', repo_path, 'fetch', '--tags']
+        _run_process(cmd)
 
-    cmd = ['git', '-C', repo_path, 'fetch']
-    _run_process(cmd)
+        cmd = ['git', '-C', repo_path, 'fetch']
+        _run_process(cmd)
 
     cmd = ['git', '-C', repo_path, 'merge']
     _run_process(cmd)
 
 
-def clone_repository(github_link, repo_path):
-    cmd = ['git', 'clone', github_link, repo_path]
-    return _run_process(cmd)
+def clone_repository(github_link, repo_path, long_paths=False):
+    """
+    Clones a repository, within the shared 'network' limit. Raises subprocess.CalledProcessError if the clone fails
+
+    :param long_paths: whether the clone allows paths beyond Windows' 260 characters (core.longpaths)
+    :type long_paths: bool
+    """
+    cmd = ['git', 'clone'] + (['-c', 'core.longpaths=true'] if long_paths else []) + [github_link, repo_path]
+    with resource_limits.acquire('network'):
+        return _run_process(cmd, check_out=True)
 
 
 if __name__ == '__main__':
@@ -1,12 +1,21 @@
+import os
 import re
 from datetime import timedelta
 
 from dateutil import parser as date_parser
 from pydriller import Repository
+
+from database.watermark import Watermark
 from utils import shell_interface
 
 TAG_STR_REGEX = re.compile('.*?tag: (.+?)(,|$)')
 
+# interval_versions must traverse the whole history. Its result is remembered for the rest of the run, and saved beside
+# the project's watermarks (see database.watermark) for as long as the repository's HEAD stays the same, so that the
+# processes of a run (project_workers, version_workers) and later runs do not walk the history again
+_interval_versions_cache = {}
+INTERVAL_VERSIONS_WATERMARK = 'INTERVAL_VERSIONS'
+
 
 class Version:
     id = None
@@ -36,6 +45,20 @@ def interval_versions(repo_path, version_interval=60):
     :return: list of versions
     :rtype: list[Version]
     """
+    cache_key = (os.path.abspath(repo_path), version_interval)
+    if cache_key in _interval_versions_cache:
+        return list(_interval_versions_cache[cache_key])
+
+    head_hash = shell_interface.head_commit(repo_path)
+    watermark = Watermark(str.lower(os.path.basename(cache_key[0])), INTERVAL_VERSIONS_WATERMARK)
+    if watermark.get('head') == head_hash and watermark.get('version_interval') == version_interval:
+        all_versions = [
+            Version(version_id, version_hash, date_parser.parse(author_date))
+            for version_id, version_hash, author_date in watermark.get('versions')
+        ]
+        _interval_versions_cache[cache_key] = all_versions
+        return list(all_versions)
+
     all_versions = []
     target_date = None
     version_counter = 1
@@ -58,7 +81,16 @@ def interval_versions(repo_path, version_interval=60):
 
             version_counter += 1
 
-    return all_versions
+    watermark.reset()
+    watermark.set('head', head_hash)
+    watermark.set('version_interval', version_interval)
+    watermark.set('versions', [
+        [version.id, version.hash_id, version.author_date.isoformat()] for version in all_versions
+    ])
+    watermark.save()
+
+    _interval_versions_cache[cache_key] = all_versions
+    return list(all_versions)
 
 
 def git_tags(repo_path):